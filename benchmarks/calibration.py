@@ -0,0 +1,223 @@
+"""Synthetic calibration benchmarks.
+
+Generates marker calibration problems of configurable size with
+`cate.util.circular_geometry` and `cate.xray.xray_multigeom_project`, and
+reports the time of a residual evaluation, of a Jacobian, and of a complete
+`scipy.optimize.least_squares` run, together with the peak memory of each.
+
+Run from the root of the repository, so that `cate` is importable:
+    python -m benchmarks.calibration --preset small
+    python -m benchmarks.calibration --markers 100 2000 --angles 360 \\
+        --tiles 3 --missing .2 --json results.jsonl
+"""
+import argparse
+import gc
+import itertools
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.optimize
+
+from cate.param import VectorParameter, params2ndarray
+from cate.util import circular_geometry
+from cate.xray import XrayOptimizationProblem, shift, xray_multigeom_project
+
+PRESETS = {
+    'small': dict(markers=[10, 100], angles=[3, 36, 360]),
+    'medium': dict(markers=[100, 500], angles=[360, 1200]),
+    'large': dict(markers=[2000], angles=[3600]),
+}
+
+
+def synthetic_problem(nr_markers: int,
+                      nr_angles: int,
+                      nr_tiles: int = 1,
+                      missing: float = 0.,
+                      noise: float = 0.,
+                      parametrization: str = 'rotation_from_init',
+                      detector_height: float = 2.,
+                      seed: int = 0):
+    """A circular scan of random markers, with perturbed initial values.
+
+    :param nr_tiles: Number of vertical tiles. Every tile is the full
+        circular scan, shifted in height, so that a marker is only annotated
+        in the tiles in which it falls on the detector. With a single tile
+        all markers are on the detector.
+    :param missing: Fraction of the annotations that is randomly removed.
+    :param noise: Standard deviation of the noise on the annotations.
+    :param detector_height: Height of the detector, used for the visibility
+        of markers in tiled scans.
+    :return: Geometries, true and perturbed markers, and the data as a list
+        of `{marker_id: pixel}` dicts, with one list for each tile.
+    """
+    rng = np.random.default_rng(seed)
+    source, detector = np.array([-10., 0., 0.]), np.array([10., 0., 0.])
+    geoms, _ = circular_geometry(source, detector, nr_angles,
+                                 parametrization=parametrization)
+
+    # The height that a tile covers, for the largest magnification, i.e. of
+    # markers that are closest to the source. The tiles cover a marker cloud
+    # that is `nr_tiles` times as tall.
+    radius = .8
+    magnification = np.linalg.norm(detector - source) / (
+        np.linalg.norm(source) - np.sqrt(2) * radius)
+    tile_height = detector_height / magnification
+    height = .9 * tile_height * nr_tiles / 2
+    markers = {
+        i: VectorParameter(rng.uniform([-radius, -radius, -height],
+                                       [radius, radius, height]))
+        for i in range(nr_markers)}
+
+    tiled_geoms, data = [], []
+    offsets = tile_height * (np.arange(nr_tiles) - (nr_tiles - 1) / 2)
+    for t, offset in enumerate(offsets):
+        # the first tile fixes the gauge, the others have an unknown offset
+        vector = np.array([0., 0., offset])
+        vector = VectorParameter(vector) if t > 0 else vector
+        tile = [shift(g, vector) for g in geoms]
+        tile_data = xray_multigeom_project(tile, markers)
+        for projs in tile_data:
+            for id in list(projs.keys()):
+                if abs(projs[id][1]) > detector_height / 2 \
+                        or rng.uniform() < missing:
+                    del projs[id]
+                else:
+                    projs[id] = projs[id] + rng.normal(0., noise, 2)
+
+        tiled_geoms.extend(tile)
+        data.append(tile_data)
+
+    guess = {i: VectorParameter(m.value + rng.normal(0., .01, 3))
+             for i, m in markers.items()}
+    return tiled_geoms, markers, guess, data
+
+
+def _measure(fn, repeat: int = 1) -> tuple:
+    """Best wall time of `fn()` over `repeat` runs, and its peak memory.
+
+    Memory is traced with `tracemalloc`, and hence excludes worker processes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    times = []
+    try:
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - t0)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak, result
+
+
+def run(nr_markers, nr_angles, nr_tiles=1, missing=0., noise=0.,
+        mode='jointly', jac='analytic', max_nfev=10, repeat=3,
+        seed=0) -> dict:
+    """Runs a single benchmark, see `synthetic_problem` for the arguments.
+
+    :param jac: 'analytic', 'parallel' for
+        `cate.parallel.FiniteDifferenceJacobian`, or '2-point' for grouped
+        finite differences of `scipy.optimize.least_squares`, of which the
+        Jacobian time is that of a `least_squares` run that stops after the
+        first Jacobian, minus a residual evaluation.
+    :return: A dict with the sizes, times (in seconds) and peak memory
+        (in bytes) of the residuals, the Jacobian and `least_squares`.
+    """
+    geoms, _, guess, data = synthetic_problem(
+        nr_markers, nr_angles, nr_tiles, missing, noise, seed=seed)
+    problem = XrayOptimizationProblem(
+        guess if mode == 'jointly' else None, geoms, data, mode=mode)
+    x0 = params2ndarray(problem.params())
+    rng = np.random.default_rng(seed)
+
+    def _residuals():
+        # perturb everything, so that no residuals are reused
+        return problem(x0 + rng.normal(0., 1e-6, len(x0)))
+
+    jac_sparsity = None
+    if jac == 'analytic':
+        jac_fn = problem.jacobian
+    elif jac == 'parallel':
+        from cate.parallel import FiniteDifferenceJacobian
+        jac_fn = FiniteDifferenceJacobian(problem)
+    else:
+        jac_fn, jac_sparsity = jac, problem.jac_sparsity()
+
+    def _least_squares(max_nfev=max_nfev):
+        return scipy.optimize.least_squares(
+            problem, x0, jac=jac_fn, jac_sparsity=jac_sparsity,
+            tr_solver='lsmr', max_nfev=max_nfev)
+
+    residual_time, residual_peak, f = _measure(_residuals, repeat)
+    if callable(jac_fn):
+        jac_time, jac_peak, _ = _measure(lambda: jac_fn(x0), repeat)
+    else:
+        # a single evaluation of the residuals and the Jacobian
+        jac_time, jac_peak, _ = _measure(lambda: _least_squares(1), repeat)
+        jac_time = max(jac_time - residual_time, 0.)
+    solve_time, solve_peak, r = _measure(_least_squares)
+    if hasattr(jac_fn, 'close'):
+        jac_fn.close()
+
+    return dict(
+        markers=nr_markers, angles=nr_angles, tiles=nr_tiles,
+        missing=missing, noise=noise, mode=mode, jac=jac,
+        geometries=len(geoms), parameters=len(x0), residuals=len(f),
+        residual_time=residual_time, residual_peak=residual_peak,
+        jacobian_time=jac_time, jacobian_peak=jac_peak,
+        least_squares_time=solve_time, least_squares_peak=solve_peak,
+        nfev=r.nfev, cost=r.cost)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--preset', choices=PRESETS.keys())
+    parser.add_argument('--markers', type=int, nargs='+', default=[100])
+    parser.add_argument('--angles', type=int, nargs='+', default=[360])
+    parser.add_argument('--tiles', type=int, nargs='+', default=[1])
+    parser.add_argument('--missing', type=float, nargs='+', default=[0.])
+    parser.add_argument('--noise', type=float, default=0.)
+    parser.add_argument('--mode', choices=['jointly', 'alternate'],
+                        default='jointly')
+    parser.add_argument('--jac', choices=['analytic', 'parallel', '2-point'],
+                        default='analytic')
+    parser.add_argument('--max-nfev', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help="Appends results as JSON lines.")
+    args = parser.parse_args()
+
+    if args.preset is not None:
+        args.markers = PRESETS[args.preset]['markers']
+        args.angles = PRESETS[args.preset]['angles']
+
+    header = (f"{'markers':>8} {'angles':>7} {'tiles':>5} {'missing':>7} "
+              f"{'params':>7} {'residuals':>10} | {'f [s]':>8} "
+              f"{'J [s]':>8} {'lsq [s]':>8} | {'peak f':>8} {'peak J':>8} "
+              f"{'peak lsq':>8}")
+    print(header)
+    print('-' * len(header))
+    for nr_markers, nr_angles, nr_tiles, missing in itertools.product(
+            args.markers, args.angles, args.tiles, args.missing):
+        result = run(nr_markers, nr_angles, nr_tiles, missing, args.noise,
+                     args.mode, args.jac, args.max_nfev, args.repeat)
+        mb = 2 ** 20
+        print(f"{nr_markers:>8} {nr_angles:>7} {nr_tiles:>5} {missing:>7.2f} "
+              f"{result['parameters']:>7} {result['residuals']:>10} | "
+              f"{result['residual_time']:>8.4f} "
+              f"{result['jacobian_time']:>8.4f} "
+              f"{result['least_squares_time']:>8.3f} | "
+              f"{result['residual_peak'] / mb:>6.1f}MB "
+              f"{result['jacobian_peak'] / mb:>6.1f}MB "
+              f"{result['least_squares_peak'] / mb:>6.1f}MB", flush=True)
+
+        if args.json is not None:
+            with open(args.json, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,412 @@
+import ast
+import os
+import shutil
+import weakref
 from abc import ABC, abstractmethod
 
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.widgets import Button
 
+from cate.data import ProjectionData
+
+# one record per annotation, see `AnnotationStore`
+ANNOTATION_DTYPE = np.dtype([('frame', '<i8'),
+                             ('marker', 'S32'),
+                             ('u', '<f8'),
+                             ('v', '<f8'),
+                             ('confidence', '<f4')])
+
+
+class AnnotationStore:
+    """Columnar, append-only store of marker annotations.
+
+    The annotations are records of `ANNOTATION_DTYPE` in a single `.npy`
+    file, which is memory-mapped, so that all frames are available after
+    one load. New annotations are appended to the end of the file, and only
+    its header is rewritten. A later record of the same frame and marker
+    replaces an earlier one, and a record with `NaN` pixel removes it, see
+    `latest`. `compact` rewrites the file without the replaced records.
+
+    Marker ids are stored as their UTF-8 encoded `repr`, of at most 32
+    bytes, so that strings, integers and tuples of those are restored as
+    they were.
+
+    Files in the pickled dict format of old `EntityLocations` are read as
+    they are, and only converted on disk, see `migrate_annotations`, when
+    they are first written to.
+
+    Use `open` to share one store between all users of a file, which is
+    re-read when it was changed by another process or store since.
+    """
+
+    _opened = weakref.WeakValueDictionary()
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._records = None
+        self._latest = None
+        self._frames = None
+        # (mtime, size) of the file when `_records` was loaded
+        self._file_stamp = None
+
+    @classmethod
+    def open(cls, fname) -> 'AnnotationStore':
+        """The store of `fname`, shared with previous calls."""
+        key = os.path.abspath(fname)
+        store = cls._opened.get(key)
+        if store is None:
+            store = cls(fname)
+            cls._opened[key] = store
+        elif store._file_stamp != _file_stamp(fname):
+            store._reset()
+
+        return store
+
+    @property
+    def records(self) -> np.ndarray:
+        """All records, including replaced ones, in the order of writing."""
+        if self._records is None:
+            self._file_stamp = _file_stamp(self.fname)
+            self._records = _load(self.fname)
+
+        return self._records
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, frames, markers, pixels, confidence=1.):
+        """Appends annotations of `markers` in `frames`, without rewriting
+        the file.
+
+        :param frames: Frame number of each annotation, or a single one.
+        :param markers: Marker id of each annotation.
+        :param pixels: (K, 2) array of (u, v) pixels, `NaN` to remove an
+            annotation.
+        :param confidence: Scalar or (K,) array, e.g. of a marker detector.
+        """
+        markers = list(markers)
+        pixels = np.reshape(np.asarray(pixels, dtype=float), (-1, 2))
+        records = np.empty(len(markers), dtype=ANNOTATION_DTYPE)
+        records['frame'] = frames
+        records['marker'] = [_encode_id(m) for m in markers]
+        records['u'] = pixels[:, 0]
+        records['v'] = pixels[:, 1]
+        records['confidence'] = confidence
+
+        # the memory map must not be used while the file grows
+        self._reset()
+        if _is_legacy(self.fname):
+            migrate_annotations(self.fname)
+
+        _append(self.fname, records)
+
+    def latest(self) -> np.ndarray:
+        """The current annotations, i.e. the last record of every frame and
+        marker, without removed ones, sorted by frame and marker."""
+        if self._latest is None:
+            records = self.records
+            # stable sort, so that the last record of a group is the latest
+            order = np.lexsort((records['marker'], records['frame']))
+            sorted_records = records[order]
+            last = np.ones(len(order), dtype=bool)
+            last[:-1] = (sorted_records['frame'][1:]
+                         != sorted_records['frame'][:-1]) | (
+                sorted_records['marker'][1:] != sorted_records['marker'][:-1])
+            latest = sorted_records[last]
+            self._latest = latest[~np.isnan(latest['u'])]
+
+        return self._latest
+
+    def frames(self) -> np.ndarray:
+        """Sorted frame numbers that have annotations."""
+        return np.unique(self.latest()['frame'])
+
+    def locations(self, frame) -> dict:
+        """`{marker_id: [u, v]}` of `frame`, sorted by marker id."""
+        latest = self.latest()
+        if self._frames is None:
+            self._frames = latest['frame']
+
+        lo, hi = np.searchsorted(self._frames, [frame, frame + 1])
+        items = [(_decode_id(r['marker']), [float(r['u']), float(r['v'])])
+                 for r in latest[lo:hi]]
+        try:
+            items.sort(key=lambda item: item[0])
+        except TypeError:
+            pass  # ids of different types stay sorted by their `repr`
+
+        return dict(items)
+
+    def _reset(self):
+        self._records, self._latest, self._frames = None, None, None
+        self._file_stamp = None
+
+    def compact(self):
+        """Rewrites the file with only the `latest` annotations."""
+        latest = np.array(self.latest())
+        self._reset()
+        if _is_legacy(self.fname):
+            migrate_annotations(self.fname)
+
+        _save(self.fname, latest)
+
+
+def load_projection_data(fnames, frames, ids=None,
+                         allow_missing: bool = True) -> ProjectionData:
+    """Annotations of `frames` as a `ProjectionData`, reading every file
+    once.
+
+    :param fnames: An annotation file, or a list of files, e.g. one for each
+        tile of a tiled scan. See `AnnotationStore`, old pickled files are
+        read as well.
+    :param frames: The (unique) frame numbers, in the order of the
+        geometries. With multiple files, a list of frame numbers for each
+        file, of which the geometries are concatenated.
+    :param ids: Marker ids of the columns. Markers that are not in `ids`
+        are left out. Defaults to all markers in the requested frames,
+        sorted.
+    :param allow_missing: If `False`, raises a `KeyError` for frames
+        without any annotations, as `EntityLocations.locations` does.
+    :return: `ProjectionData` with a row for each frame, which is empty for
+        frames without annotations.
+    """
+    if isinstance(fnames, (str, os.PathLike)):
+        fnames, frames = [fnames], [frames]
+
+    if len(fnames) != len(frames):
+        raise ValueError("`frames` must have a list of frames for each file.")
+
+    # the annotations of the requested frames, and their geometry index
+    selected, rows, offset = [], [], 0
+    for fname, file_frames in zip(fnames, frames):
+        file_frames = np.asarray(file_frames, dtype=np.int64)
+        if len(file_frames) == 0:
+            continue
+
+        latest = AnnotationStore.open(fname).latest()
+        order = np.argsort(file_frames)
+        pos = np.minimum(np.searchsorted(file_frames[order], latest['frame']),
+                         len(file_frames) - 1)
+        found = file_frames[order][pos] == latest['frame']
+        selected.append(latest[found])
+        rows.append(offset + order[pos[found]])
+        offset += len(file_frames)
+
+    records = np.concatenate(selected) if len(selected) > 0 \
+        else np.empty(0, dtype=ANNOTATION_DTYPE)
+    rows = np.concatenate(rows).astype(int) if len(rows) > 0 \
+        else np.empty(0, dtype=int)
+
+    if not allow_missing:
+        annotated = np.zeros(offset, dtype=bool)
+        annotated[rows] = True
+        if not np.all(annotated):
+            requested = np.concatenate(
+                [np.asarray(f, dtype=np.int64) for f in frames]
+                + [np.empty(0, dtype=np.int64)])
+            raise KeyError(f"No annotations of frames "
+                           f"{requested[~annotated].tolist()}.")
+
+    # ids are decoded once, not for every record
+    encoded, cols = np.unique(records['marker'], return_inverse=True)
+    decoded = [_decode_id(e) for e in encoded]
+    if ids is None:
+        ids = list(decoded)
+        try:
+            ids.sort()
+        except TypeError:
+            pass  # ids of different types stay sorted by their `repr`
+
+    ids = list(ids)
+    index = {id: i for i, id in enumerate(ids)}
+    column = np.array([index.get(id, -1) for id in decoded], dtype=int)
+    cols = column[cols] if len(cols) > 0 else cols.astype(int)
+    keep = cols >= 0
+
+    pixels = np.full((offset, len(ids), 2), np.nan)
+    mask = np.zeros((offset, len(ids)), dtype=bool)
+    pixels[rows[keep], cols[keep], 0] = records['u'][keep]
+    pixels[rows[keep], cols[keep], 1] = records['v'][keep]
+    mask[rows[keep], cols[keep]] = True
+    return ProjectionData(pixels, mask, ids)
+
+
+def migrate_annotations(fname, new_fname=None, backup: bool = True):
+    """Converts a pickled `{frame: {marker_id: pixel}}` dict, the format of
+    old `EntityLocations` files, to an `AnnotationStore` file.
+
+    :param new_fname: Defaults to overwriting `fname`.
+    :param backup: Keep the old file as `fname + '.bak'`, when overwritten.
+    """
+    records = _legacy_records(fname)
+    if new_fname is None:
+        new_fname = fname
+        if backup:
+            shutil.copyfile(fname, fname + '.bak')
+
+    _save(new_fname, records)
+
+
+def _legacy_records(fname) -> np.ndarray:
+    """Records of a file in the pickled dict format of old
+    `EntityLocations`."""
+    locations = np.load(fname, allow_pickle=True).item()
+    frames, markers, pixels = [], [], []
+    for frame, frame_locations in locations.items():
+        for id, pixel in frame_locations.items():
+            frames.append(frame)
+            markers.append(id)
+            pixels.append(pixel)
+
+    records = np.empty(len(markers), dtype=ANNOTATION_DTYPE)
+    records['frame'] = frames
+    records['marker'] = [_encode_id(m) for m in markers]
+    records['u'], records['v'] = np.reshape(pixels, (-1, 2)).T
+    records['confidence'] = 1.
+    return records
+
+
+def _encode_id(id) -> bytes:
+    if isinstance(id, np.generic):
+        id = id.item()
+    if isinstance(id, list):
+        id = tuple(id)
+
+    encoded = repr(id).encode('utf-8')
+    if len(encoded) > ANNOTATION_DTYPE['marker'].itemsize:
+        raise ValueError(f"Marker id {id!r} is too long to be stored.")
+
+    return encoded
+
+
+def _decode_id(encoded: bytes):
+    return ast.literal_eval(encoded.decode('utf-8'))
+
+
+def _read_header(f) -> tuple:
+    """Shape and dtype of a `.npy` file, leaving `f` at the data."""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+
+    return shape, dtype, version
+
+
+def _file_stamp(fname):
+    try:
+        stat = os.stat(fname)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _is_legacy(fname) -> bool:
+    if not os.path.exists(fname):
+        return False
+
+    with open(fname, 'rb') as f:
+        return _read_header(f)[1].hasobject
+
+
+def _load(fname) -> np.ndarray:
+    if not os.path.exists(fname):
+        return np.empty(0, dtype=ANNOTATION_DTYPE)
+
+    with open(fname, 'rb') as f:
+        shape, dtype, _ = _read_header(f)
+
+    if dtype.hasobject:
+        # converted in memory, the file is left as it is
+        return _legacy_records(fname)
+    if dtype != ANNOTATION_DTYPE:
+        raise ValueError(f"{fname} is not an annotation file.")
+    if shape[0] == 0:
+        return np.empty(0, dtype=ANNOTATION_DTYPE)
+
+    return np.load(fname, mmap_mode='r')
+
+
+def _save(fname, records: np.ndarray):
+    with open(fname, 'wb') as f:
+        np.lib.format.write_array(f, records)
+
+
+def _append(fname, records: np.ndarray):
+    """Appends `records` to the file, and updates the shape in its header.
+
+    NumPy reserves space in the header for the shape to grow, so that the
+    header can be rewritten in-place. Otherwise the file is rewritten.
+    """
+    if not os.path.exists(fname):
+        _save(fname, records)
+        return
+
+    with open(fname, 'r+b') as f:
+        shape, dtype, version = _read_header(f)
+        if dtype != ANNOTATION_DTYPE:
+            raise ValueError(f"{fname} is not an annotation file.")
+
+        data_offset = f.tell()
+        header = _header(shape[0] + len(records), version)
+        if len(header) == data_offset:
+            f.seek(0)
+            f.write(header)
+            f.seek(data_offset + shape[0] * dtype.itemsize)
+            f.write(records.tobytes())
+            return
+
+    old = np.fromfile(fname, dtype=ANNOTATION_DTYPE, offset=data_offset,
+                      count=shape[0])
+    _save(fname, np.concatenate((old, records)))
+
+
+def _header(length: int, version) -> bytes:
+    import io
+
+    d = {'descr': np.lib.format.dtype_to_descr(ANNOTATION_DTYPE),
+         'fortran_order': False,
+         'shape': (length,)}
+    f = io.BytesIO()
+    if version == (1, 0):
+        np.lib.format.write_array_header_1_0(f, d)
+    else:
+        np.lib.format.write_array_header_2_0(f, d)
+
+    return f.getvalue()
+
 
 class EntityLocations(ABC):
     def __init__(self, fname, angle_nr):
         self.fname = fname
         self.angle_nr = angle_nr
-
-        try:
-            self._locations = np.load(fname, allow_pickle=True).item()
-        except FileNotFoundError:
-            self._locations = dict()
+        # shared between all angles of the file, see `AnnotationStore.open`
+        self._store = AnnotationStore.open(fname)
 
     def locations(self):
-        if len(self._locations) == 0:
+        if len(self._store) == 0:
             raise Exception("Location file is empty.")
 
-        return dict(sorted(self._locations[self.angle_nr].items()))
+        locations = self._store.locations(self.angle_nr)
+        if len(locations) == 0:
+            raise KeyError(self.angle_nr)
 
-    def __getitem__(self, item):
-        try:
-            value = self._locations[self.angle_nr][item]
-        except:
-            value = False
+        return locations
 
-        return value
+    def __getitem__(self, item):
+        return self._store.locations(self.angle_nr).get(item, False)
 
     def __setitem__(self, key, value: list):
         print(f"Setting {key} to {value} for projection {self.angle_nr}.")
-        if not (self.angle_nr in self._locations):
-            self._locations[self.angle_nr] = dict()
-
-        self._locations[self.angle_nr][key] = value
-        self.save()
+        self._store.append([self.angle_nr], [key], [value])
 
     def save(self):
-        np.save(self.fname, self._locations)
+        """Annotations are appended when they are set, this removes the
+        records that were replaced since."""
+        self._store.compact()
 
     @staticmethod
     @abstractmethod
@@ -1,6 +1,7 @@
 import numpy as np
 
-from cate.xray import Geometry
+from cate.data import ProjectionData
+from cate.xray import Geometry, geometry_arrays
 
 
 class Detector:
@@ -64,15 +65,55 @@ def pixel2coord(pixel, det: Detector):
     detector midpoint is in (0, 0), the z-axis is pointing upwards and the
     image is flipped.
     """
-    pixel[0] = -pixel[0] + det.cols  # revert vertical axis (image convention)
-    pixel[1] = (pixel[1] - det.rows / 2) * det.pixel_width
-    pixel[0] = (pixel[0] - det.cols / 2) * det.pixel_height
-    pixel[1] = -pixel[1]  # observer frame is always flipped left-right
-
+    pixel[:] = pixel2coord_batch(pixel, det)
     return pixel
 
 
+def pixel2coord_batch(pixels, det: Detector, roi_offset=(0., 0.),
+                      binning=1, out: np.ndarray = None) -> np.ndarray:
+    """Vectorized `pixel2coord`, for images of a region of interest (ROI)
+    of the detector, or binned images.
+
+    :param pixels: (..., 2) array of pixels, e.g. the (G, N, 2) `pixels` of
+        a `cate.data.ProjectionData`. `NaN`s stay `NaN`.
+    :param det: The full, unbinned, detector.
+    :param roi_offset: Position of the (0, 0) corner of the image on the
+        full detector, in unbinned pixels, for each of the two axes.
+    :param binning: Binning factor, a scalar or one for each axis.
+    :param out: Optional output array, which may be `pixels` itself.
+    :return: (..., 2) array of detector coordinates.
+    """
+    center, scale = _detector_frame(det)
+    pixels = np.asarray(pixels, dtype=float)
+    full = pixels * binning + roi_offset
+    # `cols - p`, and the left-right flip, mirror both axes
+    return np.multiply(center - full, scale, out=out)
+
+
+def coord2pixel_batch(coords, det: Detector, roi_offset=(0., 0.),
+                      binning=1, out: np.ndarray = None) -> np.ndarray:
+    """Inverse of `pixel2coord_batch`, e.g. to draw projected markers in
+    the image."""
+    center, scale = _detector_frame(det)
+    coords = np.asarray(coords, dtype=float)
+    full = center - coords / scale
+    return np.divide(full - roi_offset, binning, out=out)
+
+
+def _detector_frame(det: Detector) -> tuple:
+    """The pixel of the detector midpoint, and the size of a pixel, for the
+    two axes of `pixel2coord`."""
+    return (np.array([det.cols / 2, det.rows / 2]),
+            np.array([det.pixel_height, det.pixel_width]))
+
+
 def pixels2coords(data, detector: Detector):
+    """Converts annotations in-place, either the `pixels` of a
+    `cate.data.ProjectionData`, or `{cam: [{id: pixel}]}` dicts."""
+    if isinstance(data, ProjectionData):
+        pixel2coord_batch(data.pixels, detector, out=data.pixels)
+        return
+
     for cam, proj_times in data.items():
         for proj in proj_times:
             for id, pixel in proj.items():
@@ -84,13 +125,38 @@ def geom2astravec(g: Geometry, detector: dict):
 
     Note that the CATE description is dimensionless, so we use DET_PIXEL_WIDTH
     and DET_PIXEL_HEIGHT inside the function to go back to real dimensions."""
-    c = lambda x: (x[1], x[0], - x[2])
-    d = lambda x: np.array(
-        (- x[1], - x[0], x[2])) * detector['pixel_width']
-    e = lambda x: np.array(
-        (- x[1], - x[0], x[2])) * detector['pixel_height']
-
-    return [*c(g.source),
-            *c(g.detector),
-            *d(Geometry.u(g.roll, g.pitch, g.yaw)),
-            *e(Geometry.v(g.roll, g.pitch, g.yaw))]
+    return geoms2astravecs([g], detector)[0]
+
+
+def geoms2astravecs(geoms, detector: dict, dtype=np.float64,
+                    out: np.ndarray = None) -> np.ndarray:
+    """Vectorized `geom2astravec` for many geometries.
+
+    :param geoms: A list of geometries, or a collection with an `arrays()`
+        method, see `cate.xray.geometry_arrays`. Geometries that share
+        decorators are resolved once.
+    :param detector: A dict with 'pixel_width' and 'pixel_height', or a
+        `Detector`.
+    :param dtype: Data type of the output, e.g. `np.float32` for ASTRA.
+    :param out: Optional (G, 12) array to write the vectors into.
+    :return: (G, 12) array of ASTRA cone_vec vectors.
+    """
+    if isinstance(detector, Detector):
+        detector = detector.todict()
+
+    sources, detectors, rotations = geometry_arrays(geoms)
+    if out is None:
+        out = np.empty((len(sources), 12), dtype=dtype)
+    elif out.shape != (len(sources), 12):
+        raise ValueError(f"`out` must have shape ({len(sources)}, 12).")
+
+    # (x, y, z) -> (y, x, -z) for positions, and (-y, -x, z) for the
+    # detector `u` and `v`, which are the 2nd and 3rd row of the rotation
+    # matrix, see `Geometry.u` and `Geometry.v`
+    flip = np.array([1., 1., -1.])
+    out[:, 0:3] = sources[:, [1, 0, 2]] * flip
+    out[:, 3:6] = detectors[:, [1, 0, 2]] * flip
+    out[:, 6:9] = rotations[:, 1, [1, 0, 2]] * -flip * detector['pixel_width']
+    out[:, 9:12] = rotations[:, 2, [1, 0, 2]] * -flip \
+        * detector['pixel_height']
+    return out
@@ -0,0 +1,121 @@
+import numpy as np
+
+
+class ProjectionData:
+    """Dense, masked layout of annotated marker projections.
+
+    For `G` geometries and `N` markers the annotations are stored in a
+    (G, N, 2) float array `pixels`, together with a (G, N) boolean `mask`
+    that tells which markers are annotated in which geometry. Entries that
+    are not annotated are `NaN` in `pixels`. The markers are identified by
+    `ids`, where `ids[i]` is the marker that belongs to column `i`.
+
+    This is the counterpart of the list-of-dicts format, where every list
+    item is a geometry, and every dict is a `{marker_id: pixel}` mapping,
+    which may have missing markers in partially annotated (e.g. tiled) scans.
+    """
+
+    def __init__(self, pixels: np.ndarray, mask: np.ndarray, ids):
+        pixels = np.asarray(pixels, dtype=float)
+        mask = np.asarray(mask, dtype=bool)
+        ids = list(ids)
+
+        if pixels.ndim != 3 or pixels.shape[2] != 2:
+            raise ValueError("`pixels` must have shape (G, N, 2).")
+        if mask.shape != pixels.shape[:2]:
+            raise ValueError("`mask` must have shape (G, N).")
+        if len(ids) != pixels.shape[1]:
+            raise ValueError("`ids` must have one entry for each marker.")
+        if len(set(ids)) != len(ids):
+            raise ValueError("`ids` must be unique.")
+
+        self.pixels = pixels
+        self.mask = mask
+        self.ids = ids
+        self.index = {id: i for i, id in enumerate(ids)}
+
+    @classmethod
+    def from_dicts(cls, data, ids=None):
+        """Converts the list-of-dicts format to a `ProjectionData`.
+
+        :param data: A list of `{marker_id: pixel}` dicts, one per geometry.
+            Nested lists, e.g. one list per tile of a tiled scan, are
+            flattened first.
+        :param ids: Column order of the markers. Defaults to the order in which
+            the markers first appear in `data`. Markers that are in `ids` but
+            never annotated get an empty column.
+        """
+        data = list(_flatten(data))
+
+        if ids is None:
+            ids = {}
+            for proj in data:
+                for id in proj.keys():
+                    ids.setdefault(id, None)
+
+        ids = list(ids)
+        index = {id: i for i, id in enumerate(ids)}
+
+        pixels = np.full((len(data), len(ids), 2), np.nan)
+        mask = np.zeros((len(data), len(ids)), dtype=bool)
+        for i, proj in enumerate(data):
+            if len(proj) == 0:
+                continue
+
+            try:
+                cols = [index[id] for id in proj.keys()]
+            except KeyError as e:
+                raise ValueError(f"Marker {e} is annotated but not in `ids`.")
+
+            pixels[i, cols] = np.reshape(list(proj.values()), (-1, 2))
+            mask[i, cols] = True
+
+        return cls(pixels, mask, ids)
+
+    def to_dicts(self) -> list:
+        """Converts back to the list-of-dicts format."""
+        data = []
+        for g_pixels, g_mask in zip(self.pixels, self.mask):
+            data.append({self.ids[i]: g_pixels[i]
+                         for i in np.flatnonzero(g_mask)})
+
+        return data
+
+    def __len__(self):
+        return self.pixels.shape[0]
+
+    @property
+    def nr_markers(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def nr_observations(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+    def values(self) -> np.ndarray:
+        """(M, 2) array of the `M` annotated pixels, in row-major order of
+        (geometry, marker)."""
+        return self.pixels[self.mask]
+
+    def observations(self) -> tuple:
+        """Geometry and marker index of each of the `M` annotated pixels, in
+        the order of `values()`."""
+        return np.nonzero(self.mask)
+
+    def counts(self) -> np.ndarray:
+        """Number of annotations of each marker."""
+        return np.count_nonzero(self.mask, axis=0)
+
+    def take(self, geom_indices):
+        """Selects the rows of a subset of geometries."""
+        return ProjectionData(self.pixels[geom_indices],
+                              self.mask[geom_indices],
+                              self.ids)
+
+
+def _flatten(data):
+    for item in data:
+        if isinstance(item, dict):
+            yield item
+        else:
+            yield from _flatten(item)
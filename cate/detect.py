@@ -0,0 +1,224 @@
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.ndimage
+
+
+def detect_markers(image: np.ndarray,
+                   sigma: float = 2.,
+                   polarity: str = 'dark',
+                   snr: float = 5.,
+                   threshold: float = None,
+                   min_distance: int = None,
+                   max_markers: int = None,
+                   tile_size: int = 1024) -> tuple:
+    """Finds markers, such as metal balls or needle tips, in a projection.
+
+    Markers are the peaks of a scale-normalized Laplacian of Gaussian (LoG)
+    filter, refined to sub-pixel accuracy by interpolation of the response,
+    see `_refine`. Large images are processed in overlapping tiles. The pixels
+    are in the convention of `cate.annotate.Annotator`, i.e. `[x, y]` with
+    `x` the column and `y` the row of the image.
+
+    :param image: 2D projection image.
+    :param sigma: Scale of the LoG filter, about the radius of the markers
+        in pixels divided by sqrt(2).
+    :param polarity: 'dark' for markers that absorb, in raw projections, or
+        'bright' for markers in log-transformed projections.
+    :param snr: Minimal peak response, in units of the noise level of the
+        response, which is estimated for each tile from its median absolute
+        deviation.
+    :param threshold: Minimal peak response, instead of `snr`.
+    :param min_distance: Minimal distance between two markers, in pixels,
+        defaults to `2 * sigma`.
+    :param max_markers: Keep only this many of the strongest detections.
+    :param tile_size: Size of the square tiles, which overlap by the extent
+        of the filter.
+    :return: (K, 2) array of `[x, y]` pixels, and the (K,) signal-to-noise
+        ratio of each detection, as confidence, strongest first.
+    """
+    if polarity == 'dark':
+        image = -np.asarray(image, dtype=float)
+    elif polarity == 'bright':
+        image = np.asarray(image, dtype=float)
+    else:
+        raise ValueError("`polarity` must be 'dark' or 'bright'.")
+
+    if image.ndim != 2:
+        raise ValueError("`image` must be 2D.")
+
+    if min_distance is None:
+        min_distance = max(1, int(round(2 * sigma)))
+
+    margin = int(np.ceil(4 * sigma)) + min_distance + 1
+
+    pixels, confidences = [], []
+    rows, cols = image.shape
+    for r0 in range(0, rows, tile_size):
+        for c0 in range(0, cols, tile_size):
+            core = (slice(r0, min(r0 + tile_size, rows)),
+                    slice(c0, min(c0 + tile_size, cols)))
+            tile_pixels, tile_conf = _detect_tile(
+                image, core, margin, sigma, snr, threshold, min_distance)
+            pixels.append(tile_pixels)
+            confidences.append(tile_conf)
+
+    pixels = np.concatenate(pixels)
+    confidences = np.concatenate(confidences)
+    order = np.argsort(-confidences, kind='stable')[:max_markers]
+    return pixels[order], confidences[order]
+
+
+def _detect_tile(image, core, margin, sigma, snr, threshold,
+                 min_distance) -> tuple:
+    """Detections of which the peak is in the `core` slices of `image`."""
+    window = tuple(slice(max(s.start - margin, 0),
+                         min(s.stop + margin, n))
+                   for s, n in zip(core, image.shape))
+    offset = np.array([window[0].start, window[1].start])
+
+    # scale-normalized, positive for bright blobs
+    response = -sigma ** 2 * scipy.ndimage.gaussian_laplace(
+        image[window], sigma, mode='nearest')
+
+    core_response = response[tuple(
+        slice(s.start - o, s.stop - o) for s, o in zip(core, offset))]
+    noise = 1.4826 * np.median(np.abs(
+        core_response - np.median(core_response)))
+    noise = max(noise, np.finfo(float).tiny)
+    if threshold is None:
+        threshold = snr * noise
+
+    peaks = (response == scipy.ndimage.maximum_filter(
+        response, size=2 * min_distance + 1, mode='nearest')) \
+        & (response > threshold)
+    r, c = np.nonzero(peaks)
+    inside = ((r + offset[0] >= core[0].start) & (r + offset[0] < core[0].stop)
+              & (c + offset[1] >= core[1].start)
+              & (c + offset[1] < core[1].stop))
+    r, c = r[inside], c[inside]
+
+    pixels = _refine(response, r, c) + offset[::-1]
+    return pixels, response[r, c] / noise
+
+
+def _refine(response, r, c) -> np.ndarray:
+    """Sub-pixel peaks of the response, as (K, 2) `[x, y]` pixels.
+
+    In each axis a parabola is fitted through the logarithm of the peak and
+    its two neighbours, which is exact for Gaussian peaks. Peaks at the
+    border, or with non-positive neighbours, use a parabola through the
+    response itself, or stay at the pixel.
+    """
+    out = np.stack((c, r), axis=1).astype(float)
+    for axis, idx in ((0, r), (1, c)):
+        inner = (idx > 0) & (idx < response.shape[axis] - 1)
+        step = np.array([[1, 0], [0, 1]])[axis]
+        i, j = r[inner], c[inner]
+        f = np.stack((response[i - step[0], j - step[1]], response[i, j],
+                      response[i + step[0], j + step[1]]))
+        positive = np.all(f > 0., axis=0)
+        f[:, positive] = np.log(f[:, positive])
+        denom = f[0] - 2 * f[1] + f[2]
+        delta = np.where(denom < 0., .5 * (f[0] - f[2])
+                         / np.where(denom < 0., denom, -1.), 0.)
+        out[np.flatnonzero(inner), 1 - axis] += np.clip(delta, -.5, .5)
+
+    return out
+
+
+def assign_ids(pixels: np.ndarray, reference: dict,
+               max_distance: float) -> dict:
+    """Identifies detections by an optimal one-to-one matching to reference
+    pixels.
+
+    :param pixels: (K, 2) detections, see `detect_markers`.
+    :param reference: `{marker_id: [x, y]}` expected pixels, e.g. the
+        projections of the markers with an initial geometry, converted with
+        `cate.astra.coord2pixel_batch`.
+    :param max_distance: Detections further than this from the reference
+        are not assigned.
+    :return: `{marker_id: [x, y]}` of the assigned detections.
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    ids = list(reference.keys())
+    if len(ids) == 0 or len(pixels) == 0:
+        return {}
+
+    expected = np.reshape([reference[id] for id in ids], (-1, 2))
+    distances = np.linalg.norm(
+        expected[:, np.newaxis] - np.asarray(pixels)[np.newaxis], axis=-1)
+    # too distant pairs are effectively forbidden
+    cost = np.where(distances <= max_distance, distances,
+                    max_distance * (len(ids) + len(pixels) + 1))
+    rows, cols = linear_sum_assignment(cost)
+    return {ids[i]: list(pixels[j]) for i, j in zip(rows, cols)
+            if distances[i, j] <= max_distance}
+
+
+def detect_frames(load, frames, references=None, max_distance: float = 10.,
+                  processes: int = None, store=None, **kwargs) -> list:
+    """`detect_markers` on many frames, in a pool of processes.
+
+    :param load: Function that returns the image of a frame number. It is
+        called in the worker processes, so that only the frame number is
+        sent, and must therefore be picklable (e.g. a module-level function
+        or a `functools.partial` of one).
+    :param frames: The frame numbers.
+    :param references: Optional list with a `{marker_id: [x, y]}` dict for
+        each frame, see `assign_ids`. Without references, the detections of
+        each frame are numbered by decreasing confidence, and these ids do
+        not correspond between frames.
+    :param max_distance: See `assign_ids`.
+    :param processes: Number of processes, defaults to the number of CPUs.
+        With 1, the frames are processed in this process.
+    :param store: Optional `cate.annotate.AnnotationStore`, to which all
+        detections are appended at once, with their confidence.
+    :param kwargs: Passed to `detect_markers`.
+    :return: A `{marker_id: [x, y]}` dict for each frame, as the annotations
+        of `cate.annotate.EntityLocations`.
+    """
+    frames = list(frames)
+    if references is not None and len(references) != len(frames):
+        raise ValueError("`references` must have a dict for each frame.")
+
+    detect = functools.partial(_detect_frame, load, kwargs)
+    if processes is None:
+        processes = os.cpu_count()
+
+    if processes == 1 or len(frames) <= 1:
+        detections = [detect(f) for f in frames]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            chunksize = max(1, len(frames) // (4 * processes))
+            detections = list(pool.map(detect, frames, chunksize=chunksize))
+
+    data, records = [], ([], [], [], [])
+    for i, (frame, (pixels, confidence)) in enumerate(
+            zip(frames, detections)):
+        if references is None:
+            located = {j: list(p) for j, p in enumerate(pixels)}
+            conf = confidence
+        else:
+            located = assign_ids(pixels, references[i], max_distance)
+            conf_of = {tuple(p): c for p, c in zip(pixels, confidence)}
+            conf = [conf_of[tuple(p)] for p in located.values()]
+
+        data.append(located)
+        records[0].extend([frame] * len(located))
+        records[1].extend(located.keys())
+        records[2].extend(located.values())
+        records[3].extend(conf)
+
+    if store is not None and len(records[0]) > 0:
+        store.append(records[0], records[1], records[2],
+                     confidence=records[3])
+
+    return data
+
+
+def _detect_frame(load, kwargs, frame) -> tuple:
+    return detect_markers(load(frame), **kwargs)
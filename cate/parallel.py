@@ -0,0 +1,515 @@
+import copy
+import multiprocessing
+import os
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from cate.param import Parameter, ParameterStore
+from cate.xray import (CompiledGeometries, marker_array, xray_data_residuals,
+                       xray_project_batch)
+
+
+class ResidualWorkers:
+    """Persistent processes that evaluate the residuals of slices of the
+    geometries of an `XrayOptimizationProblem`.
+
+    Every process receives its contiguous slice of geometries (with their
+    decorator chains), the matching rows of the data, and the columns of `x`
+    that belong to its parameters only once, at start-up. For an evaluation
+    `x` and the marker locations are copied into shared memory, and every
+    process writes its residuals into its rows of a shared output buffer.
+    Apart from a short message to start and finish, nothing is pickled.
+
+    Parameters that are not optimized are copied at start-up, and are not
+    kept in sync afterwards. Create new workers after changing them.
+    """
+
+    def __init__(self, layout, data, processes: int = None):
+        """
+        :param layout: The `_ParameterLayout` of the problem, which has the
+            geometries and the columns of the parameters in `x`.
+        :param data: `ProjectionData` of the geometries.
+        :param processes: Number of processes, defaults to the number of
+            CPUs, and is limited by the number of geometries.
+        """
+        self.layout = layout
+        self.data = data
+        if processes is None:
+            processes = os.cpu_count()
+        processes = max(1, min(processes, len(layout.geoms)))
+
+        # residual rows of the geometries, 2 for each annotation
+        rows = 2 * np.concatenate(
+            ([0], np.cumsum(np.count_nonzero(data.mask, axis=1))))
+
+        tasks = []
+        for chunk in np.array_split(np.arange(len(layout.geoms)), processes):
+            if len(chunk) == 0:
+                continue
+
+            geoms = [layout.geoms[i] for i in chunk]
+            params = [p for p in dict.fromkeys(
+                p for g_params in CompiledGeometries(geoms).parameters()
+                for p in g_params) if p in layout.offsets]
+            cols = np.concatenate(
+                [layout.offsets[p] + np.arange(len(p)) for p in params]
+                + [np.empty(0, dtype=int)])
+            tasks.append(_ResidualTask(geoms, params, cols, data.take(chunk),
+                                       rows[chunk[0]], rows[chunk[-1] + 1]))
+
+        self._processes = _Processes(
+            tasks, [(layout.nr_cols,), (data.nr_markers, 3), (rows[-1],)])
+
+    def __len__(self):
+        return len(self._processes)
+
+    def __call__(self, x: np.ndarray, locations: np.ndarray) -> np.ndarray:
+        """Residuals, as `xray_data_residuals` for all geometries.
+
+        :param x: Optimization vector, in the columns of `layout`.
+        :param locations: (N, 3) array of marker locations, in the column
+            order of `data`.
+        """
+        return self._processes(x, locations)
+
+    def close(self):
+        """Stops the processes and frees the shared memory."""
+        self._processes.close()
+
+
+class FiniteDifferenceJacobian:
+    """Sparse finite-difference Jacobian of an `XrayOptimizationProblem`.
+
+    A parameter of a geometry only changes the residuals of the geometries
+    that depend on it through their decorators, and a marker only changes
+    its own residuals. For every column of the Jacobian only those residuals
+    are re-evaluated, with the perturbed geometries resolved from the cached
+    states of the unperturbed ones. The columns are divided over a pool of
+    threads or persistent processes, which each keep a copy of the
+    geometries and write their columns into a shared buffer.
+
+    Steps are chosen as in `scipy.optimize.least_squares`, and flipped to
+    the other side, or made one-sided, where they would leave the bounds.
+
+    The workers are recreated when the layout or the data of the problem is
+    replaced, or when a parameter that is not optimized gets a new value
+    (see `Parameter.version`). In-place changes of the data, or of values,
+    are not noticed; call `close` after those.
+
+    Can be passed as `jac` to `scipy.optimize.least_squares`, preferably with
+    `tr_solver='lsmr'`. The result has the structure of `jac_sparsity()`.
+    """
+
+    def __init__(self, problem,
+                 method: str = '2-point',
+                 rel_step: float = None,
+                 bounds: tuple = None,
+                 executor: str = 'thread',
+                 workers: int = None):
+        """
+        :param problem: An `XrayOptimizationProblem` in 'jointly' mode.
+        :param method: '2-point' or '3-point'.
+        :param rel_step: Relative step size, defaults to the one that
+            `scipy.optimize.least_squares` uses for `method`.
+        :param bounds: (min, max) tuple, defaults to `problem.bounds()`.
+        :param executor: 'thread' or 'process'. Threads share the memory of
+            the data, but are limited by the GIL for small problems.
+        :param workers: Number of threads or processes, defaults to the
+            number of CPUs.
+        """
+        if method not in ('2-point', '3-point'):
+            raise ValueError("`method` must be '2-point' or '3-point'.")
+        if executor not in ('thread', 'process'):
+            raise ValueError("`executor` must be 'thread' or 'process'.")
+        if problem._mode != "jointly":
+            raise NotImplementedError(
+                "Finite differences are only available in 'jointly' mode.")
+
+        self.problem = problem
+        self.method = method
+        if rel_step is None:
+            rel_step = np.finfo(float).eps ** (
+                .5 if method == '2-point' else 1 / 3)
+        self.rel_step = rel_step
+        self.bounds = bounds
+        self.executor = executor
+        self.workers = os.cpu_count() if workers is None else workers
+
+        self._layout = None
+        self._data = None
+        self._tasks = None
+        self._processes = None
+
+    def _start(self):
+        """(Re)creates the structure and the workers for the current layout
+        and data of the problem."""
+        self.close()
+        layout, data = self.problem._layout(), self.problem.data
+        bounds = self.problem.bounds() if self.bounds is None else self.bounds
+        lower, upper = (np.broadcast_to(np.asarray(b, dtype=float),
+                                        (layout.nr_cols,)) for b in bounds)
+
+        # observation number of each annotation, in the order of residuals
+        obs_index = np.full(data.mask.shape, -1)
+        obs_index[data.mask] = np.arange(data.nr_observations)
+        marker_index = {id(layout.markers[m]): n
+                        for n, m in enumerate(data.ids)}
+        dependents = layout.dependents()
+
+        # geometries and annotations that each parameter influences
+        deps, indptr, indices = [], [0], []
+        for p in layout.optimizable:
+            geoms = dependents.get(p, np.empty(0, dtype=int))
+            marker = marker_index.get(id(p), -1)
+            sub_geoms = geoms
+            if marker >= 0:
+                sub_geoms = np.union1d(
+                    geoms, np.flatnonzero(data.mask[:, marker]))
+
+            sub_mask = data.mask[sub_geoms]
+            if marker >= 0:
+                # only the marker in geometries that do not depend on `p`
+                independent = ~np.isin(sub_geoms, geoms)
+                sub_mask[independent] = False
+                sub_mask[independent, marker] = True
+
+            obs = obs_index[sub_geoms][sub_mask]
+            rows = (2 * obs[:, np.newaxis] + np.arange(2)).ravel()
+            deps.append((sub_geoms, sub_mask, marker, len(geoms) > 0))
+            for _ in range(len(p)):
+                indices.append(rows)
+                indptr.append(indptr[-1] + len(rows))
+
+        self._shape = (2 * data.nr_observations, layout.nr_cols)
+        self._indptr = np.array(indptr)
+        self._indices = np.concatenate(indices + [np.empty(0, dtype=int)])
+
+        # contiguous groups of parameters, with about the same work in each
+        nr_params = len(layout.optimizable)
+        work = np.cumsum([0] + [len(p) * (1 + np.count_nonzero(d[1]))
+                                for p, d in zip(layout.optimizable, deps)])
+        nr_tasks = max(1, min(self.workers, nr_params))
+        splits = np.searchsorted(
+            work[1:], np.linspace(0, work[-1], nr_tasks + 1)[1:-1])
+        groups = np.split(np.arange(nr_params), splits)
+
+        tasks = [_ColumnTask(
+            layout.geoms, layout.optimizable,
+            [layout.markers[m] for m in data.ids], data, group,
+            [deps[i] for i in group], self._indptr, lower, upper,
+            self.method, self.rel_step) for group in groups]
+
+        if self.executor == 'thread':
+            # the tasks move the parameters into their own stores, so they
+            # need their own copies of the geometries and markers, while the
+            # read-only data and structure stay shared
+            shared = (data, self._indptr, lower, upper)
+            tasks = [copy.deepcopy(t, {id(a): a for a in shared})
+                     for t in tasks]
+            for t in tasks:
+                t.setup()
+            self._tasks = tasks
+        else:
+            self._processes = _Processes(
+                tasks, [(layout.nr_cols,), (len(self._indices),)])
+
+        self._layout, self._data = layout, data
+        self._fixed_versions = self._fixed_snapshot()
+
+    def _fixed_snapshot(self) -> list:
+        """Versions of the parameters that the workers have copied, i.e.
+        those that are not optimized. Delayed values are evaluated by the
+        workers themselves."""
+        return [p.version for p in self._layout.params
+                if isinstance(p, Parameter) and p not in self._layout.offsets
+                and not callable(p._value)]
+
+    def __call__(self, x: np.ndarray, *args, **kwargs):
+        import scipy.sparse
+
+        x = np.asarray(x, dtype=float)
+        if self._layout is not self.problem._layout() \
+                or self._data is not self.problem.data \
+                or self._fixed_versions != self._fixed_snapshot():
+            self._start()
+
+        with self.problem.profiler.phase('jacobian'):
+            if self._processes is not None:
+                values = self._processes(x)
+            else:
+                values = np.empty(len(self._indices))
+                if len(self._tasks) == 1:
+                    self._tasks[0](x, values)
+                else:
+                    with ThreadPoolExecutor(len(self._tasks)) as pool:
+                        for f in [pool.submit(t, x, values)
+                                  for t in self._tasks]:
+                            f.result()
+
+            return scipy.sparse.csc_matrix(
+                (values, self._indices, self._indptr),
+                shape=self._shape).tocsr()
+
+    def close(self):
+        """Stops the processes, if any."""
+        if self._processes is not None:
+            self._processes.close()
+
+        self._layout, self._tasks, self._processes = None, None, None
+
+
+class _ResidualTask:
+    """Residuals of a slice of geometries, see `ResidualWorkers`."""
+
+    def __init__(self, geoms, params, cols, data, start, stop):
+        self.geoms = geoms
+        self.params = params
+        self.cols = cols
+        self.data = data
+        self.start, self.stop = start, stop
+
+    def setup(self):
+        self._store = ParameterStore(self.params)
+        self._compiled = CompiledGeometries(self.geoms)
+
+    def __call__(self, x, locations, out):
+        self._store.update(x[self.cols])
+        sources, detectors, rotations = self._compiled.arrays()
+        out[self.start:self.stop] = xray_data_residuals(
+            sources, detectors, rotations, locations,
+            self.data.pixels, self.data.mask)
+
+
+class _ColumnTask:
+    """Finite differences for a group of parameters, see
+    `FiniteDifferenceJacobian`."""
+
+    def __init__(self, geoms, params, markers, data, group, deps, indptr,
+                 lower, upper, method, rel_step):
+        self.geoms = geoms
+        self.params = params
+        self.markers = markers
+        self.data = data
+        self.group = group
+        self.deps = deps
+        self.indptr = indptr
+        self.lower, self.upper = lower, upper
+        self.method = method
+        self.rel_step = rel_step
+
+    def setup(self):
+        # all parameters are stored, so that `x` is copied without indexing
+        self._store = ParameterStore(self.params)
+        self._compiled = CompiledGeometries(self.geoms)
+        self._sub_compiled = [
+            CompiledGeometries([self.geoms[i] for i in g]) if geom_dep
+            else None for g, _, _, geom_dep in self.deps]
+        offsets = np.cumsum([0] + [len(p) for p in self.params])
+        self._cols = [offsets[i] + np.arange(len(self.params[i]))
+                      for i in self.group]
+
+    def _residuals(self, k, arrays, locations) -> np.ndarray:
+        sub_geoms, sub_mask, marker, geom_dep = self.deps[k]
+        if not geom_dep:
+            # only the marker moves, in the unperturbed geometries
+            projs = xray_project_batch(
+                *(a[sub_geoms] for a in arrays),
+                self.params[self.group[k]].value[np.newaxis])
+            return (projs[:, 0]
+                    - self.data.pixels[sub_geoms, marker]).ravel()
+
+        if marker >= 0:
+            locations = locations.copy()
+            locations[marker] = self.params[self.group[k]].value
+
+        return xray_data_residuals(*self._sub_compiled[k].arrays(),
+                                   locations, self.data.pixels[sub_geoms],
+                                   sub_mask)
+
+    def __call__(self, x, out):
+        self._store.update(x)
+        arrays = self._compiled.arrays()
+        locations = marker_array(dict(enumerate(self.markers)))
+        x_work = x.copy()
+        for k, cols in enumerate(self._cols):
+            f0 = self._residuals(k, arrays, locations)
+            h, one_sided = _steps(x[cols], self.lower[cols],
+                                  self.upper[cols], self.method,
+                                  self.rel_step)
+            for j, h_j, one_sided_j in zip(cols, h, one_sided):
+                x_work[j] = x[j] + h_j
+                dx = x_work[j] - x[j]
+                self._store.update(x_work)
+                f1 = self._residuals(k, arrays, locations)
+                if self.method == '2-point':
+                    df = (f1 - f0) / dx
+                else:
+                    x_work[j] = x[j] + (2 * dx if one_sided_j else -dx)
+                    self._store.update(x_work)
+                    f2 = self._residuals(k, arrays, locations)
+                    if one_sided_j:
+                        df = (-3. * f0 + 4. * f1 - f2) / (2. * dx)
+                    else:
+                        df = (f1 - f2) / (2. * dx)
+
+                x_work[j] = x[j]
+                out[self.indptr[j]:self.indptr[j + 1]] = df
+
+            self._store.update(x)
+
+
+def _steps(x, lower, upper, method, rel_step) -> tuple:
+    """Finite-difference steps for `x`, as in `scipy.optimize.least_squares`,
+    adjusted to stay within the bounds.
+
+    :return: The steps, and for '3-point' which are one-sided (using `x + h`
+        and `x + 2h`) instead of central (using `x - h` and `x + h`).
+    """
+    sign = np.where(x >= 0, 1., -1.)
+    h = rel_step * sign * np.maximum(1., np.abs(x))
+    lower_dist, upper_dist = x - lower, upper - x
+    one_sided = np.zeros(len(x), dtype=bool)
+
+    if method == '2-point':
+        # flip the step if it fits on the other side, and shrink it otherwise
+        violated = (x + h < lower) | (x + h > upper)
+        fitting = np.abs(h) <= np.maximum(lower_dist, upper_dist)
+        h[violated & fitting] *= -1.
+        forward = (upper_dist >= lower_dist) & ~fitting
+        h[forward] = upper_dist[forward]
+        backward = (upper_dist < lower_dist) & ~fitting
+        h[backward] = -lower_dist[backward]
+        return h, one_sided
+
+    h = np.abs(h)
+    central = (lower_dist >= h) & (upper_dist >= h)
+    forward = (upper_dist >= lower_dist) & ~central
+    h[forward] = np.minimum(h[forward], .5 * upper_dist[forward])
+    backward = (upper_dist < lower_dist) & ~central
+    h[backward] = -np.minimum(h[backward], .5 * lower_dist[backward])
+    one_sided[forward | backward] = True
+
+    # in a narrow interval a central difference beats a tiny one-sided step
+    min_dist = np.minimum(lower_dist, upper_dist)
+    narrow = ~central & (np.abs(h) <= min_dist)
+    h[narrow] = min_dist[narrow]
+    one_sided[narrow] = False
+    return h, one_sided
+
+
+class _Processes:
+    """Persistent processes that each call a task on shared arrays.
+
+    The tasks are sent to the processes only once. All arrays but the last
+    are inputs, which are copied into shared memory on every call. The last
+    array is the output, in which every task writes its part.
+    """
+
+    def __init__(self, tasks, shapes):
+        self._shapes = shapes
+        self._shms = [
+            shared_memory.SharedMemory(create=True,
+                                       size=max(8 * int(np.prod(s)), 1))
+            for s in shapes]
+        self._conns, self._procs = [], []
+        ctx = multiprocessing.get_context()
+        try:
+            for task in tasks:
+                conn, child_conn = ctx.Pipe()
+                process = ctx.Process(
+                    target=_process_loop,
+                    args=(child_conn, [s.name for s in self._shms], shapes,
+                          task),
+                    daemon=True)
+                process.start()
+                child_conn.close()
+                self._conns.append(conn)
+                self._procs.append(process)
+        finally:
+            self._finalizer = weakref.finalize(
+                self, _shutdown, self._conns, self._procs, self._shms)
+
+    def __len__(self):
+        return len(self._procs)
+
+    def __call__(self, *inputs) -> np.ndarray:
+        if not self._finalizer.alive:
+            raise ValueError("The workers are closed.")
+
+        # no views are kept, so that the memory can be closed at any time
+        arrays = _shared_arrays(self._shms, self._shapes)
+        for a, value in zip(arrays, inputs):
+            a[...] = value
+
+        try:
+            for conn in self._conns:
+                conn.send(True)
+
+            errors = [conn.recv() for conn in self._conns]
+        except (EOFError, BrokenPipeError) as e:
+            del arrays
+            self.close()
+            raise RuntimeError("A worker process has stopped.") from e
+
+        errors = [e for e in errors if e is not None]
+        if len(errors) > 0:
+            raise RuntimeError("Evaluation failed in a worker process:\n"
+                               + errors[0])
+
+        return arrays[-1].copy()
+
+    def close(self):
+        """Stops the processes and frees the shared memory."""
+        self._finalizer()
+
+
+def _shutdown(conns, processes, shms):
+    for conn in conns:
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+    for process in processes:
+        process.join(timeout=5.)
+        if process.is_alive():
+            process.terminate()
+
+    for conn in conns:
+        conn.close()
+
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+
+def _shared_arrays(shms, shapes) -> list:
+    return [np.ndarray(shape, buffer=shm.buf) for shm, shape in
+            zip(shms, shapes)]
+
+
+def _process_loop(conn, shm_names, shapes, task):
+    shms = [shared_memory.SharedMemory(name=n) for n in shm_names]
+    arrays = _shared_arrays(shms, shapes)
+    try:
+        task.setup()
+        while conn.recv() is not None:
+            try:
+                task(*arrays)
+                conn.send(None)
+            except Exception:
+                conn.send(traceback.format_exc())
+    except EOFError:
+        pass
+    except Exception:
+        # a failed set-up is reported on the next call
+        conn.send(traceback.format_exc())
+
+    # the arrays must be released before the memory can be closed
+    del arrays
+    for shm in shms:
+        shm.close()
@@ -1,6 +1,5 @@
 import warnings
 from abc import ABC
-from typing import Any
 
 import numpy as np
 
@@ -18,9 +17,15 @@ class Parameter(ABC):
         self._value_original = value
         self.optimize = optimize
         self._bounds = bounds
+        self._version = 0
+        self._store = None  # see `ParameterStore`
+        self._store_index = None
 
     @property
     def value(self):
+        if self._store is not None:
+            return self._store.view(self._store_index)
+
         if callable(self._value):
             return self._value()
 
@@ -28,7 +33,29 @@ class Parameter(ABC):
 
     @value.setter
     def value(self, value):
-        self._value = value
+        if self._store is not None:
+            self._store.view(self._store_index)[:] = value
+        else:
+            self._value = value
+
+        self._version += 1
+
+    @property
+    def version(self) -> int:
+        """Counter that increases whenever a new value is set.
+
+        Used by geometries to find out if cached results are outdated. Note
+        that in-place changes of the value (e.g. `p.value[0] = 1.`) are not
+        tracked. Delayed (callable) values cannot be tracked, and always count
+        as changed.
+        """
+        if self._store is not None:
+            return self._version + self._store.versions[self._store_index]
+
+        if callable(self._value):
+            self._version += 1
+
+        return self._version
 
     @property
     def bounds(self):
@@ -41,11 +68,30 @@ class Parameter(ABC):
         return bounds
 
     def __len__(self):
+        if self._store is not None:
+            return len(self._store.view(self._store_index))
+
         if np.isscalar(self._value):
             return 1
 
         return len(self._value)
 
+    def _bind(self, store, index: int):
+        """Moves the value into `store`, or out of it if `store` is `None`."""
+        value = np.array(self.value, dtype=float)
+        # continue counting from the current version, so that cached results
+        # of geometries are never mistaken to be valid
+        self._version = self.version + 1
+        if store is None:
+            self._value = value.item() if value.ndim == 0 else value
+        else:
+            self._value = None
+            store.view(index)[:] = value
+            self._version -= store.versions[index]
+
+        self._store = store
+        self._store_index = index
+
 
 class ScalarParameter(Parameter):
     def __init__(self, value=None, **kwargs):
@@ -53,6 +99,9 @@ class ScalarParameter(Parameter):
 
     @property
     def value(self):
+        if self._store is not None:
+            return self._store.view(self._store_index).item()
+
         return super().value
 
     @value.setter
@@ -64,7 +113,7 @@ class ScalarParameter(Parameter):
             if not np.isscalar(value):
                 raise TypeError("`value` must be a scalar.")
 
-        self._value = value
+        Parameter.value.fset(self, value)
 
 
 class VectorParameter(Parameter):
@@ -88,6 +137,179 @@ class VectorParameter(Parameter):
         super(VectorParameter, self).__init__(value, **kwargs)
 
 
+class TrajectoryParameter(Parameter):
+    """Coefficients of a smooth trajectory `angle(frame)`, such as the yaw of
+    a rotation stage versus the frame number.
+
+    The trajectory is a linear combination of basis functions, either
+    a clamped B-spline of `degree` on uniform knots, or a polynomial of the
+    frame number. Per-frame values are taken with `sample` or `samples`,
+    which can be used as the angles of `cate.xray.transform`, so that the
+    number of unknowns is the number of coefficients, and not the number of
+    frames.
+    """
+
+    def __init__(self, value, frame_range: tuple, kind: str = 'bspline',
+                 degree: int = 3, **kwargs):
+        """
+        :param value: The coefficients, see `fit` for initial values.
+        :param frame_range: (first, last) frame of the trajectory, on which
+            the knots (or the scaling of the polynomial) are based.
+        :param kind: 'bspline' or 'polynomial'. A polynomial has
+            `len(value) - 1` as degree.
+        :param degree: Degree of the B-spline.
+        """
+        value = np.array(value, dtype=float)
+        if value.ndim != 1:
+            raise ValueError("`value` must be a 1D array of coefficients.")
+        if kind not in ('bspline', 'polynomial'):
+            raise ValueError("`kind` must be 'bspline' or 'polynomial'.")
+        if kind == 'bspline' and len(value) <= degree:
+            raise ValueError("A B-spline needs more than `degree` "
+                             "coefficients.")
+        if frame_range[1] <= frame_range[0]:
+            raise ValueError("`frame_range` must be increasing.")
+
+        self.frame_range = tuple(float(f) for f in frame_range)
+        self.kind = kind
+        self.degree = degree
+        super().__init__(value, **kwargs)
+
+    @classmethod
+    def fit(cls, frames, angles, nr_coefficients: int = 8,
+            kind: str = 'bspline', degree: int = 3, **kwargs):
+        """A trajectory that approximates `angles` at `frames` in the
+        least-squares sense."""
+        frames = np.asarray(frames, dtype=float)
+        if len(np.unique(frames)) < nr_coefficients:
+            raise ValueError("Fitting needs at least `nr_coefficients` "
+                             "different frames.")
+
+        param = cls(np.zeros(nr_coefficients),
+                    (frames.min(), frames.max()), kind, degree, **kwargs)
+        coefficients = np.linalg.lstsq(param.basis(frames), angles,
+                                       rcond=None)[0]
+        param.value = coefficients
+        param._value_original = coefficients
+        return param
+
+    def basis(self, frames) -> np.ndarray:
+        """(F, K) values of the `K` basis functions at `frames`, i.e. the
+        derivatives of the trajectory w.r.t. the coefficients."""
+        frames = np.atleast_1d(np.asarray(frames, dtype=float))
+        start, stop = self.frame_range
+        k = len(self)
+        if self.kind == 'polynomial':
+            t = 2. * (frames - start) / (stop - start) - 1.
+            return t[:, np.newaxis] ** np.arange(k)
+
+        from scipy.interpolate import BSpline
+
+        inner = np.linspace(start, stop, k - self.degree + 1)
+        knots = np.concatenate(([start] * self.degree, inner,
+                                [stop] * self.degree))
+        return BSpline(knots, np.identity(k), self.degree)(frames)
+
+    def __call__(self, frames) -> np.ndarray:
+        """Values of the trajectory at `frames`."""
+        return self.basis(frames) @ self.value
+
+    def sample(self, frame) -> 'TrajectorySample':
+        """The value at a single `frame`, see `samples`."""
+        return self.samples([frame])[0]
+
+    def samples(self, frames) -> list:
+        """A `TrajectorySample` for each frame in `frames`."""
+        return [TrajectorySample(self, w) for w in self.basis(frames)]
+
+
+class TrajectorySample:
+    """Value of a `TrajectoryParameter` at one frame.
+
+    Not a `Parameter` itself: geometries that use it depend on the
+    `parameter`, with derivative `weights`.
+    """
+
+    def __init__(self, parameter: TrajectoryParameter, weights: np.ndarray):
+        self.parameter = parameter
+        self.weights = weights
+
+    @property
+    def value(self) -> float:
+        return float(self.weights @ self.parameter.value)
+
+    @property
+    def version(self) -> int:
+        return self.parameter.version
+
+
+class ParameterStore:
+    """One contiguous float64 buffer that holds the values of parameters.
+
+    The parameters are bound to the store, after which the value of a
+    `VectorParameter` is a view into the buffer, and a `ScalarParameter`
+    reads its entry. Updating all parameters from an optimization vector `x`
+    is then a single copy, instead of setting every parameter separately.
+
+    A parameter can only be bound to one store at a time: binding it to a
+    new store moves its value there.
+    """
+
+    def __init__(self, params):
+        """
+        :param params: List of `Parameter`, in the order of `x`. Duplicates
+            and non-`Parameter` values are not allowed.
+        """
+        self.params = list(params)
+        for p in self.params:
+            if not isinstance(p, Parameter):
+                raise TypeError("Values in `params` must be `Parameter`.")
+            if p.value is None or (p._store is None and callable(p._value)):
+                raise ValueError("Parameters with `None` or delayed values "
+                                 "cannot be stored.")
+
+        if len(set(map(id, self.params))) != len(self.params):
+            raise ValueError("`params` must not contain duplicates.")
+
+        lengths = [len(p) for p in self.params]
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(int)
+        self.buffer = np.empty(self.offsets[-1])
+        # bumped for every parameter of which the values changed in `update`
+        self.versions = np.zeros(len(self.params), dtype=np.int64)
+
+        for i, p in enumerate(self.params):
+            p._bind(self, i)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def view(self, index: int) -> np.ndarray:
+        """The part of the buffer of the `index`-th parameter."""
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]]
+
+    def update(self, x: np.ndarray):
+        """Sets the values of all parameters from `x`."""
+        x = np.asarray(x, dtype=float)
+        if x.shape != self.buffer.shape:
+            raise ValueError(f"`x` must have shape {self.buffer.shape}.")
+
+        changed = self.buffer != x
+        if len(self.params) > 0 and np.any(changed):
+            changed = np.logical_or.reduceat(changed, self.offsets[:-1])
+            self.versions[changed] += 1
+            np.copyto(self.buffer, x)
+
+    def is_bound(self) -> bool:
+        """If all parameters are (still) bound to this store."""
+        return all(p._store is self for p in self.params)
+
+    def release(self):
+        """Unbinds all parameters, which keep their current values."""
+        for p in self.params:
+            if p._store is self:
+                p._bind(None, None)
+
+
 def params2ndarray(params, optimizable_only=True, key='value'):
     """Packs a list of `Parameter` into `numpy.ndarray`, and returns a
     list of types to restore to."""
@@ -100,7 +322,7 @@ def params2ndarray(params, optimizable_only=True, key='value'):
                           "The value is ignored.", UserWarning)
             continue
 
-        if optimizable_only and p.optimize is False:
+        if optimizable_only and not p.optimize:
             continue
 
         length += len(p)
@@ -114,7 +336,7 @@ def params2ndarray(params, optimizable_only=True, key='value'):
         if not issubclass(type(p), Parameter):
             continue
 
-        if optimizable_only and p.optimize is False:
+        if optimizable_only and not p.optimize:
             continue
 
         len_p = len(p)
@@ -146,7 +368,7 @@ def update_params(params, x: np.ndarray, optimizable_only=True):
         if not issubclass(type(p), Parameter):
             continue
 
-        if optimizable_only and p.optimize is False:
+        if optimizable_only and not p.optimize:
             continue
 
         len_p = len(p)
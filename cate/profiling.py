@@ -0,0 +1,191 @@
+import contextlib
+import json
+import time
+
+import numpy as np
+
+
+class Profiler:
+    """Instrumentation of an `XrayOptimizationProblem`.
+
+    Records the wall time and the number of calls of each phase of the
+    problem, the sizes of the problem, and the cost of every residual
+    evaluation. Phases are nested: 'residuals' and 'jacobian' are the calls
+    from the solver, and include the time of
+        'layout': (re)building the de-duplicated parameter layout,
+        'update': setting the parameters from `x`,
+        'markers': solving the markers in 'alternate' mode,
+        'geometry': resolving the geometry decorators,
+        'projection': projecting the markers, and their derivatives,
+        'workers': the residuals in worker processes, see
+            `cate.parallel.ResidualWorkers`.
+    Time that is spent outside of 'residuals' and 'jacobian' is attributed
+    to the solver.
+
+    When `trace` is given, every 'residuals' and 'jacobian' call is appended
+    as a JSON line to that file, with the elapsed time, the duration of the
+    call and its phases, and the cost.
+    """
+
+    def __init__(self, trace: str = None):
+        self.trace = trace
+        self.timers = {}
+        self.stats = {}
+        self.costs = []
+        self._stack = []
+        self._start = time.perf_counter()
+        self._file = None
+        if trace is not None:
+            self._file = open(trace, 'a')
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Times the block as phase `name`."""
+        # durations of the nested phases, for the trace
+        nested = {}
+        self._stack.append(nested)
+        t0 = time.perf_counter()
+        try:
+            yield nested
+        finally:
+            duration = time.perf_counter() - t0
+            self._stack.pop()
+            timer = self.timers.setdefault(name, [0., 0])
+            timer[0] += duration
+            timer[1] += 1
+            if len(self._stack) > 0:
+                parent = self._stack[-1]
+                parent[name] = parent.get(name, 0.) + duration
+            else:
+                self._emit(name, duration, nested)
+
+    def record(self, **stats):
+        """Sets problem statistics, e.g. the number of parameters."""
+        self.stats.update(stats)
+
+    def residuals(self, f: np.ndarray):
+        """Records the cost `0.5 * sum(f ** 2)` of a residual evaluation."""
+        cost = .5 * float(np.dot(f, f))
+        self.costs.append((time.perf_counter() - self._start, cost))
+        if len(self._stack) > 0:
+            self._stack[0]['cost'] = cost
+
+        self.stats['residuals'] = len(f)
+
+    def _emit(self, name, duration, nested):
+        if self._file is None:
+            return
+
+        line = {'event': name,
+                'elapsed': time.perf_counter() - self._start,
+                'duration': duration}
+        if 'cost' in nested:
+            line['cost'] = nested.pop('cost')
+
+        line['phases'] = nested
+        self._file.write(json.dumps(line) + '\n')
+        self._file.flush()
+
+    def report(self) -> 'ProfileReport':
+        """A snapshot of the recordings."""
+        return ProfileReport(
+            time.perf_counter() - self._start,
+            {name: tuple(t) for name, t in self.timers.items()},
+            dict(self.stats),
+            list(self.costs))
+
+    def close(self):
+        """Closes the trace file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _DisabledProfiler:
+    """No-op stand-in for a `Profiler`, so that the problem does not need to
+    check if profiling is enabled."""
+
+    trace = None
+    _null = contextlib.nullcontext()
+
+    def phase(self, name: str):
+        return self._null
+
+    def record(self, **stats):
+        pass
+
+    def residuals(self, f):
+        pass
+
+    def report(self):
+        raise ValueError("Profiling is not enabled on this problem.")
+
+    def close(self):
+        pass
+
+
+DISABLED = _DisabledProfiler()
+
+
+class ProfileReport:
+    """Timings and statistics of an optimization run, see `Profiler`.
+
+    :ivar wall_time: Seconds since the start of the profiler.
+    :ivar phases: `{phase: (seconds, calls)}`.
+    :ivar stats: Problem sizes, e.g. 'parameters', 'residuals',
+        'geometries', 'markers' and 'observations'.
+    :ivar costs: (elapsed seconds, cost) of every residual evaluation.
+    """
+
+    def __init__(self, wall_time: float, phases: dict, stats: dict,
+                 costs: list):
+        self.wall_time = wall_time
+        self.phases = phases
+        self.stats = stats
+        self.costs = costs
+
+    @property
+    def nfev(self) -> int:
+        return self.phases.get('residuals', (0., 0))[1]
+
+    @property
+    def njev(self) -> int:
+        return self.phases.get('jacobian', (0., 0))[1]
+
+    @property
+    def solver_time(self) -> float:
+        """Time outside of the residual and Jacobian evaluations."""
+        return self.wall_time - sum(
+            self.phases.get(name, (0., 0))[0]
+            for name in ('residuals', 'jacobian'))
+
+    def to_dict(self) -> dict:
+        """The report as JSON-serializable dict."""
+        return {'wall_time': self.wall_time,
+                'solver_time': self.solver_time,
+                'phases': {name: {'time': t, 'calls': n}
+                           for name, (t, n) in self.phases.items()},
+                'stats': self.stats,
+                'costs': self.costs}
+
+    def __str__(self):
+        lines = [f"wall time {self.wall_time:.3f}s, "
+                 f"{self.nfev} residual and {self.njev} Jacobian evaluations"]
+        if len(self.stats) > 0:
+            lines.append(', '.join(f"{k} {v}" for k, v in self.stats.items()))
+
+        lines.append(f"{'phase':<12} {'time [s]':>10} {'calls':>7} "
+                     f"{'per call [ms]':>14} {'share':>6}")
+        rows = list(self.phases.items()) + [
+            ('solver', (self.solver_time, 0))]
+        for name, (t, n) in rows:
+            per_call = f"{1e3 * t / n:>14.3f}" if n > 0 else ' ' * 14
+            share = t / self.wall_time if self.wall_time > 0 else 0.
+            lines.append(f"{name:<12} {t:>10.3f} {n:>7} {per_call} "
+                         f"{share:>6.1%}")
+
+        if len(self.costs) > 0:
+            lines.append(f"cost {self.costs[0][1]:.4e} -> "
+                         f"{min(c for _, c in self.costs):.4e}")
+
+        return '\n'.join(lines)
@@ -0,0 +1,208 @@
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+from scipy.optimize import OptimizeResult
+
+from cate.param import params2ndarray
+
+# rejected steps increase the damping up to this, see `bundle_adjustment`
+MAX_DAMPING = 1e16
+
+
+def bundle_adjustment(problem,
+                      x0: np.ndarray = None,
+                      bounds: tuple = None,
+                      loss: str = 'linear',
+                      max_nfev: int = None,
+                      ftol: float = 1e-8,
+                      xtol: float = 1e-8,
+                      gtol: float = 1e-8,
+                      damping: float = 1e-3,
+                      verbose: int = 0) -> OptimizeResult:
+    """Levenberg-Marquardt for joint marker/geometry optimization.
+
+    In 'jointly' mode every marker adds three unknowns that only couple to
+    the geometries that annotate it. In the normal equations
+        [U   W] [dg]   [-g_g]
+        [W.T V] [dm] = [-g_m]
+    the marker block `V` is therefore block-diagonal with 3x3 blocks, and
+    can be eliminated cheaply. Only the reduced geometry system
+        (U - W V^-1 W.T) dg = -g_g + W V^-1 g_m
+    is solved, after which `dm = V^-1 (-g_m - W.T dg)`. Steps are projected
+    onto the `Parameter` bounds.
+
+    :param problem: An `XrayOptimizationProblem` in 'jointly' mode.
+    :param x0: Initial guess, defaults to the current parameter values.
+    :param bounds: (min, max) tuple, defaults to `problem.bounds()`.
+    :param loss: 'linear' or 'huber', with the same definition as in
+        `scipy.optimize.least_squares`. The robust loss is applied by
+        reweighting the residuals in each iteration.
+    :param max_nfev: Maximum number of residual evaluations, defaults to
+        `100 * len(x0)`.
+    :param damping: Initial Levenberg-Marquardt damping factor.
+    :return: `scipy.optimize.OptimizeResult` with `least_squares` fields.
+        The `status` is -1 when no step was accepted before the damping
+        exceeded `MAX_DAMPING`, which is not a success.
+    """
+    if loss not in ('linear', 'huber'):
+        raise ValueError("`loss` must be 'linear' or 'huber'.")
+
+    if x0 is None:
+        x0 = params2ndarray(problem.params())
+
+    if bounds is None:
+        bounds = problem.bounds()
+
+    lower, upper = (np.broadcast_to(np.asarray(b, dtype=float), np.shape(x0))
+                    for b in bounds)
+    x = np.clip(np.asarray(x0, dtype=float), lower, upper)
+    if max_nfev is None:
+        max_nfev = 100 * len(x)
+
+    marker_cols = _marker_columns(problem)
+    geom_cols = np.setdiff1d(np.arange(len(x)), marker_cols)
+
+    def _cost(f):
+        z = f ** 2
+        if loss == 'huber':
+            z = np.where(z <= 1., z, 2. * np.sqrt(z) - 1.)
+
+        return .5 * np.sum(z)
+
+    f = problem(x)
+    cost = _cost(f)
+    nfev, njev = 1, 0
+    status = 0
+    message = "The maximum number of function evaluations is exceeded."
+    while nfev < max_nfev:
+        J = scipy.sparse.csr_matrix(problem.jacobian(x))
+        njev += 1
+
+        # robust loss: scale residuals and Jacobian rows by sqrt(rho'(f^2))
+        if loss == 'huber':
+            w = np.sqrt(np.minimum(1., 1. / np.maximum(np.abs(f), 1e-300)))
+            f_w, J_w = f * w, scipy.sparse.diags(w) @ J
+        else:
+            f_w, J_w = f, J
+
+        grad = J_w.T @ f_w
+        if np.linalg.norm(grad, ord=np.inf) < gtol:
+            status, message = 1, "`gtol` termination condition is satisfied."
+            break
+
+        blocks = _normal_blocks(J_w, f_w, marker_cols, geom_cols)
+        improved = False
+        while nfev < max_nfev:
+            step = _schur_step(blocks, damping, marker_cols, geom_cols)
+            x_new = np.clip(x + step, lower, upper)
+            # no improvement is possible at a stalled optimum
+            if np.linalg.norm(x_new - x) < xtol * (xtol + np.linalg.norm(x)):
+                status = 3
+                message = "`xtol` termination condition is satisfied."
+                break
+            if damping > MAX_DAMPING:
+                status = -1
+                message = "The damping exceeded its maximum."
+                break
+
+            f_new = problem(x_new)
+            nfev += 1
+            cost_new = _cost(f_new)
+            if cost_new < cost:
+                improved = True
+                break
+
+            damping *= 10.
+
+        if not improved:
+            break
+
+        dx = x_new - x
+        dcost = cost - cost_new
+        x, f, cost = x_new, f_new, cost_new
+        damping = max(damping / 10., 1e-12)
+
+        if verbose >= 2:
+            print(f"iteration {njev}: cost {cost:.6e}, "
+                  f"step {np.linalg.norm(dx):.3e}, damping {damping:.1e}")
+
+        if dcost < ftol * cost:
+            status, message = 2, "`ftol` termination condition is satisfied."
+            break
+
+        if np.linalg.norm(dx) < xtol * (xtol + np.linalg.norm(x)):
+            status, message = 3, "`xtol` termination condition is satisfied."
+            break
+
+    problem.update(x)
+    if verbose >= 1:
+        print(f"{message} Function evaluations {nfev}, "
+              f"final cost {cost:.4e}.")
+
+    return OptimizeResult(
+        x=x, cost=cost, fun=f, nfev=nfev, njev=njev, status=status,
+        message=message, success=status > 0)
+
+
+def _marker_columns(problem) -> np.ndarray:
+    """Columns of `x` that belong to optimizable markers, 3 per marker."""
+    if problem._mode != "jointly":
+        raise ValueError("The bundle adjustment needs 'jointly' mode.")
+
+    offsets = problem._offsets()
+    cols = [offsets[m] + np.arange(3) for m in problem.markers.values()
+            if m in offsets]
+    if len(cols) == 0:
+        return np.empty(0, dtype=int)
+
+    return np.concatenate(cols)
+
+
+def _normal_blocks(J, f, marker_cols, geom_cols) -> tuple:
+    """The blocks `U`, `W`, `V` and gradients of the normal equations.
+
+    `V` is returned as a stack of (3, 3) blocks, one for each marker.
+    """
+    J = scipy.sparse.csc_matrix(J)
+    J_m = J[:, marker_cols]
+    J_g = J[:, geom_cols]
+
+    U = (J_g.T @ J_g).toarray()
+    W = scipy.sparse.csr_matrix(J_g.T @ J_m)
+
+    # residuals belong to a single marker, hence `V` is block-diagonal
+    V_coo = scipy.sparse.coo_matrix(J_m.T @ J_m)
+    V = np.zeros((len(marker_cols) // 3, 3, 3))
+    np.add.at(V, (V_coo.row // 3, V_coo.row % 3, V_coo.col % 3), V_coo.data)
+
+    return U, W, V, J_g.T @ f, J_m.T @ f
+
+
+def _schur_step(blocks, damping, marker_cols, geom_cols) -> np.ndarray:
+    U, W, V, g_g, g_m = blocks
+
+    # Marquardt scaling of the damping, floored for unobserved parameters
+    U = U + damping * np.diag(np.maximum(np.diag(U), 1e-12))
+    diag_V = np.maximum(np.diagonal(V, axis1=1, axis2=2), 1e-12)
+    V = V + damping * diag_V[..., np.newaxis] * np.identity(3)
+
+    V_inv = np.linalg.inv(V) if len(V) > 0 else V
+    blk, i, j = np.indices(V_inv.shape).reshape(3, -1)
+    V_inv = scipy.sparse.csr_matrix(
+        (V_inv.ravel(), (3 * blk + i, 3 * blk + j)),
+        shape=(len(marker_cols), len(marker_cols)))
+
+    WV_inv = W @ V_inv
+    S = U - (WV_inv @ W.T).toarray()
+    rhs = -g_g + WV_inv @ g_m
+    try:
+        dg = scipy.linalg.cho_solve(scipy.linalg.cho_factor(S), rhs)
+    except np.linalg.LinAlgError:
+        dg = np.linalg.lstsq(S, rhs, rcond=None)[0]
+
+    dm = V_inv @ (-g_m - W.T @ dg)
+
+    step = np.empty(len(marker_cols) + len(geom_cols))
+    step[marker_cols] = dm
+    step[geom_cols] = dg
+    return step
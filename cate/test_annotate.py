@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pytest
+
+from cate.annotate import (ANNOTATION_DTYPE, AnnotationStore, EntityLocations,
+                           load_projection_data, migrate_annotations)
+
+
+class _Locations(EntityLocations):
+    @staticmethod
+    def get_iter():
+        return iter(['a', 'b'])
+
+    @staticmethod
+    def nr_entities():
+        return 2
+
+
+def test_annotation_store(tmp_path, monkeypatch):
+    fname = str(tmp_path / 'annotations.npy')
+    store = AnnotationStore(fname)
+    assert len(store) == 0
+
+    store.append([0, 0, 1], ['a', ('b', 1), 3], [[1., 2.], [3., 4.], [5., 6.]],
+                 confidence=[1., .5, .9])
+    size = (tmp_path / 'annotations.npy').stat().st_size
+
+    # appending does not rewrite the existing records
+    with monkeypatch.context() as m:
+        m.setattr('cate.annotate._save', None)
+        store.append(1, ['a'], [7., 8.])
+    assert (tmp_path / 'annotations.npy').stat().st_size \
+        == size + ANNOTATION_DTYPE.itemsize
+    assert isinstance(np.load(fname, mmap_mode='r'), np.memmap)
+
+    store = AnnotationStore(fname)
+    assert len(store) == 4
+    assert store.locations(0) == {'a': [1., 2.], ('b', 1): [3., 4.]}
+    assert store.locations(1) == {3: [5., 6.], 'a': [7., 8.]}
+    assert store.locations(2) == {}
+    np.testing.assert_equal(store.frames(), [0, 1])
+
+    # replace and remove
+    store.append([0, 0], ['a', ('b', 1)], [[9., 9.], [np.nan, np.nan]])
+    assert store.locations(0) == {'a': [9., 9.]}
+    assert len(store) == 6
+    store.compact()
+    assert len(store) == 3
+    assert AnnotationStore(fname).locations(0) == {'a': [9., 9.]}
+
+    # compact records, with ids of at most 32 bytes
+    assert ANNOTATION_DTYPE.itemsize <= 64
+    store.append(0, [('ball', 'stake', 'middle')], [1., 1.])
+    with pytest.raises(ValueError):
+        store.append(0, ['x' * 40], [1., 1.])
+
+
+def test_annotation_store_open(tmp_path):
+    fname = str(tmp_path / 'annotations.npy')
+    store = AnnotationStore.open(fname)
+    store.append([0], ['a'], [[1., 2.]])
+    assert store.locations(0) == {'a': [1., 2.]}
+    assert AnnotationStore.open(fname) is store
+
+    # changed by another handle, or process, since
+    AnnotationStore(fname).append([0], ['b'], [[3., 4.]])
+    assert AnnotationStore.open(fname) is store
+    assert store.locations(0) == {'a': [1., 2.], 'b': [3., 4.]}
+
+
+def test_entity_locations_migration(tmp_path):
+    fname = str(tmp_path / 'locations.npy')
+    legacy = {10: {'a': [1., 2.], 'b': (3., 4.)}, 20: {'b': [5., 6.]}}
+    np.save(fname, legacy)
+
+    loc = _Locations(fname, 10)
+    assert loc.locations() == {'a': [1., 2.], 'b': [3., 4.]}
+    assert loc['a'] == [1., 2.]
+    assert loc['c'] is False
+    # reading does not write anything
+    assert np.load(fname, allow_pickle=True).item() == legacy
+    assert not os.path.exists(fname + '.bak')
+
+    # all angles share one store, which is loaded once
+    other = _Locations(fname, 20)
+    assert other._store is loc._store
+    other['a'] = [7., 8.]
+    assert np.load(fname + '.bak', allow_pickle=True).item() == legacy
+    assert _Locations(fname, 20).locations() == {'a': [7., 8.], 'b': [5., 6.]}
+    with pytest.raises(KeyError):
+        _Locations(fname, 30).locations()
+
+    migrate_annotations(fname + '.bak', str(tmp_path / 'new.npy'))
+    assert AnnotationStore(str(tmp_path / 'new.npy')).locations(20) \
+        == {'b': [5., 6.]}
+
+
+def test_load_projection_data(tmp_path):
+    tiles = [str(tmp_path / 'tile_0.npy'), str(tmp_path / 'tile_1.npy')]
+    AnnotationStore(tiles[0]).append(
+        [0, 0, 5, 5, 9], ['a', 'b', 'a', 'c', 'a'],
+        [[1., 1.], [2., 2.], [3., 3.], [4., 4.], [5., 5.]])
+    np.save(tiles[1], {0: {'b': [6., 6.]}, 5: {'c': [7., 7.]}})
+
+    data = load_projection_data(tiles, [[5, 0, 7], [0, 5]])
+    assert data.ids == ['a', 'b', 'c']
+    np.testing.assert_equal(data.mask, [[1, 0, 1],
+                                        [1, 1, 0],
+                                        [0, 0, 0],
+                                        [0, 1, 0],
+                                        [0, 0, 1]])
+    np.testing.assert_equal(data.pixels[0, 2], [4., 4.])
+    np.testing.assert_equal(data.pixels[3, 1], [6., 6.])
+    assert np.load(tiles[1], allow_pickle=True).dtype.hasobject
+
+    # frames without annotations are an error on request
+    with pytest.raises(KeyError, match=r'\[7\]'):
+        load_projection_data(tiles, [[5, 0, 7], [0, 5]], allow_missing=False)
+    load_projection_data(tiles, [[5, 0], [0, 5]], allow_missing=False)
+
+    # the same as the annotations of each frame separately
+    expected = []
+    for fname, frames in zip(tiles, [[5, 0, 7], [0, 5]]):
+        expected += [AnnotationStore.open(fname).locations(f) for f in frames]
+    assert [{id: list(p) for id, p in d.items()} for d in data.to_dicts()] \
+        == expected
+
+    data = load_projection_data(tiles[0], [0, 5], ids=['c', 'a'])
+    assert data.ids == ['c', 'a']
+    np.testing.assert_equal(data.mask, [[0, 1], [1, 1]])
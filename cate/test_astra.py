@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from cate.astra import (Detector, coord2pixel_batch, geom2astravec,
+                        geoms2astravecs, pixel2coord, pixel2coord_batch,
+                        pixels2coords)
+from cate.data import ProjectionData
+from cate.util import InterpolatedGeometries, circular_geometry
+from cate.xray import Geometry, transform
+
+
+def test_geom2astravec():
+    detector = {'rows': 10, 'cols': 20,
+                'pixel_width': .5, 'pixel_height': .25}
+    initial = Geometry(source=np.array([-10., 1., 0.]),
+                       detector=np.array([10., 0., 2.]),
+                       roll=.1, pitch=.2, yaw=.3)
+    geom = transform(initial, yaw=.5)
+    vec = geom2astravec(geom, detector)
+
+    s, d = geom.source, geom.detector
+    u = Geometry.u(geom.roll, geom.pitch, geom.yaw)
+    v = Geometry.v(geom.roll, geom.pitch, geom.yaw)
+    np.testing.assert_almost_equal(vec, [
+        s[1], s[0], -s[2],
+        d[1], d[0], -d[2],
+        -u[1] * .5, -u[0] * .5, u[2] * .5,
+        -v[1] * .25, -v[0] * .25, v[2] * .25])
+
+
+def test_geoms2astravecs():
+    detector = Detector(rows=10, cols=20, pixel_width=.5, pixel_height=.25)
+    geoms, _ = circular_geometry(np.array([-10., 0., 0.]),
+                                 np.array([10., 0., 0.]),
+                                 nr_angles=50,
+                                 parametrization='constant_rotation')
+    expected = np.array([geom2astravec(g, detector.todict()) for g in geoms])
+    np.testing.assert_allclose(geoms2astravecs(geoms, detector), expected,
+                               atol=1e-12)
+
+    out = np.zeros((50, 12), dtype=np.float32)
+    vecs = geoms2astravecs(geoms, detector, out=out)
+    assert vecs is out
+    np.testing.assert_allclose(out, expected, rtol=1e-6, atol=1e-6)
+    assert geoms2astravecs(geoms, detector, np.float32).dtype == np.float32
+
+    # interpolated geometries are exported without creating the geometries
+    interpolated = InterpolatedGeometries(
+        geoms[0].decorated_geometry, np.arange(3),
+        [[0., 0., 1.], [0., 0., 2.], [.1, 0., 3.]])
+    np.testing.assert_allclose(
+        geoms2astravecs(interpolated, detector),
+        [geom2astravec(g, detector.todict()) for g in interpolated])
+
+    with pytest.raises(ValueError):
+        geoms2astravecs(geoms, detector, out=np.empty((49, 12)))
+
+
+def test_pixel2coord_batch():
+    det = Detector(rows=100, cols=60, pixel_width=.5, pixel_height=.25)
+    rng = np.random.default_rng(0)
+    pixels = rng.uniform(0., 60., (4, 5, 2))
+
+    # the single-pixel convention
+    coords = pixel2coord_batch(pixels, det)
+    np.testing.assert_allclose(coords[..., 0], (30. - pixels[..., 0]) * .25)
+    np.testing.assert_allclose(coords[..., 1], (50. - pixels[..., 1]) * .5)
+    pixel = list(pixels[1, 2])
+    np.testing.assert_allclose(pixel2coord(pixel, det), coords[1, 2])
+    np.testing.assert_allclose(coord2pixel_batch(coords, det), pixels)
+
+    # a binned region of interest of the same detector
+    offset, binning = np.array([10., 20.]), np.array([2., 4.])
+    roi_pixels = (pixels - offset) / binning
+    np.testing.assert_allclose(
+        pixel2coord_batch(roi_pixels, det, offset, binning), coords)
+    np.testing.assert_allclose(
+        coord2pixel_batch(coords, det, offset, binning), roi_pixels)
+
+    data = ProjectionData(pixels.copy(), np.ones((4, 5), dtype=bool),
+                          range(5))
+    data.pixels[0, 0] = np.nan
+    pixels2coords(data, det)
+    np.testing.assert_allclose(data.pixels[1:], coords[1:])
+    assert np.all(np.isnan(data.pixels[0, 0]))
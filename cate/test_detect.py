@@ -0,0 +1,79 @@
+import functools
+
+import numpy as np
+import pytest
+
+from cate.annotate import AnnotationStore
+from cate.detect import assign_ids, detect_frames, detect_markers
+
+
+def _image(markers, shape=(200, 300), sigma=2.5, noise=.01, seed=0):
+    """Dark Gaussian blobs at `[x, y]` pixels on a bright background."""
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    image = np.ones(shape)
+    for x, y in markers:
+        image -= .5 * np.exp(-((cols - x) ** 2 + (rows - y) ** 2)
+                             / (2 * sigma ** 2))
+
+    return image + np.random.default_rng(seed).normal(0., noise, shape)
+
+
+def _markers(frame):
+    rng = np.random.default_rng(frame)
+    return rng.uniform([10., 10.], [290., 190.], (6, 2))
+
+
+def _load(frame):
+    return _image(_markers(frame), seed=frame)
+
+
+def _match(found, expected):
+    distances = np.linalg.norm(found[:, np.newaxis] - expected, axis=-1)
+    return distances.min(axis=0)
+
+
+@pytest.mark.parametrize('tile_size', [1024, 64])
+def test_detect_markers(tile_size):
+    expected = np.array([[20.3, 30.7], [150.5, 100.25], [64.1, 63.9],
+                         [280.8, 180.4], [65.6, 140.]])
+    pixels, confidence = detect_markers(_image(expected), sigma=2.5,
+                                        tile_size=tile_size)
+    assert len(pixels) == len(expected)
+    assert np.all(_match(pixels, expected) < .05)
+    assert np.all(np.diff(confidence) <= 0.)
+
+    pixels, _ = detect_markers(2. - _image(expected), sigma=2.5,
+                               polarity='bright', max_markers=3)
+    assert len(pixels) == 3
+
+
+def test_assign_ids():
+    pixels = np.array([[10., 10.], [50., 50.], [90., 10.]])
+    reference = {'a': [49., 51.], 'b': [11., 9.], 'c': [200., 200.]}
+    assert assign_ids(pixels, reference, max_distance=5.) \
+        == {'a': [50., 50.], 'b': [10., 10.]}
+    assert assign_ids(pixels[:0], reference, 5.) == {}
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_detect_frames(tmp_path, processes):
+    frames = [0, 1, 2, 3]
+    references = [{f'm{i}': p + .5 for i, p in enumerate(_markers(f))}
+                  for f in frames]
+    store = AnnotationStore(str(tmp_path / 'detections.npy'))
+    data = detect_frames(functools.partial(_load), frames, references,
+                         max_distance=3., processes=processes, store=store,
+                         sigma=2.5)
+
+    assert len(data) == len(frames)
+    for frame, located in zip(frames, data):
+        expected = _markers(frame)
+        for i, p in enumerate(expected):
+            # overlapping blobs may not be separated
+            if f'm{i}' in located:
+                np.testing.assert_allclose(located[f'm{i}'], p, atol=.1)
+
+        assert len(located) >= 4
+        assert store.locations(frame).keys() == located.keys()
+
+    assert np.all(store.latest()['confidence'] > 5.)
@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+
+from cate.parallel import (FiniteDifferenceJacobian, ResidualWorkers,
+                           _steps)
+from cate.param import ScalarParameter, VectorParameter, params2ndarray
+from cate.util import circular_geometry
+from cate.xray import (XrayOptimizationProblem, transform,
+                       xray_multigeom_project)
+
+
+@pytest.fixture
+def problem_args():
+    rng = np.random.default_rng(0)
+    markers = {i: VectorParameter(rng.uniform(-1., 1., 3)) for i in range(6)}
+    geoms, _ = circular_geometry(np.array([-10., 0., 0.]),
+                                 np.array([10., 0., 0.]),
+                                 nr_angles=9,
+                                 parametrization='constant_rotation')
+    data = xray_multigeom_project(geoms, markers)
+    del data[2][1]
+    del data[7][4]
+    return markers, geoms, data
+
+
+def test_residual_workers(problem_args):
+    problem = XrayOptimizationProblem(*problem_args)
+    parallel = XrayOptimizationProblem(*problem_args, use_multiprocessing=3)
+    try:
+        x = params2ndarray(problem.params())
+        rng = np.random.default_rng(1)
+        for _ in range(3):
+            x_new = x + rng.normal(0., .01, len(x))
+            np.testing.assert_allclose(parallel(x_new), problem(x_new))
+
+        workers = parallel._workers
+        assert len(workers) == 3
+
+        # the workers are only restarted when the structure changes
+        parallel(x)
+        assert parallel._workers is workers
+
+        markers = problem_args[0]
+        markers[0].optimize = False
+        x = params2ndarray(problem.params())
+        np.testing.assert_allclose(parallel(x), problem(x))
+        assert parallel._workers is not workers
+        assert not workers._processes._finalizer.alive
+    finally:
+        parallel.close()
+
+
+def test_residual_workers_few_geometries(problem_args):
+    markers, geoms, data = problem_args
+    for nr_geoms in (0, 2):
+        problem = XrayOptimizationProblem(markers, geoms[:nr_geoms],
+                                          data[:nr_geoms])
+        layout = problem._layout()
+        workers = ResidualWorkers(layout, problem.data, processes=4)
+        try:
+            assert len(workers) == nr_geoms
+            x = params2ndarray(problem.params())
+            locations = np.array([markers[id].value
+                                  for id in problem.data.ids]).reshape(-1, 3)
+            np.testing.assert_allclose(workers(x, locations), problem(x))
+        finally:
+            workers.close()
+
+
+def test_residual_workers_error(problem_args):
+    markers, geoms, data = problem_args
+    geoms[3] = transform(geoms[2], yaw=ScalarParameter(lambda: 1 / 0,
+                                                       optimize=False))
+    problem = XrayOptimizationProblem(markers, geoms, data,
+                                      use_multiprocessing=2)
+    try:
+        with pytest.raises(RuntimeError):
+            problem(params2ndarray(problem.params()))
+    finally:
+        problem.close()
+
+
+@pytest.mark.parametrize('method', ['2-point', '3-point'])
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_finite_difference_jacobian(problem_args, method, executor):
+    markers, geoms, data = problem_args
+    # a parameter at its upper bound
+    markers[2]._bounds = [[-np.inf] * 3, markers[2].value.copy()]
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    jac = FiniteDifferenceJacobian(problem, method, executor=executor,
+                                   workers=3)
+    try:
+        x = params2ndarray(problem.params())
+        J = jac(x)
+        J_analytic = problem.jacobian(x)
+        assert J.shape == J_analytic.shape
+        np.testing.assert_allclose(J.toarray(), J_analytic.toarray(),
+                                   atol=1e-5)
+        pattern = J.copy()
+        pattern.data[:] = 1.
+        np.testing.assert_equal(pattern.toarray(),
+                                problem.jac_sparsity().toarray())
+
+        if executor == 'thread':
+            # the threads share the data, and own the geometries
+            assert all(t.data is problem.data for t in jac._tasks)
+            assert jac._tasks[0].geoms[0] is not jac._tasks[1].geoms[0]
+
+        # same result, and workers, for a different `x`
+        tasks, processes = jac._tasks, jac._processes
+        x = x + np.random.default_rng(2).normal(0., .01, len(x))
+        np.testing.assert_allclose(jac(x).toarray(),
+                                   problem.jacobian(x).toarray(), atol=1e-5)
+        assert jac._tasks is tasks and jac._processes is processes
+    finally:
+        jac.close()
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_finite_difference_jacobian_fixed(problem_args, executor):
+    markers, geoms, data = problem_args
+    speed = geoms[-1].own_parameters()['yaw']
+    speed.optimize = False
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    jac = FiniteDifferenceJacobian(problem, executor=executor, workers=2)
+    try:
+        x = params2ndarray(problem.params())
+        jac(x)
+
+        # a new value of a fixed parameter restarts the workers
+        speed.value = speed.value + .1
+        np.testing.assert_allclose(jac(x).toarray(),
+                                   problem.jacobian(x).toarray(), atol=1e-5)
+    finally:
+        jac.close()
+
+
+def test_finite_difference_steps():
+    x = np.array([0., 1., 2., 3.])
+    lower = np.array([-1., 0., 1.99, 3. - 1e-12])
+    upper = np.array([1., 1., 2.01, 3. + 1e-12])
+
+    h, one_sided = _steps(x, lower, upper, '2-point', 1e-4)
+    assert h[0] > 0.
+    assert h[1] < 0.  # flipped at the upper bound
+    assert np.all(x + h >= lower) and np.all(x + h <= upper)
+
+    h, one_sided = _steps(x, lower, upper, '3-point', 1e-2)
+    # a narrow interval gets a central difference over the whole interval
+    np.testing.assert_equal(one_sided, [False, True, False, False])
+    assert h[1] < 0.
+    steps = np.stack([x + h, np.where(one_sided, x + 2 * h, x - h)])
+    assert np.all(steps >= lower) and np.all(steps <= upper)
@@ -0,0 +1,114 @@
+import copy
+
+import numpy as np
+import pytest
+
+from cate.param import (ParameterStore, ScalarParameter, TrajectoryParameter,
+                        VectorParameter, params2ndarray, update_params)
+
+
+@pytest.fixture
+def params():
+    return [VectorParameter(np.array([1., 2., 3.])),
+            ScalarParameter(4.),
+            VectorParameter(np.array([5., 6., 7.]))]
+
+
+def test_update_params(params):
+    x = np.arange(7.)
+    update_params(params, x)
+    np.testing.assert_equal(params2ndarray(params), x)
+    assert isinstance(params[1].value, float)
+
+
+def test_parameter_store(params):
+    x = params2ndarray(params)
+    store = ParameterStore(params)
+    np.testing.assert_equal(store.buffer, x)
+    np.testing.assert_equal(params2ndarray(params), x)
+
+    # vectors are views into the buffer, scalars are still scalars
+    assert np.shares_memory(params[0].value, store.buffer)
+    assert isinstance(params[1].value, float)
+    assert len(params[2]) == 3
+
+    versions = [p.version for p in params]
+    x_new = x.copy()
+    x_new[3] = -1.
+    store.update(x_new)
+    assert params[1].value == -1.
+    assert [p.version for p in params] == [versions[0], versions[1] + 1,
+                                           versions[2]]
+
+    params[2].value = np.array([0., 0., 1.])
+    np.testing.assert_equal(store.buffer[4:], [0., 0., 1.])
+    assert params[2].version > versions[2]
+
+
+def test_parameter_store_rebind(params):
+    store = ParameterStore(params)
+    store.update(np.zeros(7))
+    version = params[0].version
+
+    other = ParameterStore(params[:1])
+    np.testing.assert_equal(other.buffer, [0., 0., 0.])
+    assert params[0].version > version
+
+    other.release()
+    assert params[0]._store is None
+    np.testing.assert_equal(params[0].value, [0., 0., 0.])
+    assert not np.shares_memory(params[0].value, other.buffer)
+
+
+def test_parameter_store_deepcopy(params):
+    store = ParameterStore(params)
+    params_copy, store_copy = copy.deepcopy((params, store))
+    store_copy.update(np.ones(7))
+
+    np.testing.assert_equal(params_copy[0].value, [1., 1., 1.])
+    np.testing.assert_equal(params[0].value, [1., 2., 3.])
+
+
+def test_parameter_store_errors(params):
+    with pytest.raises(ValueError):
+        ParameterStore([params[0], params[0]])
+
+    with pytest.raises(ValueError):
+        ParameterStore([ScalarParameter(None)])
+
+    store = ParameterStore(params)
+    with pytest.raises(ValueError):
+        store.update(np.zeros(6))
+
+
+@pytest.mark.parametrize('kind', ['bspline', 'polynomial'])
+def test_trajectory_parameter(kind):
+    frames = np.arange(100)
+    angles = .01 * frames + 1e-6 * frames ** 2
+    param = TrajectoryParameter.fit(frames, angles, 6, kind=kind)
+    assert len(param) == 6
+    np.testing.assert_allclose(param(frames), angles, atol=1e-12)
+
+    samples = param.samples(frames)
+    np.testing.assert_allclose([s.value for s in samples], angles,
+                               atol=1e-12)
+    np.testing.assert_allclose(param.sample(50).weights,
+                               param.basis(50)[0])
+
+    # the samples follow the coefficients, also from a store
+    version = samples[0].version
+    store = ParameterStore([param])
+    store.update(np.ones(6) if kind == 'bspline' else [1.] + [0.] * 5)
+    assert samples[0].version > version
+    np.testing.assert_allclose([s.value for s in samples], 1.)
+
+
+def test_trajectory_parameter_errors():
+    with pytest.raises(ValueError):
+        TrajectoryParameter(np.zeros(3), (0, 10), degree=3)
+    with pytest.raises(ValueError):
+        TrajectoryParameter(np.zeros(4), (0, 10), kind='fourier')
+    with pytest.raises(ValueError):
+        TrajectoryParameter(np.zeros(4), (10, 10))
+    with pytest.raises(ValueError):
+        TrajectoryParameter.fit([0, 1200, 2400], np.zeros(3), 8)
@@ -0,0 +1,75 @@
+import json
+
+import numpy as np
+import pytest
+import scipy.optimize
+
+from cate import profiling
+from cate.param import VectorParameter, params2ndarray
+from cate.util import circular_geometry
+from cate.xray import XrayOptimizationProblem, xray_multigeom_project
+
+
+@pytest.fixture
+def problem_args():
+    rng = np.random.default_rng(0)
+    markers = {i: VectorParameter(rng.uniform(-1., 1., 3)) for i in range(5)}
+    geoms, _ = circular_geometry(np.array([-10., 0., 0.]),
+                                 np.array([10., 0., 0.]),
+                                 nr_angles=8,
+                                 parametrization='constant_rotation')
+    data = xray_multigeom_project(geoms, markers)
+    for m in markers.values():
+        m.value = m.value + rng.normal(0., .01, 3)
+    return markers, geoms, data
+
+
+def test_profile_disabled(problem_args):
+    problem = XrayOptimizationProblem(*problem_args)
+    assert problem.profiler is profiling.DISABLED
+    problem(params2ndarray(problem.params()))
+    with pytest.raises(ValueError):
+        problem.report()
+
+
+def test_profile_report(problem_args, tmp_path):
+    trace = tmp_path / 'trace.jsonl'
+    problem = XrayOptimizationProblem(*problem_args, profile=str(trace))
+    r = scipy.optimize.least_squares(
+        problem, params2ndarray(problem.params()), jac=problem.jacobian,
+        tr_solver='lsmr', max_nfev=5)
+    problem.close()
+
+    report = problem.report()
+    assert report.nfev == r.nfev
+    assert report.njev == r.njev
+    assert report.stats['parameters'] == len(r.x)
+    assert report.stats['residuals'] == len(r.fun)
+    assert report.stats['geometries'] == 8
+    assert report.stats['markers'] == 5
+    assert report.stats['observations'] == 40
+    assert report.phases['layout'][1] == 1
+    assert report.phases['update'][1] == r.nfev + r.njev
+    for name in ('geometry', 'projection'):
+        assert report.phases[name][1] >= r.nfev + r.njev
+
+    # nested phases are included in the calls from the solver
+    evaluations = (report.phases['residuals'][0]
+                   + report.phases['jacobian'][0])
+    assert report.phases['projection'][0] <= evaluations
+    assert 0. <= report.solver_time <= report.wall_time
+
+    costs = [c for _, c in report.costs]
+    assert len(costs) == r.nfev
+    assert costs[-1] == pytest.approx(r.cost)
+    assert costs[-1] < costs[0]
+    assert 'projection' in str(report)
+    json.dumps(report.to_dict())
+
+    lines = [json.loads(line) for line in trace.read_text().splitlines()]
+    assert [line['event'] for line in lines].count('residuals') == r.nfev
+    assert [line['event'] for line in lines].count('jacobian') == r.njev
+    residuals = [line for line in lines if line['event'] == 'residuals']
+    assert [line['cost'] for line in residuals] == costs
+    assert 'update' in residuals[0]['phases']
+    assert sum(residuals[0]['phases'].values()) <= residuals[0]['duration']
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from cate.param import ScalarParameter, VectorParameter, params2ndarray
+from cate.solve import bundle_adjustment
+from cate.xray import (Geometry, XrayOptimizationProblem, transform,
+                       xray_multigeom_project)
+
+
+@pytest.fixture
+def problem_true():
+    rng = np.random.default_rng(0)
+    markers = {i: VectorParameter(rng.uniform(-1., 1., 3)) for i in range(20)}
+    initial = Geometry(
+        source=VectorParameter(np.array([-10., 0., 0.]), optimize=False),
+        detector=VectorParameter(np.array([10., 0., 0.]), optimize=False),
+        roll=None,
+        pitch=None,
+        yaw=None)
+    geoms = [transform(initial, yaw=ScalarParameter(a, optimize=a != 0.))
+             for a in np.linspace(0., 2 * np.pi, 12, endpoint=False)]
+    data = xray_multigeom_project(geoms, markers)
+    del data[3][4]
+    return markers, geoms, data
+
+
+@pytest.mark.parametrize('loss', ['linear', 'huber'])
+def test_bundle_adjustment(problem_true, loss):
+    markers, geoms, data = problem_true
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    x_true = params2ndarray(problem.params())
+
+    rng = np.random.default_rng(1)
+    x0 = x_true + rng.normal(0., .01, len(x_true))
+    r = bundle_adjustment(problem, x0, loss=loss)
+
+    assert r.success
+    assert r.cost < 1e-12
+    np.testing.assert_allclose(problem(r.x), 0., atol=1e-6)
+
+
+def test_bundle_adjustment_stalled(problem_true):
+    markers, geoms, data = problem_true
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    x_true = params2ndarray(problem.params())
+
+    # at the optimum no step is accepted, which must not use all evaluations
+    r = bundle_adjustment(problem, x_true, ftol=0., gtol=0.)
+    assert r.status == 3
+    assert r.nfev < 50
+    assert np.all(np.isfinite(r.x))
+
+    # without `xtol`, the damping limit stops it, which is no success
+    r = bundle_adjustment(problem, x_true, ftol=0., xtol=0., gtol=0.)
+    assert r.status == -1 and not r.success
+    assert r.nfev < 50
+    assert np.all(np.isfinite(r.x))
+
+
+def test_bundle_adjustment_bounds(problem_true):
+    markers, geoms, data = problem_true
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    x_true = params2ndarray(problem.params())
+    lower, upper = problem.bounds()
+    lower[-1] = x_true[-1] + .01  # excludes the true value
+
+    x0 = x_true + .02
+    r = bundle_adjustment(problem, x0, bounds=(lower, upper))
+    assert np.all(r.x >= lower)
+    assert r.cost < .5 * np.sum(problem(x0) ** 2)
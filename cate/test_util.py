@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from cate.param import ScalarParameter, VectorParameter
+from cate.util import InterpolatedGeometries, geoms_from_interpolation
+from cate.xray import Geometry, geometry_arrays, transform
+
+
+@pytest.fixture
+def calibration_geoms():
+    initial = Geometry(
+        source=VectorParameter(np.array([-10., 0.1, 0.2])),
+        detector=VectorParameter(np.array([10., -0.3, 0.1])),
+        roll=ScalarParameter(None),
+        pitch=ScalarParameter(None),
+        yaw=ScalarParameter(None))
+    tilted = transform(initial, roll=.01, pitch=-.02)
+
+    # a rotation stage that turns slightly irregular
+    nrs = np.arange(0, 3600, 400)
+    yaws = 2 * np.pi * nrs / 3600 + .01 * np.sin(2 * np.pi * nrs / 3600)
+    geoms = [transform(tilted, roll=1e-3 * np.cos(y), pitch=0., yaw=y)
+             for y in yaws]
+    return geoms, nrs
+
+
+def test_interpolated_geometries(calibration_geoms):
+    geoms, _ = calibration_geoms
+    rng = np.random.default_rng(0)
+    angles = rng.uniform(-np.pi, np.pi, (20, 3))
+    interpolated = InterpolatedGeometries(geoms[0].decorated_geometry,
+                                          np.arange(20), angles)
+    assert len(interpolated) == 20
+
+    expected = geometry_arrays(list(interpolated))
+    for a, b in zip(interpolated.arrays(), expected):
+        np.testing.assert_allclose(a, b, atol=1e-12)
+    for a, b in zip(geometry_arrays(interpolated), expected):
+        np.testing.assert_allclose(a, b, atol=1e-12)
+
+    g = interpolated[3]
+    assert isinstance(g, transform)
+    np.testing.assert_equal(
+        [g.transformation_roll, g.transformation_pitch, g.transformation_yaw],
+        angles[3])
+    assert len(interpolated[2:8:2]) == 3
+
+
+@pytest.mark.parametrize('kind', ['linear', 'cubic', 'periodic'])
+def test_geoms_from_interpolation(calibration_geoms, kind):
+    geoms, nrs = calibration_geoms
+    nrs_new = np.arange(0, 3201, 10)
+    interpolated = geoms_from_interpolation(
+        geoms, nrs_new, nrs, kind=kind, period=3600, lazy=True)
+    assert interpolated.parent is geoms[0].decorated_geometry
+
+    # the calibration geometries are reproduced exactly
+    for a, b in zip(geometry_arrays(interpolated[::40]),
+                    geometry_arrays(geoms)):
+        np.testing.assert_allclose(a, b, atol=1e-12)
+
+    yaws = 2 * np.pi * nrs_new / 3600 \
+        + .01 * np.sin(2 * np.pi * nrs_new / 3600)
+    error = np.abs(interpolated.angles[:, 2] - yaws).max()
+    assert error < {'linear': 1e-3, 'cubic': 1e-4, 'periodic': 1e-5}[kind]
+
+
+def test_geoms_from_interpolation_periodic(calibration_geoms):
+    geoms, nrs = calibration_geoms
+    with pytest.raises(ValueError):
+        geoms_from_interpolation(geoms, [0, 10], nrs, kind='periodic')
+
+    # across the end of the period, the rotation continues
+    interpolated = geoms_from_interpolation(
+        geoms, [3590, 3600, 3610], nrs, kind='periodic', period=3600,
+        lazy=True)
+    np.testing.assert_allclose(interpolated.angles[1], [1e-3, 0., 2 * np.pi],
+                               atol=1e-12)
+
+    # calibration frames of two periods, with wrapped angles
+    parent = geoms[0].decorated_geometry
+    nrs = np.arange(0, 7200, 300)
+    yaws = 2 * np.pi * nrs / 3600 + .01 * np.sin(2 * np.pi * nrs / 3600)
+    wrapped = [transform(parent, yaw=np.angle(np.exp(1j * y))) for y in yaws]
+    nrs_new = np.arange(0, 7200, 50)
+    interpolated = geoms_from_interpolation(
+        wrapped, nrs_new, nrs, kind='periodic', period=3600, lazy=True)
+    expected = 2 * np.pi * nrs_new / 3600 \
+        + .01 * np.sin(2 * np.pi * nrs_new / 3600)
+    assert np.abs(interpolated.angles[:, 2] - expected).max() < 1e-5
+
+
+def test_geoms_from_interpolation_linear(calibration_geoms):
+    geoms, nrs = calibration_geoms
+    interpolated = geoms_from_interpolation(geoms, [200, 1000], nrs)
+    assert isinstance(interpolated, list)
+    assert all(isinstance(g, transform) for g in interpolated)
+
+    # the angles are interpolated as they are, without unwrapping
+    parent = geoms[0].decorated_geometry
+    wrapping = [transform(parent, yaw=y) for y in (3., -3.)]
+    interpolated = geoms_from_interpolation(wrapping, [5], [0, 10])
+    assert interpolated[0].transformation_yaw == pytest.approx(0.)
@@ -0,0 +1,507 @@
+import numpy as np
+import pytest
+import scipy.optimize
+import transforms3d
+
+from cate.data import ProjectionData
+from cate.param import ScalarParameter, VectorParameter, params2ndarray
+from cate.util import circular_geometry
+from cate.xray import (BaseDecorator, CompiledGeometries, Geometry,
+                       XrayOptimizationProblem, _solve_blocks, angles2mats,
+                       geometry_arrays, marker_array,
+                       markers_from_leastsquares_intersection, mats2angles,
+                       shift, transform, xray_multigeom_project,
+                       xray_project, xray_project_batch)
+
+
+@pytest.fixture
+def markers():
+    rng = np.random.default_rng(0)
+    return {f'marker_{i}': VectorParameter(rng.uniform(-1., 1., 3))
+            for i in range(7)}
+
+
+@pytest.fixture
+def geoms():
+    initial = Geometry(
+        source=VectorParameter(np.array([-10., 0.1, 0.2])),
+        detector=VectorParameter(np.array([10., -0.3, 0.1])),
+        roll=ScalarParameter(None),
+        pitch=ScalarParameter(None),
+        yaw=ScalarParameter(None))
+    tilted = transform(initial,
+                       roll=ScalarParameter(0.01),
+                       pitch=ScalarParameter(-0.02))
+    geoms = []
+    for i in range(5):
+        g = transform(tilted, yaw=ScalarParameter(i * np.pi / 5))
+        geoms.append(shift(g, VectorParameter(np.array([0., 0., .1 * i]))))
+
+    return geoms
+
+
+@pytest.mark.parametrize(
+    "src, det, point, expected_projection, roll, pitch, yaw",
+    [
+        ([-1, 0, 0], [1, 0, 0], [0, 1, 1], [2, 2], 0, 0, 0),
+        ([-4, 0, 0], [2, 0, 0], [.5, 1.5, 1.5], [2, 2], 0, 0, 0),
+        ([-1, 0, 0], [1, 0, 0], [.5, 1.5, 1.5], [0, 2 * np.sqrt(2)],
+         np.pi / 4, 0, 0),
+    ]
+)
+def test_xray_project(src, det, point, expected_projection, roll, pitch, yaw):
+    geom = Geometry(
+        source=np.array(src, dtype=float),
+        detector=np.array(det, dtype=float),
+        roll=roll,
+        pitch=pitch,
+        yaw=yaw)
+    projection = xray_project(geom, np.array(point, dtype=float))
+    np.testing.assert_almost_equal(projection, np.array(expected_projection))
+
+
+def test_xray_project_batch(geoms, markers):
+    projs = xray_project_batch(*geometry_arrays(geoms),
+                               marker_array(markers))
+    assert projs.shape == (len(geoms), len(markers), 2)
+
+    for g, g_projs in zip(geoms, projs):
+        for m, proj in zip(markers.values(), g_projs):
+            np.testing.assert_almost_equal(proj, xray_project(g, m.value))
+
+
+def test_xray_multigeom_project(geoms, markers):
+    data = xray_multigeom_project(geoms, markers)
+    assert len(data) == len(geoms)
+    for g, projs in zip(geoms, data):
+        assert list(projs.keys()) == list(markers.keys())
+        np.testing.assert_almost_equal(
+            projs['marker_3'], xray_project(g, markers['marker_3'].value))
+
+
+def test_projection_data_from_dicts():
+    data = [{'a': [1., 2.], 'b': [3., 4.]},
+            [{'b': [5., 6.]}, {}]]  # nested, as in a tiled scan
+
+    pd = ProjectionData.from_dicts(data)
+    assert len(pd) == 3
+    assert pd.ids == ['a', 'b']
+    np.testing.assert_equal(pd.mask, [[True, True], [False, True],
+                                      [False, False]])
+    np.testing.assert_equal(pd.values(), [[1., 2.], [3., 4.], [5., 6.]])
+
+    dicts = pd.to_dicts()
+    assert list(dicts[1].keys()) == ['b']
+    np.testing.assert_equal(dicts[1]['b'], [5., 6.])
+    assert dicts[2] == {}
+
+
+def test_problem_partial_data(geoms, markers):
+    data = xray_multigeom_project(geoms, markers)
+    del data[1]['marker_2']
+    del data[3]['marker_5']
+    data[0]['marker_0'] = data[0]['marker_0'] + [0.1, -0.2]
+
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    residuals = problem(params2ndarray(problem.params()))
+    assert len(residuals) == 2 * (len(geoms) * len(markers) - 2)
+    np.testing.assert_almost_equal(residuals[:2], [-0.1, 0.2])
+    np.testing.assert_almost_equal(residuals[2:], 0.)
+
+
+def test_angles2mat_derivatives():
+    angles = np.array([.3, -.2, 1.1])
+    dR = Geometry.angles2mat_derivatives(*angles)
+    h = 1e-6
+    for i in range(3):
+        e = np.zeros(3)
+        e[i] = h
+        fd = (Geometry.angles2mat(*(angles + e))
+              - Geometry.angles2mat(*(angles - e))) / (2 * h)
+        np.testing.assert_almost_equal(dR[..., i], fd)
+
+
+def test_jacobian(geoms, markers):
+    data = xray_multigeom_project(geoms, markers)
+    del data[2]['marker_4']
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    x = params2ndarray(problem.params())
+    x += np.random.default_rng(1).normal(0., .01, len(x))
+
+    J = problem.jacobian(x).toarray()
+    J_fd = scipy.optimize.approx_fprime(x, problem, 1e-7)
+    assert J.shape == J_fd.shape
+    np.testing.assert_allclose(J, J_fd, atol=1e-5)
+
+
+def test_jacobian_shared_parameter(markers):
+    # chained geometries that share a rotation parameter
+    initial = Geometry(
+        source=VectorParameter(np.array([-10., 0., 0.])),
+        detector=VectorParameter(np.array([10., 0., 0.])),
+        roll=ScalarParameter(None),
+        pitch=ScalarParameter(None),
+        yaw=ScalarParameter(None))
+    speed = ScalarParameter(.3)
+    geoms = [initial]
+    for i in range(4):
+        geoms.append(transform(geoms[-1], yaw=speed, pitch=.01))
+
+    data = xray_multigeom_project(geoms, markers)
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    x = params2ndarray(problem.params())
+    J = problem.jacobian(x).toarray()
+    J_fd = scipy.optimize.approx_fprime(x, problem, 1e-7)
+    np.testing.assert_allclose(J, J_fd, atol=1e-5)
+
+
+def test_jacobian_trajectory(markers):
+    geoms, params = circular_geometry(np.array([-10., 0., 0.]),
+                                      np.array([10., 0., 0.]),
+                                      nr_angles=40,
+                                      parametrization='trajectory',
+                                      nr_coefficients=6)
+    trajectory = params['trajectory']
+    np.testing.assert_allclose(
+        [g.transformation_yaw for g in geoms[1:]],
+        2 * np.pi / 40 * np.arange(1, 40), atol=1e-12)
+
+    data = xray_multigeom_project(geoms, markers)
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    assert trajectory in problem.params()
+    x = params2ndarray(problem.params())
+    # markers, source, detector, roll, pitch, yaw and the coefficients
+    assert len(x) == 3 * len(markers) + 3 + 3 + 3 + 6
+    x += np.random.default_rng(1).normal(0., .01, len(x))
+
+    J = problem.jacobian(x).toarray()
+    J_fd = scipy.optimize.approx_fprime(x, problem, 1e-7)
+    np.testing.assert_allclose(J, J_fd, atol=1e-5)
+
+
+@pytest.mark.parametrize('optimize_markers', [True, False])
+def test_jac_sparsity(geoms, markers, optimize_markers):
+    for m in markers.values():
+        m.optimize = optimize_markers
+
+    data = xray_multigeom_project(geoms, markers)
+    del data[0]['marker_1']
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    x = params2ndarray(problem.params())
+    J = problem.jacobian(x).toarray()
+    pattern = problem.jac_sparsity().toarray()
+
+    assert pattern.shape == J.shape
+    # the structure must cover all nonzeros, but should not be dense
+    assert np.all(pattern[J != 0.] == 1)
+    assert np.count_nonzero(pattern) < pattern.size
+
+    r = scipy.optimize.least_squares(problem, x, jac_sparsity=pattern,
+                                     max_nfev=1)
+    np.testing.assert_allclose(r.jac.toarray(), J, atol=1e-5)
+
+
+def test_markers_from_leastsquares_intersection(geoms, markers):
+    data = xray_multigeom_project(geoms, markers)
+    del data[1]['marker_2']
+    del data[4]['marker_0']
+
+    result = markers_from_leastsquares_intersection(geoms, data)
+    assert list(result.keys()) == list(markers.keys())
+    for id, marker in markers.items():
+        assert result[id].optimize is False
+        np.testing.assert_almost_equal(result[id].value, marker.value)
+
+
+def test_leastsquares_chunks(geoms, markers, monkeypatch):
+    import cate.xray
+
+    data = ProjectionData.from_dicts(xray_multigeom_project(geoms, markers))
+    data.mask[2, 1] = False
+    states = geometry_arrays(geoms)
+    expected = [cate.xray.leastsquares_intersection(
+        *states, data.pixels, data.mask)]
+    expected.append(cate.xray.leastsquares_reprojection(
+        *states, data.pixels, data.mask, expected[0]))
+
+    # a single geometry in each chunk
+    monkeypatch.setattr(cate.xray, '_CHUNK_SIZE', 1)
+    result = cate.xray.leastsquares_intersection(
+        *states, data.pixels, data.mask)
+    np.testing.assert_allclose(result, expected[0], atol=1e-12)
+    np.testing.assert_allclose(cate.xray.leastsquares_reprojection(
+        *states, data.pixels, data.mask, result), expected[1], atol=1e-12)
+
+
+def test_markers_from_leastsquares_intersection_insufficient(geoms, markers):
+    data = xray_multigeom_project(geoms[:2], markers)
+    with pytest.raises(Exception):
+        markers_from_leastsquares_intersection(geoms[:2], data)
+
+
+def test_solve_blocks():
+    rng = np.random.default_rng(0)
+    A = rng.normal(size=(5, 3, 3))
+    A[1] = 0.  # e.g. a marker without annotations
+    A[2] = np.outer([1., 2., 3.], [1., 2., 3.])
+    A[3, 2] = A[3, 0] + 1e-15 * A[3, 1]  # nearly singular
+    q = rng.normal(size=(5, 3))
+
+    x = _solve_blocks(A, q)
+    expected = np.einsum('nij,nj->ni', np.linalg.pinv(A), q)
+    np.testing.assert_allclose(x, expected, atol=1e-12)
+
+
+def test_compiled_geometries_long_chain():
+    # longer than the recursion limit of a recursive evaluation
+    nr_angles = 2000
+    geoms, params = circular_geometry(np.array([-10., 0., 0.]),
+                                      np.array([10., 0., 0.]),
+                                      nr_angles,
+                                      parametrization='constant_rotation')
+    sources, detectors, rotations = CompiledGeometries(geoms).arrays()
+
+    angles = np.arange(nr_angles) * 2 * np.pi / nr_angles
+    np.testing.assert_almost_equal(
+        sources, np.stack([-10 * np.cos(angles), 10 * np.sin(angles),
+                           np.zeros(nr_angles)], axis=1))
+    np.testing.assert_almost_equal(sources[-1], geoms[-1].source)
+    np.testing.assert_almost_equal(rotations[-1], Geometry.angles2mat(
+        geoms[-1].roll, geoms[-1].pitch, geoms[-1].yaw))
+
+    assert geoms[-1].parameters() == list(params.values())
+
+
+def test_geometry_property_cache(monkeypatch):
+    geoms, params = circular_geometry(np.array([-10., 0., 0.]),
+                                      np.array([10., 0., 0.]),
+                                      100,
+                                      parametrization='constant_rotation')
+    g = geoms[-1]
+    source = g.source
+    assert g._compiled() is g._compiled()
+
+    # unchanged chains are not visited again
+    visited = []
+    stamp = transform._stamp
+    monkeypatch.setattr(transform, '_stamp',
+                        lambda self: visited.append(self) or stamp(self))
+    np.testing.assert_equal(g.source, source)
+    assert g.parameters() == list(params.values())
+    assert visited == []
+
+    params['rotation_speed'].value = 0.
+    np.testing.assert_allclose(g.source, [-10., 0., 0.], atol=1e-12)
+    assert len(visited) > 0
+
+
+def test_geometry_cache(geoms, monkeypatch):
+    calls = []
+    compose = transform._compose
+
+    def _counting_compose(self, parent):
+        calls.append(self)
+        return compose(self, parent)
+
+    monkeypatch.setattr(transform, '_compose', _counting_compose)
+
+    # tilt + one transform for each geometry
+    sources, _, _ = geometry_arrays(geoms)
+    assert len(calls) == 1 + len(geoms)
+
+    calls.clear()
+    geometry_arrays(geoms)
+    _ = geoms[0].roll, geoms[0].pitch, geoms[0].yaw
+    assert len(calls) == 0
+
+    # changing the tilt invalidates all, changing a yaw only its geometry
+    tilted = geoms[0].decorated_geometry.decorated_geometry
+    tilted.own_parameters()['roll'].value = .02
+    geometry_arrays(geoms)
+    assert len(calls) == 1 + len(geoms)
+
+    calls.clear()
+    yaw = geoms[2].decorated_geometry.own_parameters()['yaw']
+    yaw.value = yaw.value + .1
+    sources_new, _, _ = geometry_arrays(geoms)
+    assert calls == [geoms[2].decorated_geometry]
+    assert not np.allclose(sources_new[2], sources[2])
+
+
+def test_geometry_cache_copies(geoms):
+    # the cached states are read-only, but what users get is not
+    g = geoms[0]
+    cached = g.source
+    g.source[0] += 1.
+    np.testing.assert_equal(g.source, cached)
+
+    static = g.asstatic()
+    static.source += 1.
+    np.testing.assert_equal(static.source, cached + 1.)
+    g.rotation_matrix()[0, 0] = 2.
+    np.testing.assert_equal(geometry_arrays([g])[0][0], cached)
+
+
+def test_geometry_without_own_parameters(geoms):
+    class _Flip(BaseDecorator):
+        # only implements the properties
+        @property
+        def source(self):
+            return -self.decorated_geometry.source
+
+        def parameters(self):
+            return self.decorated_geometry.parameters()
+
+    flipped = _Flip(geoms[1])
+    assert flipped.own_parameters() is None
+    assert flipped.parameters() == geoms[1].parameters()
+    np.testing.assert_allclose(geometry_arrays([flipped])[0][0],
+                               -geoms[1].source)
+
+
+def test_rotation_matrix_gimbal_lock():
+    initial = Geometry(source=np.array([-10., 0., 0.]),
+                       detector=np.array([10., 0., 0.]),
+                       roll=.1, pitch=.2, yaw=.3)
+    # pitch of pi/2 is gimbal lock in the 'sxyz' convention
+    locked = transform(initial, pitch=np.pi / 2)
+    geom = transform(locked, roll=.4, yaw=-.2)
+
+    expected = (Geometry.angles2mat(.1, .2, .3)
+                @ Geometry.angles2mat(0., np.pi / 2, 0.)
+                @ Geometry.angles2mat(.4, 0., -.2))
+    np.testing.assert_almost_equal(geom.rotation_matrix(), expected)
+    np.testing.assert_almost_equal(
+        Geometry.angles2mat(geom.roll, geom.pitch, geom.yaw), expected)
+
+
+def test_euler_conversions():
+    rng = np.random.default_rng(2)
+    angles = rng.uniform(-np.pi, np.pi, (50, 3))
+    angles[:, 1] /= 2  # pitch in [-pi/2, pi/2]
+    angles[0] = [.3, np.pi / 2, 0.]  # gimbal lock
+    angles[1] = [-.2, -np.pi / 2, 0.]
+
+    expected = np.stack([transforms3d.euler.euler2mat(*a, 'sxyz')
+                         for a in angles])
+    mats = angles2mats(angles)
+    np.testing.assert_almost_equal(mats, expected)
+    np.testing.assert_almost_equal(Geometry.angles2mat(*angles[5]),
+                                   expected[5])
+
+    expected = np.array([transforms3d.euler.mat2euler(m, 'sxyz')
+                         for m in mats])
+    np.testing.assert_almost_equal(mats2angles(mats), expected)
+    np.testing.assert_almost_equal(mats2angles(mats), angles)
+    np.testing.assert_almost_equal(Geometry.mat2angles(mats[0]), expected[0])
+    np.testing.assert_almost_equal(angles2mats(angles.reshape(5, 10, 3)),
+                                   mats.reshape(5, 10, 3, 3))
+
+
+def test_problem_layout(geoms, markers):
+    data = xray_multigeom_project(geoms, markers)
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    params = problem.params()
+    assert len(params) == len(set(params))
+    assert params[:len(markers)] == [markers[id] for id in sorted(markers)]
+
+    layout = problem._layout()
+    x = params2ndarray(params)
+    problem(x)
+    assert problem._layout() is layout
+
+    # toggling `optimize` changes the structure of `x`
+    markers['marker_0'].optimize = False
+    assert problem._layout() is not layout
+    assert len(params2ndarray(problem.params())) == len(x) - 3
+    assert markers['marker_1'] in problem._offsets()
+    assert markers['marker_0'] not in problem._offsets()
+
+    layout = problem._layout()
+    problem.geoms = geoms[:-1]
+    problem.data = problem.data.take(slice(0, -1))
+    assert problem._layout() is not layout
+    assert len(problem(params2ndarray(problem.params()))) == \
+        2 * (len(geoms) - 1) * len(markers)
+
+
+def test_problem_layout_numpy_flags(geoms, markers):
+    # e.g. `optimize=angle != 0.`, which is a NumPy bool
+    data = xray_multigeom_project(geoms, markers)
+    markers['marker_0'].optimize = np.bool_(False)
+    markers['marker_1'].optimize = np.bool_(True)
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    layout = problem._layout()
+    assert markers['marker_0'] not in problem._offsets()
+    assert markers['marker_1'] in problem._offsets()
+    assert len(params2ndarray(problem.params())) == layout.nr_cols
+
+    markers['marker_0'].optimize = False
+    assert problem._layout() is layout
+
+
+def test_problem_incremental_residuals(geoms, markers, monkeypatch):
+    data = xray_multigeom_project(geoms, markers)
+    del data[3]['marker_1']
+    problem = XrayOptimizationProblem(markers, geoms, data)
+    x = params2ndarray(problem.params())
+    problem(x)
+
+    import cate.xray
+    projected = []
+    project = cate.xray.xray_project_batch
+
+    def _counting_project(sources, detectors, rotations, locations):
+        projected.append(len(sources) * len(locations))
+        return project(sources, detectors, rotations, locations)
+
+    monkeypatch.setattr(cate.xray, 'xray_project_batch', _counting_project)
+
+    # yaw of one geometry and one marker
+    yaw = geoms[3].decorated_geometry.own_parameters()['yaw']
+    x[problem._offsets()[yaw]] += .01
+    x[problem._offsets()[markers['marker_4']] + 1] -= .02
+    residuals = problem(x)
+    assert sum(projected) == len(markers) + len(geoms) - 1
+
+    expected = XrayOptimizationProblem(markers, geoms, data)(x)
+    np.testing.assert_almost_equal(residuals, expected)
+
+    # changes of attributes that are not a `Parameter` are also tracked
+    static = [g.asstatic() for g in geoms]
+    problem = XrayOptimizationProblem(markers, static, data)
+    x = params2ndarray(problem.params())
+    before = problem(x)
+    static[2].yaw = static[2].yaw + .1
+    after = problem(x)
+    np.testing.assert_almost_equal(
+        after, XrayOptimizationProblem(markers, static, data)(x))
+    assert not np.allclose(after, before)
+
+
+def test_problem_alternate(geoms, markers):
+    data = xray_multigeom_project(geoms, markers)
+    del data[1]['marker_2']
+    del data[4]['marker_0']
+    problem = XrayOptimizationProblem(None, geoms, data, mode='alternate')
+    x = params2ndarray(problem.params())
+    np.testing.assert_almost_equal(problem(x), 0.)
+    for id, marker in problem.markers.items():
+        assert marker.optimize is False
+        np.testing.assert_almost_equal(marker.value, markers[id].value)
+
+    # near the solution the reduced Jacobian is the derivative of `__call__`
+    x_perturbed = x + np.random.default_rng(1).normal(0., 1e-5, len(x))
+    J = problem.jacobian(x_perturbed).matmat(np.identity(len(x)))
+    J_fd = scipy.optimize.approx_fprime(x_perturbed, problem, 1e-7)
+    np.testing.assert_allclose(J, J_fd, atol=1e-4)
+    pattern = problem.jac_sparsity().toarray()
+    assert np.all(pattern[J != 0.] == 1)
+
+    # the markers are solved again, and warm-started, at every evaluation
+    markers_before = problem.markers
+    x_perturbed = x + np.random.default_rng(2).normal(0., 1e-2, len(x))
+    r = scipy.optimize.least_squares(problem, x_perturbed,
+                                     jac=problem.jacobian, tr_solver='lsmr')
+    assert problem.markers is markers_before
+    assert r.cost < 1e-3 * .5 * np.sum(problem(x_perturbed) ** 2)
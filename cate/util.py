@@ -1,7 +1,8 @@
 import numpy as np
 
-from cate.param import ScalarParameter, VectorParameter
-from cate.xray import Geometry, transform
+from cate.param import ScalarParameter, TrajectoryParameter, VectorParameter
+from cate.xray import (Geometry, angles2mats, geometry_arrays, mats2angles,
+                       transform)
 
 
 def circular_geometry(
@@ -10,8 +11,16 @@ def circular_geometry(
     nr_angles: int,
     angle_start: float = 0.,
     angle_stop: float = 2 * np.pi,
-    parametrization=None
+    parametrization=None,
+    nr_coefficients: int = 8
 ):
+    """
+    :param parametrization: `None` for static geometries,
+        'constant_rotation' for a single rotation speed, 'rotation_from_init'
+        for an angle for each frame, or 'trajectory' for a B-spline of the
+        angle versus the frame number (see `TrajectoryParameter`).
+    :param nr_coefficients: Number of coefficients of the 'trajectory'.
+    """
     if parametrization is not None:
         parameters = {
             'source': VectorParameter(source_position),
@@ -58,18 +67,73 @@ def circular_geometry(
             angle = ScalarParameter(angular_increment * i)
             parameters[f'angle_{i}'] = angle
             geoms.append(transform(geoms[0], yaw=angle))
+    elif parametrization == 'trajectory':
+        # one smooth curve of the angles, independent of the number of frames
+        frames = np.arange(nr_angles)
+        trajectory = TrajectoryParameter.fit(
+            frames, angular_increment * frames, nr_coefficients)
+        parameters['trajectory'] = trajectory
+        for sample in trajectory.samples(frames[1:]):
+            geoms.append(transform(geoms[0], yaw=sample))
     else:
         raise ValueError("Unkown parametrization")
 
     return geoms, parameters
 
 
+class InterpolatedGeometries:
+    """Geometries that are `transform`s of one `parent` geometry, of which
+    the (roll, pitch, yaw) are given as arrays.
+
+    The geometries are only created when they are accessed, e.g. by indexing
+    or iterating, while `arrays` resolves all of them at once, so that many
+    frames can be exported without creating `transform` objects.
+    """
+
+    def __init__(self, parent: Geometry, nrs, angles: np.ndarray):
+        """
+        :param parent: The geometry that is transformed.
+        :param nrs: Frame number of each geometry.
+        :param angles: (F, 3) array of (roll, pitch, yaw) of the transforms.
+        """
+        self.parent = parent
+        self.nrs = np.asarray(nrs)
+        self.angles = np.asarray(angles, dtype=float)
+        if self.angles.shape != (len(self.nrs), 3):
+            raise ValueError("`angles` must have shape (len(nrs), 3).")
+
+    def __len__(self):
+        return len(self.angles)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        r, p, y = self.angles[i]
+        return transform(self.parent, roll=r, pitch=p, yaw=y)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def arrays(self) -> tuple:
+        """Sources, detectors and rotation matrices of all geometries, see
+        `geometry_arrays`, composed as in `transform`."""
+        s, d, S = self.parent._state()
+        R = angles2mats(self.angles)
+        # `R.T @ s` for every `R`
+        return s @ R, d @ R, S @ R
+
+
 def geoms_from_interpolation(
     interpolation_geoms,
     interpolation_nrs,
     interpolation_calibration_nrs,
     plot: bool = False,
-    method='transforms'
+    method='transforms',
+    kind='linear',
+    period: float = None,
+    lazy: bool = False
 ):
     """
     :param interpolation_geoms:
@@ -79,58 +143,96 @@ def geoms_from_interpolation(
     :param interpolation_calibration_nrs:
         The numbers to interpolate from.
     :param plot:
-    :return:
+    :param kind: 'linear', 'cubic' for a cubic spline, or 'periodic' for
+        a periodic cubic spline, which needs the `period`. The angles are
+        interpolated as they are for 'linear', and unwrapped along the
+        frames for the splines.
+    :param period: Number of frames of a full rotation, for 'periodic'.
+        A yaw that increases by multiples of 2 pi over the period is allowed,
+        and the calibration frames may span more than one period.
+    :param lazy: Return `InterpolatedGeometries`, instead of a list.
+    :return: A list of `transform`s of the decorated geometry of the first
+        of `interpolation_geoms`, or `InterpolatedGeometries` of them.
     """
     from scipy import interpolate
 
-    def interpolate_var(v, fill_value):
-        """Reinterpolate angles (x=interp_calib_nrs, y=angles)"""
-        v = np.squeeze(np.array(v))
-        f = interpolate.interp1d(
-            x=np.array(interpolation_calibration_nrs),
-            y=v,
-            fill_value=fill_value)
-
-        xnew = interpolation_nrs
-        ynew = f(xnew)
-
-        if plot:
-            import matplotlib.pyplot as plt
-            plt.plot(interpolation_calibration_nrs, v, 'o', xnew, ynew, '-')
-            plt.show()
-
-        return ynew
+    x = np.asarray(interpolation_calibration_nrs, dtype=float)
+    xnew = np.asarray(interpolation_nrs, dtype=float)
+    if kind == 'periodic' and period is None:
+        raise ValueError("A 'periodic' interpolation needs the `period`.")
 
     if method == 'transforms':
-        rolls = interpolate_var(
-            [g.transformation_roll for g in interpolation_geoms],
-            fill_value='extrapolate')
-        pitches = interpolate_var(
-            [g.transformation_pitch for g in interpolation_geoms],
-            fill_value='extrapolate')
-        yaws = interpolate_var(
-            [g.transformation_yaw for g in interpolation_geoms],
-            fill_value='extrapolate')
+        angles = np.array([[g.transformation_roll,
+                            g.transformation_pitch,
+                            g.transformation_yaw]
+                           for g in interpolation_geoms], dtype=float)
+        # extrapolates outside of the calibrated frames
+        bounds_error = False
     elif method == 'statics':
-        rolls = interpolate_var([g.roll for g in interpolation_geoms],
-                                fill_value='interpolate')
-        pitches = interpolate_var([g.pitch for g in interpolation_geoms],
-                                  fill_value='interpolate')
-        yaws = interpolate_var([g.yaw for g in interpolation_geoms],
-                               fill_value='interpolate')
+        angles = mats2angles(geometry_arrays(interpolation_geoms)[2])
+        bounds_error = True
     else:
         raise ValueError
 
-    geoms = []
-    for i, (r, p, y) in enumerate(zip(rolls, pitches, yaws)):
-        parent_geom = interpolation_geoms[0].decorated_geometry
-        rotated_geom = transform(parent_geom,
-                                 roll=r,
-                                 pitch=p,
-                                 yaw=y)
-        geoms.append(rotated_geom)
+    # all components are interpolated at once, along the frames
+    if kind == 'linear':
+        f = interpolate.interp1d(
+            x, angles, axis=0, bounds_error=bounds_error,
+            fill_value='extrapolate' if not bounds_error else np.nan)
+    elif kind == 'cubic':
+        f = interpolate.CubicSpline(x, np.unwrap(angles, axis=0), axis=0)
+    elif kind == 'periodic':
+        f = _periodic_spline(x, angles, period)
+    else:
+        raise ValueError("`kind` must be 'linear', 'cubic' or 'periodic'.")
+
+    angles_new = f(xnew)
+
+    if plot:
+        import matplotlib.pyplot as plt
+        for i in range(3):
+            plt.plot(x, angles[:, i], 'o', xnew, angles_new[:, i], '-')
+        plt.show()
+
+    geoms = InterpolatedGeometries(interpolation_geoms[0].decorated_geometry,
+                                   interpolation_nrs, angles_new)
+    return geoms if lazy else list(geoms)
+
+
+def _periodic_spline(x, angles, period):
+    """Periodic cubic spline of (F, 3) `angles` at frames `x`, of which the
+    angles may increase by whole turns over the `period`."""
+    from scipy import interpolate
+
+    order = np.argsort(x, kind='stable')
+    x, angles = x[order], np.unwrap(angles[order], axis=0)
+
+    # whole turns over the period, from the average angular speed
+    speed = np.polyfit(x, angles, 1)[0] if len(x) > 1 else np.zeros(3)
+    turns = 2 * np.pi * np.round(speed * period / (2 * np.pi))
+    x0 = x[0]
+
+    # the remainder is periodic, and is fitted on a single period
+    phase = x0 + np.mod(x - x0, period)
+    remainder = angles - turns * (x - x0)[:, np.newaxis] / period
+    order = np.argsort(phase, kind='stable')
+    phase, remainder = phase[order], remainder[order]
+    unique = np.append(True, np.diff(phase) > 0.)
+    # frames that are a period apart are combined, modulo whole turns
+    phase, remainder = phase[unique], remainder[unique]
+    wrapped = np.unwrap(np.mod(remainder, 2 * np.pi), axis=0)
+    remainder = wrapped + (remainder[0] - wrapped[0])
+    spline = interpolate.CubicSpline(
+        np.append(phase, x0 + period),
+        np.vstack((remainder, remainder[0])),
+        axis=0, bc_type='periodic')
+
+    def f(nrs):
+        nrs = np.asarray(nrs, dtype=float)
+        return (spline(x0 + np.mod(nrs - x0, period))
+                + turns * (nrs - x0)[:, np.newaxis] / period)
 
-    return geoms
+    return f
 
 
 def plot_markers(markers):
@@ -1,12 +1,14 @@
+import math
 from abc import ABC, abstractmethod
-from multiprocessing import Pool
 from typing import Any
 
 import numpy as np
 import transforms3d
 
-from cate.param import (Parameter, ScalarParameter, VectorParameter,
-                        params2ndarray, update_params)
+from cate import profiling
+from cate.data import ProjectionData
+from cate.param import (Parameter, ParameterStore, TrajectorySample,
+                        VectorParameter, params2ndarray)
 
 
 class Geometry:
@@ -38,6 +40,13 @@ class Geometry:
     """
     ANGLES_CONVENTION = "sxyz"
 
+    # incremented when a non-`Parameter` attribute is set, see `_stamp`
+    _version = 0
+    # result of `_compose`, see `CompiledGeometries.states`
+    _cache = None
+    # `CompiledGeometries` of this geometry alone, see `_compiled`
+    _chain = None
+
     def __init__(
         self,
         source: Any,
@@ -115,6 +124,7 @@ class Geometry:
             self._source.value = value
         else:
             self._source = value
+            self._version += 1
 
     @property
     def detector(self):
@@ -129,6 +139,7 @@ class Geometry:
             self._detector.value = value
         else:
             self._detector = value
+            self._version += 1
 
     @property
     def roll(self):
@@ -143,6 +154,7 @@ class Geometry:
             self._roll.value = value
         else:
             self._roll = value
+            self._version += 1
 
     @property
     def pitch(self):
@@ -157,6 +169,7 @@ class Geometry:
             self._pitch.value = value
         else:
             self._pitch = value
+            self._version += 1
 
     @property
     def yaw(self):
@@ -171,6 +184,7 @@ class Geometry:
             self._yaw.value = value
         else:
             self._yaw = value
+            self._version += 1
 
     @staticmethod
     def u(r, p, y):
@@ -186,13 +200,54 @@ class Geometry:
 
     @staticmethod
     def angles2mat(r, p, y) -> np.ndarray:
+        if Geometry.ANGLES_CONVENTION == "sxyz":
+            # same as `angles2mats`, but much faster for a single matrix
+            ci, cj, ck = math.cos(r), math.cos(p), math.cos(y)
+            si, sj, sk = math.sin(r), math.sin(p), math.sin(y)
+            cc, cs = ci * ck, ci * sk
+            sc, ss = si * ck, si * sk
+            return np.array([[cj * ck, sj * sc - cs, sj * cc + ss],
+                             [cj * sk, sj * ss + cc, sj * cs - sc],
+                             [-sj, cj * si, cj * ci]])
+
         return transforms3d.euler.euler2mat(
             r, p, y,
             Geometry.ANGLES_CONVENTION
         )
 
+    @staticmethod
+    def angles2mat_derivatives(r, p, y) -> np.ndarray:
+        """Derivatives of `angles2mat` w.r.t. `r`, `p` and `y`.
+
+        In the static 'sxyz' convention the matrix is `Rz(y) Ry(p) Rx(r)`.
+        :return: (3, 3, 3) array, the last axis being the angle.
+        """
+        cr, sr = np.cos(r), np.sin(r)
+        cp, sp = np.cos(p), np.sin(p)
+        cy, sy = np.cos(y), np.sin(y)
+        Rx = np.array([[1., 0., 0.], [0., cr, -sr], [0., sr, cr]])
+        Ry = np.array([[cp, 0., sp], [0., 1., 0.], [-sp, 0., cp]])
+        Rz = np.array([[cy, -sy, 0.], [sy, cy, 0.], [0., 0., 1.]])
+        dRx = np.array([[0., 0., 0.], [0., -sr, -cr], [0., cr, -sr]])
+        dRy = np.array([[-sp, 0., cp], [0., 0., 0.], [-cp, 0., -sp]])
+        dRz = np.array([[-sy, -cy, 0.], [cy, -sy, 0.], [0., 0., 0.]])
+        return np.stack((Rz @ Ry @ dRx,
+                         Rz @ dRy @ Rx,
+                         dRz @ Ry @ Rx), axis=-1)
+
     @staticmethod
     def mat2angles(mat) -> tuple:
+        if Geometry.ANGLES_CONVENTION == "sxyz":
+            # same as `mats2angles`, but much faster for a single matrix
+            (m00, _, _), (m10, m11, m12), (m20, m21, m22) = np.asarray(
+                mat, dtype=float).tolist()
+            cy = math.hypot(m00, m10)
+            if cy > np.finfo(float).eps * 4.:
+                return (math.atan2(m21, m22), math.atan2(-m20, cy),
+                        math.atan2(m10, m00))
+
+            return math.atan2(-m12, m11), math.atan2(-m20, cy), 0.
+
         return transforms3d.euler.mat2euler(
             mat,
             Geometry.ANGLES_CONVENTION
@@ -235,6 +290,122 @@ class Geometry:
     def parameters(self) -> list:
         return list(self.own_parameters().values())
 
+    def rotation_matrix(self) -> np.ndarray:
+        """Rotation matrix of the detector frame, as in `angles2mat`.
+
+        For decorated geometries the matrix is composed from the rotation
+        matrices of the decorators, and never converted to `roll`, `pitch`
+        and `yaw` (which is slow, and ill-conditioned near gimbal lock).
+        """
+        return self._state()[2].copy()
+
+    def _state(self) -> tuple:
+        """Source, detector and rotation matrix, see `CompiledGeometries`."""
+        return self._compiled().states()[0]
+
+    def _compiled(self) -> 'CompiledGeometries':
+        """The decorator chain of this geometry, which is fixed once the
+        geometry is created, and hence flattened only once."""
+        if self._chain is None:
+            self._chain = CompiledGeometries([self])
+
+        return self._chain
+
+    def _stamp(self) -> tuple:
+        """Changes whenever the own attributes or parameters change, `None`
+        if the geometry does not report its own parameters."""
+        own = self.own_parameters()
+        if own is None:
+            return None
+
+        return (self._version, *(p.version for p in own.values()))
+
+    def _compose(self, parent) -> tuple:
+        """Source, detector and rotation matrix of this geometry, given the
+        `_compose` result of the decorated geometry (`None` if there is
+        none)."""
+        return (np.array(self.source, dtype=float),
+                np.array(self.detector, dtype=float),
+                self.angles2mat(self.roll, self.pitch, self.yaw))
+
+    def linearize(self) -> tuple:
+        """Source, detector, rotation matrix, and their derivatives.
+
+        The derivatives are returned as a `dict` of "tangents", that maps
+        each `Parameter` of the geometry to a tuple of derivatives of the
+        source (3, k), detector (3, k) and rotation matrix (3, 3, k),
+        where `k` is the length of the parameter. Parameters with a delayed
+        (callable) value are considered constants.
+        """
+        return self._compiled().linearize()[0]
+
+    def _linearize(self, parent) -> tuple:
+        """Like `_compose`, but for `linearize`."""
+        R = self.angles2mat(self.roll, self.pitch, self.yaw)
+        tangents = {}
+        if isinstance(self._source, Parameter):
+            _add_tangent(tangents, self._source, ds=np.identity(3))
+        if isinstance(self._detector, Parameter):
+            _add_tangent(tangents, self._detector, dd=np.identity(3))
+
+        dR = self.angles2mat_derivatives(self.roll, self.pitch, self.yaw)
+        for i, angle in enumerate((self._roll, self._pitch, self._yaw)):
+            if isinstance(angle, Parameter):
+                _add_tangent(tangents, angle, dR=dR[..., i:i + 1])
+
+        return (np.array(self.source, dtype=float),
+                np.array(self.detector, dtype=float),
+                R, tangents)
+
+
+def angles2mats(angles) -> np.ndarray:
+    """Vectorized `Geometry.angles2mat` for the static 'sxyz' convention.
+
+    :param angles: (..., 3) array of (roll, pitch, yaw).
+    :return: (..., 3, 3) stack of rotation matrices.
+    """
+    angles = np.asarray(angles, dtype=float)
+    ci, cj, ck = np.moveaxis(np.cos(angles), -1, 0)
+    si, sj, sk = np.moveaxis(np.sin(angles), -1, 0)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    M = np.empty(angles.shape[:-1] + (3, 3))
+    M[..., 0, 0] = cj * ck
+    M[..., 0, 1] = sj * sc - cs
+    M[..., 0, 2] = sj * cc + ss
+    M[..., 1, 0] = cj * sk
+    M[..., 1, 1] = sj * ss + cc
+    M[..., 1, 2] = sj * cs - sc
+    M[..., 2, 0] = -sj
+    M[..., 2, 1] = cj * si
+    M[..., 2, 2] = cj * ci
+    return M
+
+
+def mats2angles(mats) -> np.ndarray:
+    """Vectorized `Geometry.mat2angles` for the static 'sxyz' convention.
+
+    At gimbal lock (pitch of +/- pi/2) the yaw is set to zero, as in
+    `transforms3d.euler.mat2euler`.
+
+    :param mats: (..., 3, 3) stack of rotation matrices.
+    :return: (..., 3) array of (roll, pitch, yaw).
+    """
+    M = np.asarray(mats, dtype=float)
+    cy = np.hypot(M[..., 0, 0], M[..., 1, 0])
+    regular = cy > np.finfo(float).eps * 4.
+
+    angles = np.empty(M.shape[:-2] + (3,))
+    angles[..., 0] = np.where(regular,
+                              np.arctan2(M[..., 2, 1], M[..., 2, 2]),
+                              np.arctan2(-M[..., 1, 2], M[..., 1, 1]))
+    angles[..., 1] = np.arctan2(-M[..., 2, 0], cy)
+    angles[..., 2] = np.where(regular,
+                              np.arctan2(M[..., 1, 0], M[..., 0, 0]),
+                              0.)
+    return angles
+
 
 class BaseDecorator(Geometry, ABC):
     def __init__(self, decorated_geometry: Geometry):
@@ -270,17 +441,38 @@ class BaseDecorator(Geometry, ABC):
         # be to return self._g.parameters().
         raise NotImplementedError()
 
+    def own_parameters(self) -> dict:
+        # Only the parameters that the decorator adds to the decorated
+        # geometry. `None` if not implemented, then `parameters()` is used.
+        return None
+
+    def _compose(self, parent) -> tuple:
+        # Generic fallback for decorators that only implement the properties.
+        return (np.array(self.source, dtype=float),
+                np.array(self.detector, dtype=float),
+                self.angles2mat(self.roll, self.pitch, self.yaw))
+
+    def _linearize(self, parent) -> tuple:
+        raise NotImplementedError(
+            f"`{type(self).__name__}` does not provide derivatives.")
+
     def asstatic(self):
+        source, detector, R = self._state()
+        roll, pitch, yaw = self.mat2angles(R)
         return Geometry(
-            source=self.source,
-            detector=self.detector,
-            roll=self.roll,
-            pitch=self.pitch,
-            yaw=self.yaw)
+            source=source.copy(),
+            detector=detector.copy(),
+            roll=roll,
+            pitch=pitch,
+            yaw=yaw)
 
 
 class transform(BaseDecorator):
-    """Describes a coordinate transformation to a new orthogonal basis"""
+    """Describes a coordinate transformation to a new orthogonal basis
+
+    The angles can be constants, `Parameter`s, or `TrajectorySample`s of
+    a `cate.param.TrajectoryParameter`, which many transforms share.
+    """
 
     def __init__(self,
                  geom: Geometry,
@@ -296,24 +488,15 @@ class transform(BaseDecorator):
 
     @property
     def transformation_roll(self) -> float:
-        if isinstance(self.__roll, Parameter):
-            return self.__roll.value
-        else:
-            return self.__roll
+        return _angle_value(self.__roll)
 
     @property
     def transformation_pitch(self) -> float:
-        if isinstance(self.__pitch, Parameter):
-            return self.__pitch.value
-        else:
-            return self.__pitch
+        return _angle_value(self.__pitch)
 
     @property
     def transformation_yaw(self) -> float:
-        if isinstance(self.__yaw, Parameter):
-            return self.__yaw.value
-        else:
-            return self.__yaw
+        return _angle_value(self.__yaw)
 
     def __R(self):
         return Geometry.angles2mat(
@@ -332,19 +515,22 @@ class transform(BaseDecorator):
         parametrization `d' + S'x'` we have S'.T = R.T S.T, and
         the r', p' and y' can just be retrieved from those since
         S' = S R
+        The composition is done in `_compose`.
         """
-        S = Geometry.angles2mat(self._g.roll, self._g.pitch, self._g.yaw)
-        # TODO check if I need to get the RPY from S_prime or S_prime.T
-        #    it must be the opposite operation of angles2mat?
-        return Geometry.mat2angles(S @ self.__R())
+        return Geometry.mat2angles(self._state()[2])
+
+    def _compose(self, parent) -> tuple:
+        s, d, S = parent
+        R = self.__R()
+        return R.T @ s, R.T @ d, S @ R
 
     @property
     def source(self):
-        return self.__R().T @ self._g.source
+        return self._state()[0].copy()
 
     @property
     def detector(self):
-        return self.__R().T @ self._g.detector
+        return self._state()[1].copy()
 
     @property
     def roll(self):
@@ -361,22 +547,47 @@ class transform(BaseDecorator):
         r, p, y = self.__rpy()
         return y
 
-    def parameters(self) -> list:
-        # Adding these parameters will result in parameter duplication amongst
-        # geometries that decorate the same underlying geometry.
-        # This is not a problem, as we can de-duplicate the parameters before
-        # feeding into to the optimization procedure.
-        params = self._g.parameters()
-
-        if isinstance(self.__roll, Parameter):
-            params.append(self.__roll)
-        if isinstance(self.__pitch, Parameter):
-            params.append(self.__pitch)
-        if isinstance(self.__yaw, Parameter):
-            params.append(self.__yaw)
+    def _linearize(self, parent) -> tuple:
+        """See `Geometry.linearize`. The rotation of the detector frame is
+        `S' = S R`, see `__rpy`."""
+        s, d, S, parent_tangents = parent
+        R = self.__R()
+
+        tangents = {}
+        for param, (ds, dd, dS) in parent_tangents.items():
+            _add_tangent(tangents, param, ds=R.T @ ds, dd=R.T @ dd,
+                         dR=np.einsum('ijk,jl->ilk', dS, R))
+
+        dR = Geometry.angles2mat_derivatives(
+            self.transformation_roll,
+            self.transformation_pitch,
+            self.transformation_yaw)
+        for i, angle in enumerate((self.__roll, self.__pitch, self.__yaw)):
+            param, weights = _angle_parameter(angle)
+            if param is not None:
+                _add_tangent(tangents, param,
+                             ds=np.outer(dR[..., i].T @ s, weights),
+                             dd=np.outer(dR[..., i].T @ d, weights),
+                             dR=(S @ dR[..., i])[..., np.newaxis] * weights)
+
+        return R.T @ s, R.T @ d, S @ R, tangents
+
+    def own_parameters(self) -> dict:
+        params = {}
+        for name, angle in (('roll', self.__roll), ('pitch', self.__pitch),
+                            ('yaw', self.__yaw)):
+            param, _ = _angle_parameter(angle)
+            if param is not None:
+                params[name] = param
 
         return params
 
+    def parameters(self) -> list:
+        # Geometries that decorate the same underlying geometry will share
+        # parameters. This is not a problem, as we de-duplicate the parameters
+        # before feeding into to the optimization procedure.
+        return self._compiled().parameters()[0]
+
 
 class shift(BaseDecorator):
     def __init__(self,
@@ -403,18 +614,207 @@ class shift(BaseDecorator):
 
     @property
     def source(self):
-        return self._g.source + self.vector
+        return self._state()[0].copy()
 
     @property
     def detector(self):
-        return self._g.detector + self.vector
+        return self._state()[1].copy()
 
-    def parameters(self) -> list:
-        params = self._g.parameters()
+    def _compose(self, parent) -> tuple:
+        s, d, R = parent
+        return s + self.vector, d + self.vector, R
+
+    def _linearize(self, parent) -> tuple:
+        """See `Geometry.linearize`."""
+        s, d, R, tangents = parent
         if isinstance(self.__vector, Parameter):
-            params.append(self.__vector)
+            tangents = dict(tangents)
+            _add_tangent(tangents, self.__vector,
+                         ds=np.identity(3), dd=np.identity(3))
 
-        return params
+        return s + self.vector, d + self.vector, R, tangents
+
+    def own_parameters(self) -> dict:
+        if isinstance(self.__vector, Parameter):
+            return {'vector': self.__vector}
+
+        return {}
+
+    def parameters(self) -> list:
+        return self._compiled().parameters()[0]
+
+
+class CompiledGeometries:
+    """Flat representation of geometries and their decorator chains.
+
+    The geometries, and all geometries that they (indirectly) decorate, are
+    put in a list in which every geometry comes after the one it decorates.
+    Evaluating the list in that order resolves each geometry exactly once,
+    by composing its own rotation and translation onto the already resolved
+    state of its decorated geometry. Shared chains, such as in
+    `cate.util.circular_geometry(..., 'constant_rotation')`, are therefore
+    evaluated in O(1) per geometry, instead of recursing through every
+    decorator for every geometry and every property.
+    """
+
+    def __init__(self, geoms):
+        self.geoms = list(geoms)
+
+        nodes, index = [], {}
+        for g in self.geoms:
+            chain = []
+            while g is not None and id(g) not in index:
+                chain.append(g)
+                g = g.decorated_geometry if isinstance(g, BaseDecorator) \
+                    else None
+
+            for node in reversed(chain):
+                index[id(node)] = len(nodes)
+                nodes.append(node)
+
+        self._nodes = nodes
+        self._parents = [index[id(n.decorated_geometry)]
+                         if isinstance(n, BaseDecorator) else -1
+                         for n in nodes]
+        self._targets = [index[id(g)] for g in self.geoms]
+        self._own = None
+        self._states = None
+        self._parameters = None
+
+    def _node_parameters(self, node_versions: list):
+        """All parameters of the nodes, which only change with the versions
+        of the nodes, or `None` if a node does not report its own
+        parameters."""
+        if self._own is None or self._own[0] != node_versions:
+            own = [n.own_parameters() for n in self._nodes]
+            params = None if any(o is None for o in own) else list(
+                dict.fromkeys(p for o in own for p in o.values()))
+            self._own = (node_versions, params)
+
+        return self._own[1]
+
+    def _evaluate(self, fn) -> list:
+        """Evaluates `fn(node, result_of_parent)` on all nodes, and returns
+        the results of the geometries."""
+        results = [None] * len(self._nodes)
+        for i, (node, parent) in enumerate(zip(self._nodes, self._parents)):
+            results[i] = fn(node, results[parent] if parent >= 0 else None)
+
+        return [results[i] for i in self._targets]
+
+    def states(self) -> list:
+        """(source, detector, rotation matrix) for each geometry.
+
+        The results are cached on the geometries, and only recomputed when
+        a parameter upstream in the chain has changed (see
+        `Parameter.version`). The returned arrays are therefore read-only,
+        and the public accessors, such as `Geometry.source`, return copies.
+        When nothing in the chains has changed, the previous states are
+        returned without visiting the nodes.
+        """
+        node_versions = [n._version for n in self._nodes]
+        params = self._node_parameters(node_versions)
+        versions = None if params is None else (
+            node_versions, [p.version for p in params])
+        if versions is not None and self._states is not None \
+                and self._states[0] == versions:
+            return self._states[1]
+
+        states = self._evaluate(_cached_compose)
+        self._states = (versions, states)
+        return states
+
+    def arrays(self) -> tuple:
+        """Stacked states, see `geometry_arrays`."""
+        states = self.states()
+        if len(states) == 0:
+            return np.empty((0, 3)), np.empty((0, 3)), np.empty((0, 3, 3))
+
+        return tuple(np.stack(a) for a in zip(*states))
+
+    def linearize(self) -> list:
+        """`Geometry.linearize` for each geometry."""
+        return self._evaluate(lambda node, parent: node._linearize(parent))
+
+    def parameters(self) -> list:
+        """De-duplicated `Geometry.parameters` for each geometry."""
+        node_versions = [n._version for n in self._nodes]
+        cacheable = self._node_parameters(node_versions) is not None
+        if cacheable and self._parameters is not None \
+                and self._parameters[0] == node_versions:
+            return [list(p) for p in self._parameters[1]]
+
+        def _parameters(node, parent):
+            own = node.own_parameters()
+            if own is None:
+                return dict.fromkeys(node.parameters())
+
+            params = {} if parent is None else dict(parent)
+            params.update(dict.fromkeys(own.values()))
+            return params
+
+        parameters = [list(p.keys()) for p in self._evaluate(_parameters)]
+        if cacheable:
+            self._parameters = (node_versions, parameters)
+
+        return [list(p) for p in parameters]
+
+
+def _cached_compose(node: Geometry, parent) -> tuple:
+    """`node._compose(parent)`, cached until the stamp of the node changes, or
+    the state of its parent is recomputed."""
+    stamp = node._stamp()
+    if stamp is None:
+        # decorators without `own_parameters()` cannot be tracked
+        return node._compose(parent)
+
+    cache = node._cache
+    if cache is not None and cache[0] == stamp and cache[1] is parent:
+        return cache[2]
+
+    state = node._compose(parent)
+    for a in state:
+        a.setflags(write=False)
+
+    node._cache = (stamp, parent, state)
+    return state
+
+
+def _angle_value(angle):
+    """Value of a constant, `Parameter` or `TrajectorySample` angle."""
+    if isinstance(angle, (Parameter, TrajectorySample)):
+        return angle.value
+
+    return angle
+
+
+def _angle_parameter(angle) -> tuple:
+    """The `Parameter` that an angle depends on, and the (k,) derivative of
+    the angle w.r.t. it, or `(None, None)` for constants."""
+    if isinstance(angle, Parameter):
+        return angle, np.ones(1)
+
+    if isinstance(angle, TrajectorySample):
+        return angle.parameter, angle.weights
+
+    return None, None
+
+
+def _add_tangent(tangents: dict, param: Parameter, ds=None, dd=None, dR=None):
+    """Accumulates derivatives w.r.t. `param` into `tangents`, see
+    `Geometry.linearize`."""
+    if callable(param._value):
+        return
+
+    k = len(param)
+    ds = np.zeros((3, k)) if ds is None else ds
+    dd = np.zeros((3, k)) if dd is None else dd
+    dR = np.zeros((3, 3, k)) if dR is None else dR
+    if param in tangents:
+        ds0, dd0, dR0 = tangents[param]
+        ds, dd, dR = ds0 + ds, dd0 + dd, dR0 + dR
+
+    tangents[param] = (ds, dd, dR)
 
 
 def xray_project(geom: Geometry, location: np.ndarray) -> np.ndarray:
@@ -451,20 +851,149 @@ def xray_project(geom: Geometry, location: np.ndarray) -> np.ndarray:
         => y =  ...
         => z =  ...
     """
-    R = Geometry.angles2mat(geom.roll, geom.pitch, geom.yaw)
+    return xray_project_batch(*geom._state(), location)[0, 0]
+
+
+def xray_project_batch(sources: np.ndarray,
+                       detectors: np.ndarray,
+                       rotations: np.ndarray,
+                       locations: np.ndarray) -> np.ndarray:
+    """X-ray projection of `N` marker locations with `G` geometries at once.
+
+    This is the broadcasted version of `xray_project`, see there for the
+    derivation.
+
+    :param sources: (G, 3) array of source positions.
+    :param detectors: (G, 3) array of detector positions.
+    :param rotations: (G, 3, 3) stack of detector rotation matrices, as given
+        by `Geometry.angles2mat`.
+    :param locations: (N, 3) array of marker locations.
+    :return: (G, N, 2) array of projections in the detector frames.
+    """
+    sources = np.reshape(sources, (-1, 3))
+    detectors = np.reshape(detectors, (-1, 3))
+    rotations = np.reshape(rotations, (-1, 3, 3))
+    locations = np.reshape(locations, (-1, 3))
 
-    # get `p-s`, `s-d`, `d` transformed
-    p = np.dot(R, location - geom.detector)
-    s = np.dot(R, geom.source - geom.detector)
+    # get `p-s`, `s-d`, `d` transformed, for each geometry
+    p = np.einsum('gij,gnj->gni', rotations,
+                  locations[np.newaxis] - detectors[:, np.newaxis])
+    s = np.einsum('gij,gj->gi', rotations, sources - detectors)
+    s = s[:, np.newaxis]
 
-    # solve ray parameter
-    t = s[0] / (s - p)[0]
+    # solve ray parameters
+    t = s[..., 0] / (s[..., 0] - p[..., 0])
 
     # get (0, y, z) in the detector basis
-    y = s[1] + t * (p - s)[1]
-    z = s[2] + t * (p - s)[2]
+    return s[..., 1:] + t[..., np.newaxis] * (p[..., 1:] - s[..., 1:])
+
+
+def xray_project_derivatives(source, detector, R, locations) -> tuple:
+    """Derivatives of `xray_project` for a single geometry.
+
+    Writing `a = R (p - d)` and `b = R (s - d)`, the projection is
+        t = b[0] / (b[0] - a[0]),
+        (y, z) = b[1:] + t * (a[1:] - b[1:]).
+
+    :param locations: (N, 3) array of marker locations.
+    :return: A tuple of (N, 2, 3) arrays: the derivatives of the projections
+        w.r.t. `a` and `b`, and w.r.t. the marker locations.
+    """
+    locations = np.reshape(locations, (-1, 3))
+    a = (locations - detector) @ R.T
+    b = R @ (source - detector)
 
-    return np.array((y, z))
+    denom = b[0] - a[:, 0]
+    t = b[0] / denom
+    da0 = b[0] / denom ** 2  # dt/da[0]
+    db0 = -a[:, 0] / denom ** 2  # dt/db[0]
+
+    J_a = np.zeros((len(locations), 2, 3))
+    J_b = np.zeros((len(locations), 2, 3))
+    for i in (1, 2):
+        J_a[:, i - 1, 0] = (a[:, i] - b[i]) * da0
+        J_a[:, i - 1, i] = t
+        J_b[:, i - 1, 0] = (a[:, i] - b[i]) * db0
+        J_b[:, i - 1, i] = 1. - t
+
+    return J_a, J_b, J_a @ R
+
+
+def xray_project_location_derivatives(sources, detectors, rotations,
+                                      locations) -> tuple:
+    """Projections and their derivatives w.r.t. the marker locations, for `G`
+    geometries and `N` markers at once.
+
+    This is the broadcasted version of the marker derivative of
+    `xray_project_derivatives`, see there for the notation.
+
+    :return: A (G, N, 2) array of projections, as `xray_project_batch`, and
+        a (G, N, 2, 3) array of their derivatives.
+    """
+    locations = np.reshape(locations, (-1, 3))
+    a = np.einsum('gij,gnj->gni', rotations,
+                  locations[np.newaxis] - detectors[:, np.newaxis])
+    b = np.einsum('gij,gj->gi', rotations, sources - detectors)[:, np.newaxis]
+
+    denom = b[..., 0] - a[..., 0]
+    t = b[..., 0] / denom
+    projs = b[..., 1:] + t[..., np.newaxis] * (a[..., 1:] - b[..., 1:])
+
+    # dy/da and dz/da, of which only the 0th and own column are nonzero
+    J_a = np.zeros(a.shape[:2] + (2, 3))
+    J_a[..., 0] = (a[..., 1:] - b[..., 1:]) \
+        * (b[..., 0] / denom ** 2)[..., np.newaxis]
+    J_a[..., 0, 1] = t
+    J_a[..., 1, 2] = t
+    return projs, J_a @ rotations[:, np.newaxis]
+
+
+def xray_project_tangent(source, detector, R, locations, J_a, J_b,
+                         tangent) -> np.ndarray:
+    """Chain rule from a geometry tangent to the projections.
+
+    :param J_a: Derivative w.r.t. `a`, see `xray_project_derivatives`.
+    :param J_b: Derivative w.r.t. `b`, see `xray_project_derivatives`.
+    :param tangent: (ds, dd, dR) tuple, see `Geometry.linearize`.
+    :return: (N, 2, k) derivatives of the projections of `locations`.
+    """
+    ds, dd, dR = tangent
+    da = (np.einsum('ijk,nj->nik', dR, locations - detector)
+          - (R @ dd)[np.newaxis])
+    db = np.einsum('ijk,j->ik', dR, source - detector) + R @ (ds - dd)
+    return (np.einsum('nij,njk->nik', J_a, da)
+            + np.einsum('nij,jk->nik', J_b, db))
+
+
+def geometry_arrays(geoms) -> tuple:
+    """Stacks sources, detectors and rotation matrices of `geoms`.
+
+    :param geoms: A list of geometries, or a collection with an `arrays()`
+        method, such as `CompiledGeometries` or
+        `cate.util.InterpolatedGeometries`, which is used as is.
+    :return: A tuple of (G, 3), (G, 3) and (G, 3, 3) arrays, ready to be fed
+        into `xray_project_batch`.
+    """
+    if hasattr(geoms, 'arrays'):
+        return geoms.arrays()
+
+    return CompiledGeometries(geoms).arrays()
+
+
+def marker_array(markers: dict, ids=None) -> np.ndarray:
+    """Stacks the marker locations of `markers` into an (N, 3) array.
+
+    :param ids: Order of the markers, defaults to the order of `markers`.
+    """
+    if ids is None:
+        ids = markers.keys()
+
+    out = np.empty((len(ids), 3))
+    for i, id in enumerate(ids):
+        marker = markers[id]
+        out[i] = marker.value if isinstance(marker, Parameter) else marker
+
+    return out
 
 
 def xray_multigeom_project(geoms, markers: dict) -> list:
@@ -473,47 +1002,68 @@ def xray_multigeom_project(geoms, markers: dict) -> list:
     Returns a list. Each list item contains a dictionary of projection values
     belonging to a geometry from `geoms`.
     """
+    if isinstance(geoms, dict):
+        geoms = geoms.values()
 
-    data = []
-    for g in geoms.values():
-        projs = {}
-        for id, marker in markers.items():
-            v = marker.value if isinstance(marker, VectorParameter) else marker
-            projs[id] = xray_project(g, v)
+    ids = list(markers.keys())
+    projs = xray_project_batch(*geometry_arrays(geoms),
+                               marker_array(markers, ids))
 
-        data.append(projs)
+    data = []
+    for g_projs in projs:
+        data.append(dict(zip(ids, g_projs)))
 
     return data
 
 
 def xray_project_residuals(geom, proj, markers):
-    """Project markers only were there is data. Compute residuals."""
+    """Project markers only were there is data. Compute residuals.
 
-    residuals = []
-    available_annotations = [(markers[id].value, p) for id, p in
-                             proj.items()]
-    for marker, projected in available_annotations:
-        residual = xray_project(geom, marker) - projected
-        residuals.append(residual)
+    :return: (K, 2) array of residuals for the `K` annotations in `proj`.
+    """
+    ids = list(proj.keys())
+    projected = xray_project_batch(*geom._state(),
+                                   marker_array(markers, ids))[0]
+    return projected - np.reshape([proj[id] for id in ids], (-1, 2))
+
+
+def xray_data_residuals(sources, detectors, rotations, locations,
+                        pixels, mask) -> np.ndarray:
+    """Residuals of the annotated projections in a dense data layout.
 
-    return residuals
+    :param pixels: (G, N, 2) annotations, see `ProjectionData`.
+    :param mask: (G, N) annotation mask, see `ProjectionData`.
+    :return: Flat array of the (y, z) residuals of every annotation, in
+        row-major order of (geometry, marker).
+    """
+    projs = xray_project_batch(sources, detectors, rotations, locations)
+    return (projs[mask] - pixels[mask]).ravel()
 
 
 class XrayOptimizationProblem:
     def __init__(self, markers, geoms, data,
                  use_multiprocessing: bool = False,
-                 mode='jointly'):
+                 mode='jointly',
+                 profile=False):
         """
 
         :param markers:
         :param geoms:
-        :param data:
-        :param use_multiprocessing:
+        :param data: A `ProjectionData`, or a list of `{marker_id: pixel}`
+            dicts, one for each geometry, that is converted into one.
+        :param use_multiprocessing: Evaluate the residuals in persistent
+            worker processes, see `cate.parallel.ResidualWorkers`. `True` for
+            one process per CPU, or the number of processes.
         :param mode: when mode is set to 'alternate', the markers are not
         returned with params(), leading to a smaller optimization problem.
-        Instead the markers are computed using
-        `markers_from_leastsquares_intersection` in each iteration. This is
-        useful when there are many markers.
+        Instead, for every evaluation the markers are solved for the current
+        geometries with `leastsquares_reprojection`, starting from the
+        markers of the previous evaluation (variable projection). This is
+        useful when there are many markers. The markers are then available
+        in `markers`, after the first evaluation.
+        :param profile: Record timings and statistics in a
+            `cate.profiling.Profiler`, see `report()`. `True`, or the path of
+            a JSON-lines file to which every evaluation is appended.
         """
         self._mode = mode
         if mode not in ('jointly', 'alternate'):
@@ -525,63 +1075,500 @@ class XrayOptimizationProblem:
 
         self.markers = markers
         self.geoms = geoms
-        self.data = np.array(data).flatten()
-
-        # self.data = data
-        if use_multiprocessing:
-            self._pool = Pool()
+        self._store = None
+        self._cached_layout = None
+        if not isinstance(data, ProjectionData):
+            data = ProjectionData.from_dicts(
+                data, ids=sorted(markers.keys()) if mode == 'jointly' else None)
+        self.data = data
+
+        if len(self.data) != len(self.geoms):
+            raise ValueError("`data` must have an entry for each geometry.")
+
+        self._use_multiprocessing = use_multiprocessing
+        self._workers = None
+        self._incremental = None
+        self._marker_store = None
+
+        if profile is False or profile is None:
+            self.profiler = profiling.DISABLED
+        else:
+            self.profiler = profiling.Profiler(
+                trace=None if profile is True else profile)
+
+    def _layout(self) -> '_ParameterLayout':
+        """The cached `_ParameterLayout`, rebuilt only when the structure of
+        the problem changes, i.e. when geometries or markers are replaced,
+        added or removed, or when `Parameter.optimize` is toggled."""
+        markers = self.markers if self._mode == "jointly" else None
+        layout = self._cached_layout
+        if layout is None or not layout.matches(self.geoms, markers):
+            with self.profiler.phase('layout'):
+                layout = _ParameterLayout(self.geoms, markers)
+            self._cached_layout = layout
+            self.profiler.record(
+                parameters=layout.nr_cols, geometries=len(self.geoms),
+                markers=self.data.nr_markers,
+                observations=self.data.nr_observations)
+
+        return layout
+
+    def report(self) -> 'profiling.ProfileReport':
+        """Timings and statistics since the start of the problem, when it
+        was created with `profile`."""
+        return self.profiler.report()
 
     def params(self):
         """Consistent conversion of markers and geoms to list of parameters"""
-
-        params = []
-        if self._mode == "jointly":
-            for id in sorted(self.markers.keys()):
-                params.append(self.markers[id])
-
-        for g in self.geoms:
-            for p in g.parameters():
-                params.append(p)
-
-        # remove duplicates, it is important this is done in a consistent way
-        # so that when `update()` is called, the same parameters are updated.
-        deduped = []
-        for p in params:
-            if p not in deduped:
-                deduped.append(p)
-
-        assert len(deduped) == len(set(params))
-        return deduped
+        return list(self._layout().params)
 
     def bounds(self):
-        params = self.params()
+        params = self._layout().optimizable
         return (
             params2ndarray(params, key='min_bound'),
             params2ndarray(params, key='max_bound')
         )
 
     def update(self, x):
-        update_params(self.params(), x)
+        """Sets the parameters from `x`, through a `ParameterStore` that is
+        (re)created when the optimizable parameters change."""
+        params = self._layout().optimizable
+        with self.profiler.phase('update'):
+            # parameters that are shared with another problem may have moved
+            if self._store is None or self._store.params != params \
+                    or not self._store.is_bound():
+                self._store = ParameterStore(params)
+
+            self._store.update(x)
+
         return self.geoms, self.markers
 
+    def _offsets(self) -> dict:
+        """Maps each optimizable parameter to its first column in `x`."""
+        return self._layout().offsets
+
+    def jac_sparsity(self):
+        """Sparsity structure of the Jacobian, as a sparse 0/1 matrix.
+
+        A residual of a marker in a geometry only depends on the parameters
+        of that geometry (through its decorators), and on the marker. In
+        'alternate' mode the marker is inferred from all geometries that
+        annotate it, so the residual depends on the parameters of those.
+
+        Can be passed as `jac_sparsity` to `scipy.optimize.least_squares`,
+        which then uses grouped finite differences and the 'lsmr' solver.
+        """
+        import scipy.sparse
+
+        layout = self._layout()
+        offsets, nr_cols = layout.offsets, layout.nr_cols
+
+        def _incidence(param_lists):
+            # rows: items, columns: the `x`-columns of their parameters
+            rows, cols = [], []
+            for i, params in enumerate(param_lists):
+                for p in params:
+                    if p in offsets:
+                        cols.append(offsets[p] + np.arange(len(p)))
+                        rows.append(np.full(len(p), i))
+
+            rows = np.concatenate(rows) if len(rows) > 0 else []
+            cols = np.concatenate(cols) if len(cols) > 0 else []
+            return scipy.sparse.csr_matrix(
+                (np.ones(len(rows), dtype=int), (rows, cols)),
+                shape=(len(param_lists), nr_cols))
+
+        obs_g, obs_n = self.data.observations()
+        nr_obs = len(obs_g)
+        obs = np.arange(nr_obs)
+        ones = np.ones(nr_obs, dtype=int)
+        geom_obs = scipy.sparse.csr_matrix(
+            (ones, (obs, obs_g)), shape=(nr_obs, len(self.geoms)))
+        marker_obs = scipy.sparse.csr_matrix(
+            (ones, (obs, obs_n)), shape=(nr_obs, self.data.nr_markers))
+
+        geom_params = _incidence(layout.geom_params)
+        if self._mode == "jointly":
+            marker_params = _incidence(
+                [[self.markers[id]] for id in self.data.ids])
+        else:
+            marker_params = scipy.sparse.csr_matrix(
+                self.data.mask.T.astype(int)) @ geom_params
+
+        pattern = geom_obs @ geom_params + marker_obs @ marker_params
+
+        # every observation has a residual in `y` and `z`
+        pattern = scipy.sparse.kron(pattern, np.ones((2, 1), dtype=int))
+        pattern = scipy.sparse.csr_matrix(pattern)
+        pattern.data[:] = 1
+        return pattern
+
+    def jacobian(self, x: np.ndarray):
+        """Analytic Jacobian of `__call__`, as a sparse matrix.
+
+        Can be passed as `jac` to `scipy.optimize.least_squares`, preferably
+        with `tr_solver='lsmr'`. The derivatives of the geometries are taken
+        through their decorators with `Geometry.linearize`.
+
+        In 'alternate' mode this is the reduced Jacobian of variable
+        projection, w.r.t. the geometry parameters only. With `J_g` and `J_m`
+        the derivatives w.r.t. the geometries and the (solved) markers, it is
+            (I - J_m (J_m.T J_m)^-1 J_m.T) J_g,
+        i.e. Kaufman's approximation, which drops the second-order terms of
+        the markers. `J_m.T J_m` is block-diagonal with a (3, 3) block for
+        each marker, which are inverted in one batch. Since every marker
+        couples all geometries that annotate it, the reduced Jacobian is
+        nearly dense, and it is returned as a `LinearOperator` (which needs
+        `tr_solver='lsmr'`).
+        """
+        with self.profiler.phase('jacobian'):
+            return self._jacobian(x)
+
+    def _jacobian(self, x: np.ndarray):
+        import scipy.sparse
+        import scipy.sparse.linalg
+
+        self.update(x)
+        if self._mode == "alternate":
+            locations = self._solve_markers()
+        else:
+            locations = marker_array(self.markers, self.data.ids)
+
+        J_g, J_m = self._jacobian_blocks(locations)
+        if self._mode == "jointly":
+            # columns of the optimized markers in `x`
+            offsets = self._layout().offsets
+            marker_offsets = np.array(
+                [offsets.get(self.markers[id], -1) for id in self.data.ids],
+                dtype=int)
+            rows = np.flatnonzero(np.repeat(marker_offsets >= 0, 3))
+            cols = (np.repeat(marker_offsets, 3) + np.tile(np.arange(3),
+                    len(marker_offsets)))[rows]
+            select = scipy.sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, cols)),
+                shape=(J_m.shape[1], J_g.shape[1]))
+            return scipy.sparse.csr_matrix(J_g + J_m @ select)
+
+        H = scipy.sparse.coo_matrix(J_m.T @ J_m)
+        blocks = np.zeros((self.data.nr_markers, 3, 3))
+        np.add.at(blocks, (H.row // 3, H.row % 3, H.col % 3), H.data)
+        H_inv = np.linalg.pinv(blocks, hermitian=True)
+        blk, i, j = np.indices(H_inv.shape).reshape(3, -1)
+        H_inv = scipy.sparse.csr_matrix(
+            (H_inv.ravel(), (3 * blk + i, 3 * blk + j)),
+            shape=(J_m.shape[1],) * 2)
+        J_m_T = scipy.sparse.csr_matrix(J_m.T)
+
+        def _project(v):
+            # the projection is symmetric, so also used for the transpose
+            return v - J_m @ (H_inv @ (J_m_T @ v))
+
+        return scipy.sparse.linalg.LinearOperator(
+            J_g.shape,
+            matvec=lambda v: _project(J_g @ np.ravel(v)),
+            rmatvec=lambda v: J_g.T @ _project(np.ravel(v)),
+            dtype=float)
+
+    def _jacobian_blocks(self, locations) -> tuple:
+        """Sparse derivatives of the residuals w.r.t. the optimizable
+        geometry parameters, in the columns of `x`, and w.r.t. the (N, 3)
+        marker `locations`, in 3N columns."""
+        import scipy.sparse
+
+        layout = self._layout()
+        offsets = layout.offsets
+        nr_rows = 2 * self.data.nr_observations
+
+        geom_entries, marker_entries = ([], [], []), ([], [], [])
+
+        def _append(entries, obs_rows, col, block):
+            # `block` has shape (N, 2, k) for observation rows `obs_rows` of
+            # shape (N, 2), and columns `col` of shape (N, k) or (k,)
+            col = np.reshape(col, (-1, 1, block.shape[2]))
+            r, c = np.broadcast_arrays(obs_rows[..., np.newaxis], col)
+            entries[0].append(r.ravel())
+            entries[1].append(c.ravel())
+            entries[2].append(block.ravel())
+
+        row = 0
+        with self.profiler.phase('geometry'):
+            linearizations = layout.compiled.linearize()
+
+        with self.profiler.phase('projection'):
+            for linearization, g_mask in zip(linearizations, self.data.mask):
+                n_idx = np.flatnonzero(g_mask)
+                if len(n_idx) == 0:
+                    continue
+
+                obs_rows = row + np.arange(2 * len(n_idx)).reshape(-1, 2)
+                row += 2 * len(n_idx)
+
+                s, d, R, tangents = linearization
+                g_locations = locations[n_idx]
+                J_a, J_b, J_loc = xray_project_derivatives(
+                    s, d, R, g_locations)
+                for param, tangent in tangents.items():
+                    if param not in offsets:
+                        continue
+
+                    block = xray_project_tangent(s, d, R, g_locations, J_a,
+                                                 J_b, tangent)
+                    _append(geom_entries, obs_rows,
+                            offsets[param] + np.arange(block.shape[2]), block)
+
+                _append(marker_entries, obs_rows,
+                        3 * n_idx[:, np.newaxis] + np.arange(3), J_loc)
+
+        def _matrix(entries, nr_cols):
+            if len(entries[0]) == 0:
+                return scipy.sparse.csr_matrix((nr_rows, nr_cols))
+
+            rows, cols, vals = (np.concatenate(e) for e in entries)
+            return scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                           shape=(nr_rows, nr_cols))
+
+        return (_matrix(geom_entries, layout.nr_cols),
+                _matrix(marker_entries, 3 * self.data.nr_markers))
+
+    def _residual_workers(self):
+        """The `ResidualWorkers`, restarted when the layout or data change."""
+        from cate.parallel import ResidualWorkers
+
+        layout = self._layout()
+        workers = self._workers
+        if workers is None or workers.layout is not layout \
+                or workers.data is not self.data:
+            if workers is not None:
+                workers.close()
+
+            processes = None if self._use_multiprocessing is True \
+                else int(self._use_multiprocessing)
+            workers = ResidualWorkers(layout, self.data, processes)
+            self._workers = workers
+
+        return workers
+
+    def close(self):
+        """Stops the worker processes, if any, and closes the trace file."""
+        if self._workers is not None:
+            self._workers.close()
+            self._workers = None
+
+        self.profiler.close()
+
+    def _solve_markers(self) -> np.ndarray:
+        """In 'alternate' mode, solves the markers for the current geometries,
+        warm-started from the previous solution.
+
+        The markers are stored as `VectorParameter`s in `markers`, in one
+        `ParameterStore`, so that they can be set without a loop.
+        """
+        layout = self._layout()
+        with self.profiler.phase('geometry'):
+            sources, detectors, rotations = layout.compiled.arrays()
+
+        store = self._marker_store
+        warm = store is not None and store.is_bound() \
+            and len(store) == 3 * self.data.nr_markers
+        with self.profiler.phase('markers'):
+            locations = leastsquares_reprojection(
+                sources, detectors, rotations, self.data.pixels,
+                self.data.mask,
+                locations=store.buffer.reshape(-1, 3) if warm else None)
+
+        if not warm:
+            self.markers = {id: VectorParameter(loc, optimize=False)
+                            for id, loc in zip(self.data.ids, locations)}
+            store = ParameterStore(list(self.markers.values()))
+            self._marker_store = store
+
+        store.update(locations.ravel())
+        return locations
+
     def __call__(self, x: np.ndarray):
         """Optimization call"""
+        with self.profiler.phase('residuals'):
+            f = self._residuals(x)
+            self.profiler.residuals(f)
+
+        return f
+
+    def _residuals(self, x: np.ndarray):
         self.update(x)  # params restore values from `x`
 
         if self._mode == "alternate":
-            self.markers = markers_from_leastsquares_intersection(
-                self.geoms, self.data)
-
-        if hasattr(self, '_pool'):
-            residuals = self._pool.starmap(
-                xray_project_residuals, zip(self.geoms, self.data,
-                                            [self.markers] * len(self.geoms)))
+            locations = self._solve_markers()
         else:
-            residuals = []
-            for geom, proj in zip(self.geoms, self.data):
-                residuals.append(xray_project_residuals(geom, proj, self.markers))
+            locations = marker_array(self.markers, self.data.ids)
+
+        if self._use_multiprocessing:
+            with self.profiler.phase('workers'):
+                return self._residual_workers()(x, locations)
+
+        layout = self._layout()
+        incremental = self._incremental
+        if incremental is None or incremental.layout is not layout \
+                or incremental.data is not self.data:
+            incremental = _IncrementalResiduals(layout, self.data,
+                                                self.profiler)
+            self._incremental = incremental
 
-        return list(np.array(residuals).flatten())
+        return incremental(locations)
+
+
+class _ParameterLayout:
+    """De-duplicated parameters of an `XrayOptimizationProblem`, with the
+    column offsets of the optimizable ones in `x`.
+
+    The markers come first, sorted by id, and then the parameters of the
+    geometries in the order of `CompiledGeometries.parameters`. Duplicates are
+    removed by identity, keeping the first occurrence, so that the order is
+    consistent between `params()` and `update()`.
+    """
+
+    def __init__(self, geoms, markers=None):
+        self.geoms = list(geoms)
+        self.markers = None if markers is None else dict(markers)
+        self.compiled = CompiledGeometries(self.geoms)
+        self.geom_params = self.compiled.parameters()
+
+        params = {}
+        if self.markers is not None:
+            for id in sorted(self.markers.keys()):
+                params.setdefault(self.markers[id], None)
+
+        for g_params in self.geom_params:
+            params.update(dict.fromkeys(g_params))
+
+        self.params = list(params.keys())
+        self.optimizable = [p for p in self.params
+                            if isinstance(p, Parameter) and p.optimize]
+        self.offsets = {}
+        self.nr_cols = 0
+        for p in self.optimizable:
+            self.offsets[p] = self.nr_cols
+            self.nr_cols += len(p)
+
+        self._flags = [bool(p.optimize) for p in self.params]
+        self._dependents = None
+
+    def matches(self, geoms, markers=None) -> bool:
+        """If the layout is still valid for `geoms` and `markers`."""
+        if len(geoms) != len(self.geoms) or any(
+                g is not h for g, h in zip(geoms, self.geoms)):
+            return False
+
+        if (markers is None) != (self.markers is None):
+            return False
+
+        if markers is not None and (
+                markers.keys() != self.markers.keys() or any(
+                m is not self.markers[id] for id, m in markers.items())):
+            return False
+
+        return self._flags == [bool(p.optimize) for p in self.params]
+
+    def dependents(self) -> dict:
+        """Inverted index from each geometry parameter to the sorted indices
+        of the geometries that depend on it, through their decorators."""
+        if self._dependents is None:
+            dependents = {}
+            for i, g_params in enumerate(self.geom_params):
+                for p in g_params:
+                    dependents.setdefault(p, []).append(i)
+
+            self._dependents = {p: np.array(g, dtype=int)
+                                for p, g in dependents.items()}
+
+        return self._dependents
+
+
+class _IncrementalResiduals:
+    """Residuals of an `XrayOptimizationProblem` that are re-evaluated only
+    for what changed since the previous evaluation.
+
+    The changed parameters are found from `Parameter.version`, and the
+    geometries that depend on them from the inverted index of
+    `_ParameterLayout.dependents`. Only those geometries are resolved and
+    projected again, with all markers. The other geometries only project the
+    markers that moved. All other residuals are reused. Geometries of which
+    a non-`Parameter` attribute changed are all re-evaluated.
+    """
+
+    def __init__(self, layout: _ParameterLayout, data: ProjectionData,
+                 profiler=profiling.DISABLED):
+        self.layout = layout
+        self.data = data
+        self.profiler = profiler
+
+        # row of each annotation in the (M, 2) residuals
+        self._obs_index = np.full(data.mask.shape, -1)
+        self._obs_index[data.mask] = np.arange(data.nr_observations)
+
+        self._residuals = None
+        self._locations = None
+        self._versions = None
+        self._node_versions = None
+
+    def _snapshot(self):
+        return (np.array([p.version for p in self.layout.params], dtype=int),
+                [n._version for n in self.layout.compiled._nodes])
+
+    def __call__(self, locations: np.ndarray) -> np.ndarray:
+        """Residuals, as `xray_data_residuals`, for the current values of the
+        parameters of the layout and marker `locations`."""
+        data = self.data
+        versions, node_versions = self._snapshot()
+        if self._residuals is None or node_versions != self._node_versions:
+            geoms = np.arange(len(data))
+        else:
+            dependents = self.layout.dependents()
+            changed = [self.layout.params[i] for i in
+                       np.flatnonzero(versions != self._versions)]
+            geoms = np.unique(np.concatenate(
+                [dependents.get(p, []) for p in changed]
+                + [np.empty(0, dtype=int)]).astype(int))
+
+        phase = self.profiler.phase
+        if self._residuals is None or len(geoms) > len(data) // 2:
+            with phase('geometry'):
+                states = self.layout.compiled.arrays()
+            with phase('projection'):
+                residuals = xray_data_residuals(
+                    *states, locations, data.pixels,
+                    data.mask).reshape(-1, 2)
+        else:
+            residuals = self._residuals
+            if len(geoms) > 0:
+                with phase('geometry'):
+                    states = CompiledGeometries(
+                        [self.layout.geoms[i] for i in geoms]).arrays()
+                with phase('projection'):
+                    mask = data.mask[geoms]
+                    residuals[self._obs_index[geoms][mask]] = \
+                        xray_data_residuals(*states, locations,
+                                            data.pixels[geoms],
+                                            mask).reshape(-1, 2)
+
+            # moved markers in the other geometries
+            markers = np.flatnonzero(
+                np.any(locations != self._locations, axis=1))
+            if len(markers) > 0:
+                others = np.setdiff1d(np.arange(len(data)), geoms)
+                with phase('geometry'):
+                    states = CompiledGeometries(
+                        [self.layout.geoms[i] for i in others]).arrays()
+                with phase('projection'):
+                    projs = xray_project_batch(*states, locations[markers])
+                    idx = np.ix_(others, markers)
+                    mask = data.mask[idx]
+                    residuals[self._obs_index[idx][mask]] = \
+                        projs[mask] - data.pixels[idx][mask]
+
+        self._residuals = residuals
+        self._locations = np.array(locations, dtype=float)
+        self._versions, self._node_versions = versions, node_versions
+        return residuals.ravel().copy()
 
 
 def markers_from_leastsquares_intersection(
@@ -596,6 +1583,28 @@ def markers_from_leastsquares_intersection(
     on the detector to the source location.
     
     https://silo.tips/download/least-squares-intersection-of-lines"""
+    # There is a complication with partially-annotated data that for instance
+    # occurs when derived from a tiled scan (not every marker is visible on
+    # every scan), or with difficult data, where marker locations are skipped
+    # because they could not be accurately annotated.
+    # For this, we use the masked data layout, and check if the number of
+    # annotations is large enough for a line intersection (n>= 2).
+    if not isinstance(data, ProjectionData):
+        data = ProjectionData.from_dicts(data)
+
+    # are there enough projections?
+    for id, count in zip(data.ids, data.counts()):
+        if 0 < count <= 2:
+            raise Exception(f"Unsufficient data for point with id {id}")
+
+    sources, detectors, rotations = geometry_arrays(geoms)
+    locations = leastsquares_intersection(sources, detectors, rotations,
+                                          data.pixels, data.mask)
+
+    markers = {}
+    for i in np.flatnonzero(data.counts()):
+        markers[data.ids[i]] = VectorParameter(locations[i],
+                                               optimize=optimizable)
 
     if plot:
         import matplotlib.pyplot as plt
@@ -605,69 +1614,149 @@ def markers_from_leastsquares_intersection(
         ax = fig.add_subplot(111, projection='3d')
         # ax.set_box_aspect([150, 150, 40])
 
-    # There is a complication with partially-annotated data that for instance
-    # occurs when derived from a tiled scan (not every marker is visible on
-    # every scan), or with difficult data, where marker locations are skipped
-    # because they could not be accurately annotated.
-    # For this, we'll have to assume that data is a partial array, so we'll
-    # have to go through the data and see which geometries annotate which data,
-    # and if the number of annotations is large enough for a
-    # line intersection (n>= 2).
-    projections = {}
-    for proj, geom in zip(data, geoms):
-        for id, pixel in proj.items():
-            if not (id in projections):
-                projections[id] = []
-
-            # store both the pixel location and associated geometry
-            projections[id].append((geom, pixel))
-
-    # are there enough projections?
-    for id, proj_point in projections.items():
-        if len(proj_point) <= 2:
-            raise Exception(f"Unsufficient data for point with id {id}")
+        points = detector_points(detectors, rotations, data.pixels)
+        for i in np.flatnonzero(data.counts()):
+            g_idx = np.flatnonzero(data.mask[:, i])
+            for s, y in zip(sources[g_idx], points[g_idx, i]):
+                ax.plot(*np.stack((s, y), axis=1), 'gray')
 
-    markers = {}
-    for id, projected_markers in projections.items():
-        R = np.zeros((3, 3))
-        q = np.zeros(3)
-
-        # one entity (needle) on multiple projections
-        ns = []
-        ss = []
-        ds = []
-        for g, p in projected_markers:  # type: (Geometry, np.ndarray)
-            # the projection point in physical space
-            R_det = Geometry.angles2mat(g.roll, g.pitch, g.yaw)
-            y = g.detector + R_det.T @ [0., p[0], p[1]]
-            n = g.source - y  # normal vector
-            n /= np.linalg.norm(n)
-            Rj = np.identity(3) - np.outer(n, n)
-            R += Rj
-            q += Rj.dot(y)
-
-            if plot:
-                ns.append(y)
-                ss.append(g.source)
-                ds.append(g.detector)
-
-                k = lambda i: [g.source[i], y[i]]
-                ax.plot(k(0), k(1), k(2), 'gray')
-
-        x = np.linalg.pinv(R) @ q
-        markers[id] = VectorParameter(np.array(x), optimize=optimizable)
-
-        if plot:
-            ns = np.array(ns).T
-            ss = np.array(ss).T
-            ds = np.array(ds).T
+            ns = points[g_idx, i].T
+            ss = sources[g_idx].T
+            ds = detectors[g_idx].T
+            x = locations[i]
             ax.scatter(x[0], x[1], x[2], marker='.', s=150)
             ax.scatter(ns[0], ns[1], ns[2], marker='o')
             ax.scatter(ss[0], ss[1], ss[2], marker='x')
             ax.scatter(ds[0], ds[1], ds[2], marker='|')
 
-    if plot:
-        import matplotlib.pyplot as plt
         plt.show()
 
-    return markers
\ No newline at end of file
+    return markers
+
+
+# number of (geometry, marker) pairs of which the intermediates of
+# `leastsquares_intersection` and `leastsquares_reprojection` are in memory
+_CHUNK_SIZE = 2 ** 20
+
+
+def detector_points(detectors, rotations, pixels) -> np.ndarray:
+    """Physical locations of (G, N, 2) detector coordinates, i.e. the
+    inverse of the detector-plane part of `xray_project_batch`.
+
+    :return: (G, N, 3) array.
+    """
+    # `R.T @ [0, y, z]` is a combination of the 2nd and 3rd row of `R`
+    return (detectors[:, np.newaxis]
+            + pixels[..., 0, np.newaxis] * rotations[:, np.newaxis, 1]
+            + pixels[..., 1, np.newaxis] * rotations[:, np.newaxis, 2])
+
+
+def leastsquares_intersection(sources, detectors, rotations, pixels,
+                              mask) -> np.ndarray:
+    """Least-squares intersection of the source-to-detector rays of every
+    marker, for all markers at once.
+
+    For each marker the normal equations
+        sum_j (I - n_j n_j.T) x = sum_j (I - n_j n_j.T) y_j
+    are accumulated over the geometries `j` that annotate it, with `y_j` the
+    annotated point on the detector, and `n_j` the unit direction to the
+    source, in chunks of geometries. The (N, 3, 3) systems are solved in
+    one batch, falling back to a pseudo-inverse only for degenerate systems
+    (e.g. parallel rays).
+
+    :param pixels: (G, N, 2) annotations, see `ProjectionData`.
+    :param mask: (G, N) annotation mask, see `ProjectionData`.
+    :return: (N, 3) marker locations. Markers without annotations are zero.
+    """
+    nr_markers = mask.shape[1]
+    A = np.zeros((nr_markers, 3, 3))
+    q = np.zeros((nr_markers, 3))
+    # chunks of geometries, to limit the memory of the intermediates
+    chunk = max(1, _CHUNK_SIZE // max(1, nr_markers))
+    for c in range(0, len(sources), chunk):
+        c = slice(c, c + chunk)
+        w = mask[c].astype(float)
+        y = detector_points(detectors[c], rotations[c],
+                            np.where(mask[c, ..., np.newaxis], pixels[c], 0.))
+        n = sources[c, np.newaxis] - y
+        n /= np.linalg.norm(n, axis=-1, keepdims=True)
+
+        A += (np.sum(w, axis=0)[:, np.newaxis, np.newaxis] * np.identity(3)
+              - np.einsum('gn,gni,gnj->nij', w, n, n))
+        q += (np.einsum('gn,gni->ni', w, y)
+              - np.einsum('gn,gni,gn->ni', w, n,
+                          np.einsum('gni,gni->gn', n, y)))
+
+    return _solve_blocks(A, q)
+
+
+def leastsquares_reprojection(sources, detectors, rotations, pixels, mask,
+                              locations: np.ndarray = None,
+                              max_iter: int = 10,
+                              xtol: float = 1e-12) -> np.ndarray:
+    """Marker locations that minimize the reprojection error, for all
+    markers at once.
+
+    With the geometries fixed, every marker is an independent 3-parameter
+    least-squares problem. These are solved with batched Gauss-Newton
+    iterations, in which the (N, 3, 3) normal equations of all markers are
+    accumulated over the annotating geometries, and solved in one go.
+
+    :param pixels: (G, N, 2) annotations, see `ProjectionData`.
+    :param mask: (G, N) annotation mask, see `ProjectionData`.
+    :param locations: (N, 3) initial marker locations, e.g. the solution for
+        slightly different geometries. Defaults to the closed-form
+        `leastsquares_intersection`.
+    :param max_iter: Maximum number of Gauss-Newton iterations.
+    :param xtol: Stops when no marker moves more than `xtol` times (`xtol`
+        plus the largest coordinate).
+    :return: (N, 3) marker locations. Markers without annotations are not
+        moved.
+    """
+    if locations is None:
+        locations = leastsquares_intersection(sources, detectors, rotations,
+                                              pixels, mask)
+
+    locations = np.array(locations, dtype=float)
+    # chunks of geometries, to limit the memory of the derivatives
+    chunk = max(1, _CHUNK_SIZE // max(1, locations.shape[0]))
+    for _ in range(max_iter):
+        H = np.zeros((len(locations), 3, 3))
+        g = np.zeros((len(locations), 3))
+        for c in range(0, len(sources), chunk):
+            c = slice(c, c + chunk)
+            projs, J = xray_project_location_derivatives(
+                sources[c], detectors[c], rotations[c], locations)
+            J[~mask[c]] = 0.
+            r = np.where(mask[c, ..., np.newaxis], projs - pixels[c], 0.)
+
+            # (N, 2G, 3) stacks, for batched products per marker
+            J = J.transpose(1, 0, 2, 3).reshape(len(locations), -1, 3)
+            r = r.transpose(1, 0, 2).reshape(len(locations), -1, 1)
+            J_T = J.transpose(0, 2, 1)
+            H += J_T @ J
+            g += (J_T @ r)[..., 0]
+
+        step = _solve_blocks(H, -g)
+        locations += step
+        if np.max(np.abs(step), initial=0.) <= xtol * (
+                xtol + np.max(np.abs(locations), initial=0.)):
+            break
+
+    return locations
+
+
+def _solve_blocks(A, q) -> np.ndarray:
+    """Solves a stack of (3, 3) systems `A x = q`, falling back to a
+    pseudo-inverse only for the (nearly) singular ones."""
+    x = np.empty_like(q)
+    # Cheaper than the condition number, which needs an SVD of every block:
+    # the determinant (from an LU factorization) is small relative to its
+    # upper bound, the product of the row norms (Hadamard's inequality), for
+    # blocks that are close to singular.
+    bound = np.prod(np.linalg.norm(A, axis=-1), axis=-1)
+    regular = np.abs(np.linalg.det(A)) > 1e-12 * bound
+    x[regular] = np.linalg.solve(A[regular], q[regular, :, np.newaxis])[..., 0]
+    x[~regular] = np.einsum('nij,nj->ni', np.linalg.pinv(A[~regular]),
+                            q[~regular])
+    return x
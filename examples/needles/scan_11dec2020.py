@@ -193,7 +193,7 @@ def astra_tiled_reco(
     else:
         # convert input `geoms` to ASTRA vectors, take detector from
         # FleX-ray settings
-        vectors = np.array([geom2astravec(g, rec.detector()) for g in geoms])
+        vectors = geoms2astravecs(geoms, rec.detector())
 
     sino_id, proj_geom = rec.sino_gpu_and_proj_geom(
         sinogram,
@@ -229,7 +229,7 @@ def astra_tiled_residual(tiling_paths,
 
         vectors = rec.geom(angles)
     else:
-        vectors = np.array([geom2astravec(g, rec.detector()) for g in geoms])
+        vectors = geoms2astravecs(geoms, rec.detector())
 
     sino_id, proj_geom = rec.sino_gpu_and_proj_geom(
         0.,  # zero-sinogram
@@ -8,8 +8,12 @@ import pyqtgraph as pq
 import scipy.optimize
 
 from cate import xray
-from cate.annotate import Annotator
-from cate.param import ScalarParameter, VectorParameter, params2ndarray
+from cate.annotate import Annotator, load_projection_data
+from cate.astra import geoms2astravecs
+from cate.parallel import FiniteDifferenceJacobian
+from cate.param import (ScalarParameter, TrajectoryParameter, VectorParameter,
+                        params2ndarray)
+from cate.solve import bundle_adjustment
 from cate.xray import Detector, XrayOptimizationProblem, \
     markers_from_leastsquares_intersection
 
@@ -33,22 +37,12 @@ def needle_data_from_reflex(dir,
             loc = entity_locations_class(fname, nr)
             Annotator(loc, proj)
 
-    data = []
-    for nr in nrs:
-        loc = entity_locations_class(fname, nr)
-        l = loc.locations()
+    # a single pass over the annotation file, for all `nrs`
+    return load_projection_data(fname, nrs, allow_missing=False).to_dicts()
 
-        # for backwards compatibility (I used tuples before)
-        for id, pixel in l.items():
-            if isinstance(l[id], tuple):
-                l[id] = list(pixel)
 
-        data.append(l)
-
-    return data
-
-
-def geoms_from_reflex(dir: str, angles, parametrization='default'):
+def geoms_from_reflex(dir: str, angles, parametrization='default',
+                      nr_coefficients: int = 8, nrs=None):
     """Load CATE X-ray geometries from FleX-ray descriptions, using Reflex
 
     :param parametrization
@@ -58,13 +52,17 @@ def geoms_from_reflex(dir: str, angles, parametrization='default'):
         When the `parametrization` is 'rotation_stage', the geometry is encoded
         as an initial static geometry, and all the subsequent geometries are
         parametrized as a rotation of the initial geometry.
+        With 'rotation_trajectory' the rotations are not independent, but
+        samples of one smooth `TrajectoryParameter` of the angle versus the
+        frame, with `nr_coefficients` unknowns, which needs the frame
+        numbers `nrs` of the `angles`, at least `nr_coefficients` of them.
     """
     import reflex
 
     sett = reflex.Settings.from_path(dir)
     motor_geom = reflex.motor_geometry(sett, verbose=False)
 
-    if parametrization == 'rotation_stage':
+    if parametrization in ('rotation_stage', 'rotation_trajectory'):
         geoms = []
 
         # describe a tilt of the rotation stage, which doesn't require yaw
@@ -80,13 +78,21 @@ def geoms_from_reflex(dir: str, angles, parametrization='default'):
                                      roll=ScalarParameter(0.),
                                      pitch=ScalarParameter(0.))
 
+        if parametrization == 'rotation_trajectory':
+            if nrs is None or len(nrs) != len(angles):
+                raise ValueError("'rotation_trajectory' needs the frame "
+                                 "number of each angle in `nrs`.")
+            trajectory = TrajectoryParameter.fit(
+                np.asarray(nrs), angles, nr_coefficients)
+            angles = trajectory.samples(np.asarray(nrs))
+        else:
+            angles = [ScalarParameter(angle) for angle in angles]
+
         # describe as a rotation of `angle` from the initial point
         # the alternative could be to chain-describe the geometries, not sure
         # if that is better
         for i, angle in enumerate(angles):
-            rotated_geom = xray.transform(
-                tilted_geom,
-                yaw=ScalarParameter(angle))
+            rotated_geom = xray.transform(tilted_geom, yaw=angle)
             geoms.append(rotated_geom)
 
     elif parametrization == 'default':
@@ -209,7 +215,7 @@ def astra_reco(
     else:
         # convert input `geoms` to ASTRA vectors, take detector from
         # FleX-ray settings
-        vectors = np.array([geom2astravec(g, rec.detector()) for g in geoms])
+        vectors = geoms2astravecs(geoms, rec.detector())
 
     sino_id, proj_geom = rec.sino_gpu_and_proj_geom(
         sinogram,
@@ -244,7 +250,7 @@ def astra_residual(projs_path, nrs, vol_id, vol_geom, angles=None, geoms=None):
 
         vectors = rec.geom(angles)
     else:
-        vectors = np.array([geom2astravec(g, rec.detector()) for g in geoms])
+        vectors = geoms2astravecs(geoms, rec.detector())
 
     sino_id, proj_geom = rec.sino_gpu_and_proj_geom(
         0.,  # zero-sinogram
@@ -261,14 +267,26 @@ def astra_residual(projs_path, nrs, vol_id, vol_geom, angles=None, geoms=None):
 
 
 def run_calibration(geoms, markers, data, method='trf',
-                    loss='huber', verbose=2, max_nfev=None):
+                    loss='huber', verbose=2, max_nfev=None, jac='3-point',
+                    jac_sparsity: bool = False, profile=False):
     """In-place optimization of `geoms` and `points` using `data`
 
     :param geoms:
     :param markers:
     :param data:
     :param plot_dets:
+    :param method: 'schur' for `cate.solve.bundle_adjustment`, otherwise
+        a method of `scipy.optimize.least_squares`.
     :param verbose:
+    :param jac: A finite difference scheme that is understood by SciPy,
+        'analytic' to use the exact Jacobian of the problem, or 'parallel'
+        for `cate.parallel.FiniteDifferenceJacobian`. Not used by 'schur'.
+        The latter two are sparse, and solved with `tr_solver='lsmr'`.
+    :param jac_sparsity: `True` to group the finite differences of a SciPy
+        scheme by `problem.jac_sparsity()`, which is also solved with
+        `tr_solver='lsmr'`. Otherwise the dense 'exact' solver is used.
+    :param profile: `True` to print a `cate.profiling.ProfileReport` of the
+        optimization, or the path of a JSON-lines trace file.
     :return:
     """
 
@@ -287,21 +305,55 @@ def run_calibration(geoms, markers, data, method='trf',
         markers=markers,
         geoms=geoms,
         data=data,
-        use_multiprocessing=False
+        use_multiprocessing=False,
+        profile=profile
     )
 
-    r = scipy.optimize.least_squares(
-        fun=problem,
-        x0=params2ndarray(problem.params()),
-        bounds=problem.bounds(),
-        verbose=verbose,
-        method=method,
-        tr_solver='exact',
-        loss=loss,
-        jac='3-point',
-        max_nfev=max_nfev
-    )
-    geoms_calibrated, markers_calibrated = problem.update(r.x)
+    # sparse Jacobians are not supported by the exact trust-region solver,
+    # nor by 'lm'
+    sparse = jac in ('analytic', 'parallel') or jac_sparsity
+    if method == 'lm' and sparse:
+        raise ValueError("`method='lm'` needs a dense Jacobian, i.e. a "
+                         "finite difference `jac` without `jac_sparsity`.")
+
+    try:
+        if method == 'schur':
+            # dedicated bundle adjustment, eliminating the marker unknowns
+            r = bundle_adjustment(
+                problem,
+                x0=params2ndarray(problem.params()),
+                bounds=problem.bounds(),
+                verbose=verbose,
+                loss=loss,
+                max_nfev=max_nfev
+            )
+        else:
+            if jac == 'analytic':
+                jac = problem.jacobian
+            elif jac == 'parallel':
+                jac = FiniteDifferenceJacobian(problem)
+
+            r = scipy.optimize.least_squares(
+                fun=problem,
+                x0=params2ndarray(problem.params()),
+                bounds=problem.bounds(),
+                verbose=verbose,
+                method=method,
+                tr_solver='lsmr' if sparse else 'exact',
+                loss=loss,
+                jac=jac,
+                jac_sparsity=problem.jac_sparsity() if jac_sparsity else None,
+                max_nfev=max_nfev
+            )
+        geoms_calibrated, markers_calibrated = problem.update(r.x)
+    finally:
+        # stops the worker processes, if any
+        if isinstance(jac, FiniteDifferenceJacobian):
+            jac.close()
+        problem.close()
+
+    if profile:
+        print(problem.report())
 
     np.set_printoptions(precision=4, suppress=True)
     if verbose >= 2: